@@ -0,0 +1,306 @@
+"""
+Headless benchmarks of the preprocessing, directory loading, preview and
+upload planning code paths on synthetic volumes. Every case runs in its
+own subprocess three times: timed, under tracemalloc, and for its peak
+resident set size. Both memory figures are what the timed code uses on
+top of its setup (the synthetic volume, the napari import): tracemalloc
+counts Python and numpy allocations, the peak RSS also counts native
+buffers such as those of decoders and Qt, and neither measurement slows
+the timed run. Results are appended as JSON lines tagged with the
+current git commit.
+
+    QT_QPA_PLATFORM=offscreen python benchmarks/bench_suite.py --z 200 --size 1024 --output results.jsonl
+    python benchmarks/bench_suite.py --compare before.jsonl after.jsonl
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from skimage.io import imsave
+
+# Each case does its setup and returns the function to time and the number of files it handles
+CASES = {}
+
+
+def case(func):
+    CASES[func.__name__] = func
+    return func
+
+
+def make_volume(args):
+    rng = np.random.default_rng(args.seed)
+    return rng.integers(0, 256, (args.z, args.size, args.size), dtype=np.uint8)
+
+
+def make_subject_set_dir(directory, args):
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(args.seed)
+    for z in range(args.z):
+        imsave(os.path.join(directory, f"img_x0000_y0000_z{z:04d}.jpeg"),
+               rng.integers(0, 256, (args.tile, args.tile), dtype=np.uint8), check_contrast=False)
+    return args.z
+
+
+def make_viewer():
+    from qtpy.QtWidgets import QApplication
+    from napari.components import ViewerModel
+    return QApplication.instance() or QApplication([]), ViewerModel()
+
+
+def drain(generator):
+    for _ in generator:
+        pass
+
+
+@case
+def preprocess_tiling(args, tmp):
+    from napari_zooniverse._export import grid_tiles
+    from napari_zooniverse._pipeline import iter_preprocess
+    image = make_volume(args)
+    tiles = grid_tiles(image.shape, args.tiles, args.tiles)
+    return lambda: drain(iter_preprocess(image, tmp, tiles, args.slab_size, args.workers)), \
+        len(tiles) * args.z
+
+
+@case
+def preprocess_tiling_zarr(args, tmp):
+    from napari_zooniverse._export import grid_tiles
+    from napari_zooniverse._pipeline import iter_preprocess
+    image = make_volume(args)
+    tiles = grid_tiles(image.shape, args.tiles, args.tiles)
+    return lambda: drain(iter_preprocess(image, tmp, tiles, args.slab_size, args.workers, output_format='zarr')), \
+        len(tiles) * args.z
+
+
+@case
+def preprocess_roi(args, tmp):
+    from napari_zooniverse._export import roi_tiles
+    from napari_zooniverse._pipeline import iter_preprocess
+    image = make_volume(args)
+    half = args.size // 2
+    shapes = [np.array([[0, r, c], [0, r, c + args.tile], [0, r + args.tile, c + args.tile], [0, r + args.tile, c]])
+              for r, c in [(0, 0), (0, half), (half, 0), (half, half)]]
+    tiles = roi_tiles(shapes)
+    return lambda: drain(iter_preprocess(image, tmp, tiles, args.slab_size, args.workers)), \
+        len(tiles) * args.z
+
+
+@case
+def tiling_roi_preview(args, tmp):
+    from napari_zooniverse._preprocess_widget import PreprocessWidget
+    app, viewer = make_viewer()
+    widget = PreprocessWidget(viewer)
+    layer = viewer.add_image(make_volume(args))
+    widget.image_select.choices = [layer]
+    widget.image_select.value = layer
+    widget.tiling_checkbox.setChecked(True)
+    widget.tiling_n_tiles_x.setValue(args.tiles)
+    widget.tiling_n_tiles_y.setValue(args.tiles)
+
+    def run():
+        widget._tiling_roi_preview()
+        np.asarray(viewer.layers[-1].data[args.z // 2])
+
+    return run, args.z
+
+
+@case
+def scan_directory(args, tmp):
+    from napari_zooniverse import _utils
+    from napari_zooniverse._upload_widget import UploadWidget
+    directory = os.path.join(tmp, 'image_x0000_y0000')
+    n_files = make_subject_set_dir(directory, args)
+    app, viewer = make_viewer()
+    widget = UploadWidget(viewer)
+
+    def run():
+        for _ in range(args.repeat):
+            _utils.get_image_list(directory)
+            widget.validate_directory(directory)
+
+    return run, n_files * args.repeat
+
+
+@case
+def subject_set_preview(args, tmp):
+    from napari_zooniverse._upload_widget import UploadWidget
+    directory = os.path.join(tmp, 'image_x0000_y0000')
+    make_subject_set_dir(directory, args)
+    app, viewer = make_viewer()
+    widget = UploadWidget(viewer)
+
+    def run():
+        preview = widget._build_subject_set_preview(directory, args.span, args.step, args.subject_set_size)
+        # Decode what napari would show first: one plane of the preview
+        np.asarray(preview[0, args.span])
+
+    return run, args.z
+
+
+@case
+def upload_planning(args, tmp):
+    from napari_zooniverse._pipeline import plan_report
+    directory = os.path.join(tmp, 'image_x0000_y0000')
+    n_files = make_subject_set_dir(directory, args)
+    return lambda: plan_report(directory, args.span, args.step, args.subject_set_size), n_files
+
+
+def run_case(name, args):
+    with tempfile.TemporaryDirectory() as tmp:
+        run, n_files = CASES[name](args, tmp)
+        start_time = time.perf_counter()
+        run()
+        wall_time = time.perf_counter() - start_time
+    return {'case': name, 'wall (s)': wall_time, 'files': n_files, 'files/s': n_files / wall_time}
+
+
+def trace_case(name, args):
+    """
+    :return: peak MB allocated by Python and numpy while a case runs,
+             counted from the end of its setup.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        run, _ = CASES[name](args, tmp)
+        tracemalloc.start()
+        try:
+            run()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return {'case': name, 'peak memory (MB)': peak / 1e6}
+
+
+def _rss_mb(field):
+    with open('/proc/self/status') as f:
+        return int(re.search(rf'^{field}:\s+(\d+) kB', f.read(), re.MULTILINE).group(1)) / 1e3
+
+
+def rss_case(name, args):
+    """
+    :return: peak MB of resident memory while a case runs, above the
+             resident memory at the end of its setup.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        run, _ = CASES[name](args, tmp)
+        if os.path.exists('/proc/self/clear_refs'):
+            baseline = _rss_mb('VmRSS')
+            # Reset the high water mark to the current RSS, so setup peaks are not counted
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+            run()
+            peak = _rss_mb('VmHWM')
+        else:
+            import resource
+            # ru_maxrss is in kB on Linux and bytes on macOS, and counts the setup's own peak
+            unit = 1e6 if sys.platform == 'darwin' else 1e3
+            baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit
+            run()
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit
+    return {'case': name, 'peak RSS (MB)': max(peak - baseline, 0.0)}
+
+
+def run_subprocess(name, passthrough, mode):
+    proc = subprocess.run([sys.executable, __file__, name, mode] + passthrough, capture_output=True, text=True)
+    if proc.returncode != 0:
+        print(f"{name} failed:\n{proc.stderr}", file=sys.stderr)
+        return None
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+
+def compare(before_path, after_path):
+    def load(path):
+        with open(path) as f:
+            return {r['case']: r for r in map(json.loads, f)}
+
+    before, after = load(before_path), load(after_path)
+    print(f"{'case':<28}{'wall before':>14}{'wall after':>14}{'speedup':>10}{'MB before':>12}{'MB after':>11}"
+          f"{'RSS before':>12}{'RSS after':>11}")
+    for name in before:
+        if name in after:
+            b, a = before[name], after[name]
+            print(f"{name:<28}{b['wall (s)']:>14.3f}{a['wall (s)']:>14.3f}{b['wall (s)'] / a['wall (s)']:>10.2f}"
+                  f"{b.get('peak memory (MB)', 0):>12.1f}{a.get('peak memory (MB)', 0):>11.1f}"
+                  f"{b.get('peak RSS (MB)', 0):>12.1f}{a.get('peak RSS (MB)', 0):>11.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('cases', nargs='*', help=f"cases to run, from {', '.join(CASES)}; all by default")
+    parser.add_argument('--z', type=int, default=100, help="number of z slices")
+    parser.add_argument('--size', type=int, default=1024, help="edge length of the synthetic volume")
+    parser.add_argument('--tile', type=int, default=256, help="edge length of ROI tiles and subject images")
+    parser.add_argument('--tiles', type=int, default=4, help="tiles along each axis when tiling")
+    parser.add_argument('--slab-size', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=min(os.cpu_count() or 1, 8))
+    parser.add_argument('--span', type=int, default=2)
+    parser.add_argument('--step', type=int, default=10)
+    parser.add_argument('--subject-set-size', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=10, help="repetitions of the directory scan")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="JSON lines file results are appended to")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help="compare two result files")
+    parser.add_argument('--in-process', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--trace-memory', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--measure-rss', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # The preview shows the first subject, which needs a full window of slices
+    window = 2 * args.span * args.step + 1
+    if not args.cases:
+        args.cases = [name for name in CASES if name != 'subject_set_preview' or args.z >= window]
+        if 'subject_set_preview' not in args.cases:
+            print(f"Skipping subject_set_preview, which needs --z of at least {window}", file=sys.stderr)
+    elif 'subject_set_preview' in args.cases and args.z < window:
+        parser.error(f"subject_set_preview needs --z of at least 2 * span * step + 1 = {window} "
+                     f"for one subject, got {args.z}")
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    if args.in_process:
+        print(json.dumps(run_case(args.cases[0], args)))
+        return
+    if args.trace_memory:
+        print(json.dumps(trace_case(args.cases[0], args)))
+        return
+    if args.measure_rss:
+        print(json.dumps(rss_case(args.cases[0], args)))
+        return
+
+    commit = git_commit()
+    passthrough = [a for a in sys.argv[1:] if a not in args.cases]
+    if '--output' in passthrough:
+        i = passthrough.index('--output')
+        del passthrough[i:i + 2]
+    for name in args.cases:
+        result = run_subprocess(name, passthrough, '--in-process')
+        memory = run_subprocess(name, passthrough, '--trace-memory')
+        rss = run_subprocess(name, passthrough, '--measure-rss')
+        if result is None or memory is None or rss is None:
+            continue
+        result.update(memory, **rss)
+        result.update(commit=commit, z=args.z, size=args.size, tile=args.tile, workers=args.workers)
+        print(f"{name:<28}{result['wall (s)']:>10.3f} s{result['peak memory (MB)']:>10.1f} MB"
+              f"{result['peak RSS (MB)']:>10.1f} MB RSS{result['files/s']:>12.1f} files/s")
+        if args.output:
+            with open(args.output, 'a') as f:
+                f.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Time upload planning and submission of a synthetic subject set directory
+against the in-process FakePanoptesBackend, without touching Zooniverse.
+
+    python benchmarks/bench_upload.py --n-images 500 --latency 0.05 --workers 8
+"""
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+from skimage.io import imsave
+from napari_zooniverse._backend import FakePanoptesBackend
+from napari_zooniverse._pipeline import iter_upload
+from napari_zooniverse._planner import plan_upload
+from napari_zooniverse._scheduler import RequestScheduler, ScheduledBackend
+from napari_zooniverse._utils import load_image_list
+
+
+def make_subject_set_dir(directory, n_images, shape=(256, 256), seed=0):
+    """Write `n_images` random JPEGs named like the tiling export."""
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    for z in range(n_images):
+        imsave(os.path.join(directory, f"img_x0000_y0000_z{z:04d}.jpeg"),
+               rng.integers(0, 256, shape, dtype=np.uint8), check_contrast=False)
+
+
+def run(n_images=200, shape=(256, 256), span=2, step=1, subject_set_size=50, n_workers=8,
+        latency=0.05, jitter=0.5, rate_limit=None, failure_rate=0.0, adaptive=True, cache_mb=256, seed=0):
+    """
+    :return: dict of timings and backend counters.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = os.path.join(tmp, 'image_x0000_y0000')
+        make_subject_set_dir(directory, n_images, shape, seed)
+        backend = FakePanoptesBackend(latency=latency, jitter=jitter, rate_limit=rate_limit,
+                                      failure_rate=failure_rate, seed=seed)
+        project = backend.find_project('benchmark')
+        scheduler = RequestScheduler(max_concurrency=n_workers) if adaptive else None
+        client = ScheduledBackend(backend, scheduler) if adaptive else backend
+
+        start_time = time.perf_counter()
+        plan_upload(len(load_image_list(directory)), span, step, subject_set_size)
+        planning_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        upload = iter_upload(project, directory, span, step, subject_set_size, n_workers=n_workers, backend=client,
+                             cache_bytes=int(cache_mb * 2 ** 20))
+        try:
+            while True:
+                n_done, n_subjects = next(upload)
+        except StopIteration as e:
+            n_sets, n_failed = e.value
+        upload_time = time.perf_counter() - start_time
+
+    return {
+        'subjects': n_subjects,
+        'subject sets': n_sets,
+        'failed subjects': n_failed,
+        'planning (s)': planning_time,
+        'upload (s)': upload_time,
+        'subjects/s': n_subjects / upload_time,
+        'requests': backend.n_requests,
+        'rate limited': backend.n_rate_limited,
+        'injected failures': backend.n_failed,
+        'MB sent': backend.bytes_received / 1e6,
+        'retries': scheduler.n_retries if adaptive else 0,
+        'final concurrency': scheduler.concurrency if adaptive else n_workers,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-images', type=int, default=200)
+    parser.add_argument('--size', type=int, default=256, help="edge length of each image in pixels")
+    parser.add_argument('--span', type=int, default=2)
+    parser.add_argument('--step', type=int, default=1)
+    parser.add_argument('--subject-set-size', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds per request")
+    parser.add_argument('--jitter', type=float, default=0.5)
+    parser.add_argument('--rate-limit', type=float, default=None, help="requests per second")
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--no-adaptive', dest='adaptive', action='store_false',
+                        help="call the backend directly, without retries or adaptive concurrency")
+    parser.add_argument('--cache-mb', type=float, default=256, help="media cache size, 0 to disable")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    results = run(n_images=args.n_images, shape=(args.size, args.size), span=args.span, step=args.step,
+                  subject_set_size=args.subject_set_size, n_workers=args.workers, latency=args.latency,
+                  jitter=args.jitter, rate_limit=args.rate_limit, failure_rate=args.failure_rate,
+                  adaptive=args.adaptive, cache_mb=args.cache_mb, seed=args.seed)
+    for key, value in results.items():
+        print(f"{key:>18}: {value:.3f}" if isinstance(value, float) else f"{key:>18}: {value}")
+
+
+if __name__ == '__main__':
+    main()
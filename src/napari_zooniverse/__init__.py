@@ -1,9 +1,27 @@
 __version__ = "0.0.1"
 
-from ._preprocess_widget import PreprocessWidget
-from ._upload_widget import UploadWidget
+from ._pipeline import open_volume, preprocess, iter_preprocess, merge, upload, iter_upload, plan_report, run_config
 
 __all__ = (
     "PreprocessWidget",
-    "UploadWidget"
+    "UploadWidget",
+    "open_volume",
+    "preprocess",
+    "iter_preprocess",
+    "merge",
+    "upload",
+    "iter_upload",
+    "plan_report",
+    "run_config",
 )
+
+
+def __getattr__(name):
+    # The widgets import Qt, which headless runs of the pipeline do without
+    if name == "PreprocessWidget":
+        from ._preprocess_widget import PreprocessWidget
+        return PreprocessWidget
+    if name == "UploadWidget":
+        from ._upload_widget import UploadWidget
+        return UploadWidget
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,283 @@
+import io
+import itertools
+import random
+import threading
+import time
+import requests
+from panoptes_client import Project, Panoptes, Subject, SubjectSet
+from panoptes_client.panoptes import PanoptesAPIException, PanoptesObject
+
+
+class ZooniverseAPIError(PanoptesAPIException):
+    """
+    PanoptesAPIException with the HTTP status code and headers of the
+    response that caused it, which panoptes_client does not keep.
+    """
+
+    def __init__(self, message, status_code=None, headers=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class PanoptesBackend:
+    """
+    Every call the plugin makes to Zooniverse, made through the live
+    `panoptes_client`. Swap in another object with the same methods to
+    upload somewhere else or to run without a network.
+
+    A subject is saved in two steps, see save_subject: creating it, which
+    is not idempotent, and uploading its media to the URLs Zooniverse
+    returns, which can be repeated safely.
+    """
+
+    def __init__(self):
+        self.client = None
+        self._local = threading.local()
+
+    def _keep_response(self, response, *args, **kwargs):
+        self._local.response = response
+
+    def _call(self, func, *args, **kwargs):
+        # Run a panoptes_client call with the connected client in this thread, raising
+        # its errors with the status code and headers of the last response
+        self._local.response = None
+        try:
+            if self.client is None:
+                return func(*args, **kwargs)
+            with self.client:
+                return func(*args, **kwargs)
+        except PanoptesAPIException as e:
+            if isinstance(e, ZooniverseAPIError):
+                raise
+            response = self._local.response
+            if response is None:
+                raise ZooniverseAPIError(str(e)) from e
+            raise ZooniverseAPIError(str(e), response.status_code, response.headers) from e
+
+    @property
+    def endpoint(self):
+        return (self.client or Panoptes.client()).endpoint
+
+    def connect(self, username, password):
+        self.client = Panoptes.connect(username=username, password=password)
+        self.client.session.hooks['response'].append(self._keep_response)
+        return self.client
+
+    def find_project(self, slug):
+        return self._call(Project.find, slug=slug)
+
+    def create_subject_set(self, project, display_name):
+        subject_set = SubjectSet()
+        subject_set.links.project = project
+        subject_set.display_name = display_name
+        self._call(subject_set.save)
+        return subject_set
+
+    def find_subject_set(self, subject_set_id):
+        return self._call(SubjectSet.find, subject_set_id)
+
+    def create_subject(self, project, locations, metadata):
+        """
+        Create a subject with a single request, without its media.
+
+        :param locations: image paths or JPEG bytes.
+        :return: the subject and the (url, data, media type) of every
+                 media upload still to be made with upload_media.
+        """
+        subject = Subject()
+        subject.links.project = project
+        for location in locations:
+            if isinstance(location, bytes):
+                subject.add_location(io.BytesIO(location), manual_mimetype='image/jpeg')
+            else:
+                subject.add_location(location)
+        subject.metadata.update(metadata)
+        subject.modified_attributes.add('metadata')
+        # PanoptesObject.save posts once; Subject.save would retry the post itself and upload the media
+        response = self._call(PanoptesObject.save, subject)
+        uploads = [(url, media_data, media_type)
+                   for location, media_data in zip(response['subjects'][0]['locations'], subject._media_files)
+                   if media_data
+                   for media_type, url in location.items()]
+        return subject, uploads
+
+    def upload_media(self, url, data, media_type):
+        response = requests.put(url, headers={'Content-Type': media_type, 'x-ms-blob-type': 'BlockBlob'},
+                                data=data)
+        response.raise_for_status()
+
+    def delete_subject(self, subject):
+        self._call(subject.delete)
+
+    def save_subject(self, project, locations, metadata):
+        """
+        :param locations: image paths or JPEG bytes.
+        """
+        return save_subject(self, project, locations, metadata)
+
+    def link_subjects(self, subject_set, subjects):
+        self._call(subject_set.add, subjects)
+
+
+def save_subject(backend, project, locations, metadata):
+    """
+    Create a subject and upload its media. The subject is created once,
+    creating it again would leave a duplicate on Zooniverse, while a
+    backend may retry the media uploads; a subject whose media cannot be
+    uploaded is deleted again.
+
+    :param backend: object with create_subject, upload_media and
+                    delete_subject methods.
+    :return: the subject.
+    """
+    subject, uploads = backend.create_subject(project, locations, metadata)
+    try:
+        for upload in uploads:
+            backend.upload_media(*upload)
+    except Exception:
+        try:
+            backend.delete_subject(subject)
+        except Exception as e:
+            print(f"Could not delete subject {subject.id} after its media failed to upload ({e})")
+        raise
+    return subject
+
+
+class FakeServerError(ZooniverseAPIError):
+    def __init__(self, message):
+        super().__init__(message, 500)
+
+
+class FakeRateLimitError(ZooniverseAPIError):
+    """Raised by FakePanoptesBackend when more requests are made than its rate limit allows."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Rate limit exceeded, retry after {retry_after:.2f} s", 429,
+                         {'Retry-After': f"{retry_after:.3f}"})
+
+
+class FakeObject:
+    def __init__(self, object_id, **attributes):
+        self.id = str(object_id)
+        self.__dict__.update(attributes)
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {self.id}>"
+
+
+class FakePanoptesBackend:
+    """
+    In-process stand-in for Zooniverse with the same methods as
+    PanoptesBackend. Nothing leaves the machine. Media are read like the
+    real client reads them so I/O is still measured, and every request
+    can be slowed down, throttled or failed at random.
+
+    :param latency: seconds each request takes.
+    :param jitter: extra random latency, as a fraction of `latency`.
+    :param rate_limit: requests per second accepted before requests
+                       fail with FakeRateLimitError, None for no limit.
+    :param failure_rate: probability a request fails with FakeServerError.
+    :param seed: seed for the injected jitter and failures.
+    """
+
+    endpoint = 'fake'
+
+    def __init__(self, latency=0.0, jitter=0.0, rate_limit=None, failure_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.failure_rate = failure_rate
+
+        self.subject_sets = {}
+        self.subjects = {}
+        self.links = {}
+        self.n_requests = 0
+        self.n_rate_limited = 0
+        self.n_failed = 0
+        self.bytes_received = 0
+
+        self._random = random.Random(seed)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._tokens = rate_limit
+        self._last_refill = time.monotonic()
+
+    def _request(self):
+        with self._lock:
+            self.n_requests += 1
+            if self.rate_limit is not None:
+                # Token bucket holding at most one second of requests
+                now = time.monotonic()
+                self._tokens = min(self.rate_limit, self._tokens + (now - self._last_refill) * self.rate_limit)
+                self._last_refill = now
+                if self._tokens < 1:
+                    self.n_rate_limited += 1
+                    raise FakeRateLimitError((1 - self._tokens) / self.rate_limit)
+                self._tokens -= 1
+            delay = self.latency * (1 + self.jitter * self._random.random())
+            failed = self._random.random() < self.failure_rate
+        time.sleep(delay)
+        if failed:
+            with self._lock:
+                self.n_failed += 1
+            raise FakeServerError("Injected server error")
+
+    def connect(self, username, password):
+        self._request()
+        return FakeObject('user', login=username)
+
+    def find_project(self, slug):
+        self._request()
+        return FakeObject(next(self._ids), slug=slug)
+
+    def create_subject_set(self, project, display_name):
+        self._request()
+        with self._lock:
+            if any(s.display_name == display_name and s.project is project for s in self.subject_sets.values()):
+                raise ZooniverseAPIError(f"Subject set {display_name} already exists", 422)
+            subject_set = FakeObject(next(self._ids), display_name=display_name, project=project)
+            self.subject_sets[subject_set.id] = subject_set
+            self.links[subject_set.id] = []
+        return subject_set
+
+    def find_subject_set(self, subject_set_id):
+        self._request()
+        if str(subject_set_id) not in self.subject_sets:
+            raise ZooniverseAPIError(f"Could not find subject_set with id='{subject_set_id}'", 404)
+        return self.subject_sets[str(subject_set_id)]
+
+    def create_subject(self, project, locations, metadata):
+        media = []
+        for location in locations:
+            if isinstance(location, str):
+                with open(location, 'rb') as f:
+                    media.append(f.read())
+            elif isinstance(location, bytes):
+                media.append(location)
+            else:
+                media.append(location.read())
+        self._request()
+        with self._lock:
+            subject = FakeObject(next(self._ids), project=project, metadata=dict(metadata), media=0)
+            self.subjects[subject.id] = subject
+        return subject, [(subject.id, data, 'image/jpeg') for data in media]
+
+    def upload_media(self, url, data, media_type):
+        self._request()
+        with self._lock:
+            self.subjects[url].media += 1
+            self.bytes_received += len(data)
+
+    def delete_subject(self, subject):
+        self._request()
+        with self._lock:
+            del self.subjects[subject.id]
+
+    def save_subject(self, project, locations, metadata):
+        return save_subject(self, project, locations, metadata)
+
+    def link_subjects(self, subject_set, subjects):
+        self._request()
+        with self._lock:
+            self.links[subject_set.id].extend(s.id if isinstance(s, FakeObject) else str(s) for s in subjects)
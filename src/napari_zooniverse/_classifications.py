@@ -0,0 +1,702 @@
+import csv
+import json
+import os
+import re
+import sys
+import threading
+from datetime import datetime
+import numpy as np
+from ._export import tile_origin
+
+# Classification export fields can hold large JSON documents
+csv.field_size_limit(min(sys.maxsize, 2 ** 31 - 1))
+
+# File names of subject images, as build_subject records them in the `Image <frame>` metadata
+_SUBJECT_IMAGE = re.compile(r'([^/_]+)_x(\d+)_y(\d+)_z(\d+)\.jpe?g$', re.IGNORECASE)
+
+# Columns of each table of a ClassificationStore. Strings are stored as
+# int32 codes into the store's `strings`, -1 where missing.
+#   classifications: one row per classification
+#   answers:         one row per answer of a question task
+#   marks:           one row per point or polygon of a drawing task, with
+#                    the position of a point, NaN for a polygon
+#   vertices:        one row per vertex of a polygon mark, in drawing order
+#   subjects:        one row per subject, the first time it is seen, with
+#                    the volume (row, col) of its tile's first pixel and
+#                    the z of its frames, z_first + frame * z_step; -1
+#                    where its image names do not follow the export naming,
+#                    and the scale its images were uploaded at
+TABLES = {
+    'classifications': {'classification_id': np.int64, 'user': np.int32, 'workflow_id': np.int64,
+                        'workflow_version': np.int32, 'created_at': 'datetime64[s]', 'subject_id': np.int64,
+                        'duration': np.float32},
+    'answers': {'classification': np.int64, 'task': np.int32, 'answer': np.int32},
+    'marks': {'classification': np.int64, 'task': np.int32, 'tool': np.int32, 'frame': np.int32,
+              'x': np.float32, 'y': np.float32, 'n_vertices': np.int32},
+    'vertices': {'mark': np.int64, 'x': np.float32, 'y': np.float32},
+    'subjects': {'subject_id': np.int64, 'centre_image': np.int32, 'row': np.int64, 'col': np.int64,
+                 'z_first': np.int64, 'z_step': np.int64, 'n_frames': np.int32, 'default_frame': np.int32,
+                 'scale': np.float32},
+}
+
+
+def _time(value):
+    # Exports write times as '2023-01-31 12:00:00 UTC', metadata as ISO 8601
+    try:
+        return datetime.fromisoformat(value.replace(' UTC', '').replace('Z', '+00:00')[:19])
+    except (AttributeError, ValueError):
+        return None
+
+
+class ClassificationStore:
+    """
+    Compact columnar store of a Zooniverse classification export. The
+    JSON columns are parsed into flat NumPy columns, one table per kind
+    of row (see TABLES), and repeated strings are interned as codes.
+    Rows are appended a chunk at a time to one growable array per
+    column; with a `spill_dir` each column is instead a file on disk
+    that chunks are appended to as they arrive and that is read through
+    a memory map, so memory stays bounded by the chunk size. Rows can be
+    read from another thread while chunks are appended: a chunk is only
+    counted in `n_rows` once it is completely written.
+
+    :param spill_dir: directory to spill columns to, None to keep them in memory.
+    """
+
+    def __init__(self, spill_dir=None):
+        self.spill_dir = spill_dir
+        self.strings = []
+        self._codes = {}
+        self._arrays = {table: {name: np.empty(0, dtype=dtype) for name, dtype in dtypes.items()}
+                        for table, dtypes in TABLES.items()}
+        self._maps = {}
+        self._lock = threading.Lock()
+        self.n_rows = {table: 0 for table in TABLES}
+        self._seen_subjects = set()
+        self._users = set()
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+            for table, dtypes in TABLES.items():
+                for name in dtypes:
+                    open(self._path(table, name), 'wb').close()
+
+    def _path(self, table, name):
+        return os.path.join(self.spill_dir, f"{table}.{name}.bin")
+
+    def code(self, string):
+        """
+        :return: int code of `string`, interning it if it is new; -1 for None.
+        """
+        if string is None:
+            return -1
+        code = self._codes.get(string)
+        if code is None:
+            code = self._codes[string] = len(self.strings)
+            self.strings.append(string)
+        return code
+
+    def append(self, table, columns):
+        """
+        Append a chunk of rows to `table`.
+
+        :param columns: dict of column name to list or array of values.
+        """
+        chunk = {name: np.asarray(columns[name], dtype=dtype) for name, dtype in TABLES[table].items()}
+        n = len(next(iter(chunk.values())))
+        if n == 0:
+            return
+        with self._lock:
+            self._append(table, chunk, n)
+
+    def _append(self, table, chunk, n):
+        start = self.n_rows[table]
+        for name, values in chunk.items():
+            if self.spill_dir is not None:
+                with open(self._path(table, name), 'ab') as f:
+                    f.write(values.tobytes())
+                continue
+            array = self._arrays[table][name]
+            if start + n > len(array):
+                # Grow geometrically; views handed out earlier keep the old array
+                grown = np.empty(max(2 * len(array), start + n, 1024), dtype=array.dtype)
+                grown[:start] = array[:start]
+                array = self._arrays[table][name] = grown
+            array[start:start + n] = values
+        # Published last, so readers never count rows that are not written yet
+        self.n_rows[table] = start + n
+
+    def column(self, table, name):
+        """
+        :return: every row loaded so far of one column of `table`, a view
+                 of the column, or a memory map of it with a `spill_dir`.
+        """
+        with self._lock:
+            n = self.n_rows[table]
+            if self.spill_dir is None:
+                return self._arrays[table][name][:n]
+            if n == 0:
+                return self._arrays[table][name]
+            mapped = self._maps.get((table, name))
+            if mapped is None or len(mapped) != n:
+                mapped = self._maps[table, name] = np.memmap(self._path(table, name), dtype=TABLES[table][name],
+                                                             mode='r', shape=(n,))
+            return mapped
+
+    def decode(self, codes):
+        """
+        :return: object array of the strings of `codes`, None where missing.
+        """
+        strings = np.array(self.strings + [None], dtype=object)
+        return strings[np.asarray(codes)]
+
+    def close(self):
+        """
+        Write the strings of a spilled store next to its columns.
+        """
+        if self.spill_dir is None:
+            return
+        with open(os.path.join(self.spill_dir, 'strings.json'), 'w') as f:
+            json.dump(self.strings, f)
+
+    def summary(self):
+        """
+        :return: one line summary of what has been loaded.
+        """
+        return (f"{self.n_rows['classifications']} classifications of {self.n_rows['subjects']} subjects "
+                f"by {len(self._users)} volunteers, {self.n_rows['answers']} answers, {self.n_rows['marks']} marks")
+
+
+def _parse_rows(store, rows):
+    classifications = {name: [] for name in TABLES['classifications']}
+    answers = {name: [] for name in TABLES['answers']}
+    marks = {name: [] for name in TABLES['marks']}
+    vertices = {name: [] for name in TABLES['vertices']}
+    subjects = {name: [] for name in TABLES['subjects']}
+    first_mark = store.n_rows['marks']
+
+    for i, row in enumerate(rows, start=store.n_rows['classifications']):
+        metadata = json.loads(row.get('metadata') or '{}')
+        started, finished = _time(metadata.get('started_at')), _time(metadata.get('finished_at'))
+        subject_id = int(row['subject_ids'].split(';')[0]) if row.get('subject_ids') else -1
+        created_at = _time(row.get('created_at'))
+        classifications['classification_id'].append(int(row['classification_id']))
+        user = store.code(row.get('user_name') or None)
+        store._users.add(user)
+        classifications['user'].append(user)
+        classifications['workflow_id'].append(int(row.get('workflow_id') or -1))
+        classifications['workflow_version'].append(store.code(row.get('workflow_version') or None))
+        classifications['created_at'].append(np.datetime64(created_at, 's') if created_at else np.datetime64('NaT'))
+        classifications['subject_id'].append(subject_id)
+        classifications['duration'].append((finished - started).total_seconds() if started and finished
+                                           else np.nan)
+
+        for annotation in json.loads(row.get('annotations') or '[]'):
+            task = store.code(annotation.get('task'))
+            values = annotation.get('value')
+            if not isinstance(values, list):
+                values = [values]
+            for value in values:
+                if isinstance(value, dict) and ('x' in value or 'points' in value):
+                    points = value.get('points') or []
+                    for point in points:
+                        vertices['mark'].append(first_mark + len(marks['classification']))
+                        vertices['x'].append(point.get('x') if point.get('x') is not None else np.nan)
+                        vertices['y'].append(point.get('y') if point.get('y') is not None else np.nan)
+                    marks['classification'].append(i)
+                    marks['task'].append(task)
+                    marks['tool'].append(value.get('tool') if isinstance(value.get('tool'), int) else -1)
+                    marks['frame'].append(value.get('frame') or 0)
+                    marks['x'].append(value.get('x') if value.get('x') is not None else np.nan)
+                    marks['y'].append(value.get('y') if value.get('y') is not None else np.nan)
+                    marks['n_vertices'].append(len(points))
+                elif not isinstance(value, dict):
+                    answers['classification'].append(i)
+                    answers['task'].append(task)
+                    answers['answer'].append(store.code(None if value is None else str(value)))
+
+        if subject_id not in store._seen_subjects and row.get('subject_data'):
+            store._seen_subjects.add(subject_id)
+            subject = json.loads(row['subject_data']).get(str(subject_id), {})
+            default_frame = int(subject.get('default_frame') or 1)
+            images = []
+            while f"Image {len(images)}" in subject:
+                images.append(subject[f"Image {len(images)}"])
+            matches = [_SUBJECT_IMAGE.search(str(image)) for image in images]
+            if matches and all(matches):
+                prefix, x, y = matches[0].group(1), int(matches[0].group(2)), int(matches[0].group(3))
+                origin = tile_origin(prefix, x, y)
+                z = [int(match.group(4)) for match in matches]
+                z_step = z[1] - z[0] if len(z) > 1 else 0
+            else:
+                origin, z, z_step = (-1, -1), [-1], 0
+            # The image volunteers annotate, 'Image <default_frame - 1>' of the uploaded metadata
+            subjects['subject_id'].append(subject_id)
+            subjects['centre_image'].append(store.code(subject.get(f"Image {default_frame - 1}")))
+            subjects['row'].append(origin[0])
+            subjects['col'].append(origin[1])
+            subjects['z_first'].append(z[0])
+            subjects['z_step'].append(z_step)
+            subjects['n_frames'].append(len(images))
+            subjects['default_frame'].append(default_frame)
+            subjects['scale'].append(float(subject.get('Upload scale') or 1.0))
+
+    store.append('classifications', classifications)
+    store.append('answers', answers)
+    store.append('marks', marks)
+    store.append('vertices', vertices)
+    store.append('subjects', subjects)
+
+
+def _counted_lines(f, position):
+    for line in f:
+        position[0] += len(line)
+        yield line.decode('utf-8')
+
+
+def iter_load_classifications(path, chunk_size=10000, spill_dir=None, store=None):
+    """
+    Stream a Zooniverse classification export into a
+    ClassificationStore, `chunk_size` rows at a time, without holding
+    more than one chunk of the file in memory. Loading a newer export
+    into the store of an older one only adds the classifications the
+    store does not have yet.
+
+    :param path: classification export CSV.
+    :param chunk_size: number of rows parsed at a time.
+    :param spill_dir: directory to spill the store to, see ClassificationStore.
+    :param store: ClassificationStore to load into, so its rows can be
+                  read before the file is loaded; a new one by default.
+    :return: yields (bytes read, file size) after every chunk; returns
+             the store.
+    """
+    store = store if store is not None else ClassificationStore(spill_dir)
+    known = np.sort(store.column('classifications', 'classification_id'))
+    total = os.path.getsize(path)
+    position = [0]
+    n_skipped = 0
+    with open(path, 'rb') as f:
+        reader = csv.DictReader(_counted_lines(f, position))
+        while True:
+            rows = [row for _, row in zip(range(chunk_size), reader)]
+            if not rows:
+                break
+            if len(known):
+                ids = np.array([int(row['classification_id']) for row in rows], dtype=np.int64)
+                found = known[np.minimum(np.searchsorted(known, ids), len(known) - 1)] == ids
+                rows = [row for row, old in zip(rows, found) if not old]
+                n_skipped += int(found.sum())
+            _parse_rows(store, rows)
+            yield position[0], total
+    store.close()
+    print(f"Loaded {path}: {store.summary()}" + (f", {n_skipped} already loaded" if n_skipped else ""))
+    return store
+
+
+def iter_load_consensus(path, store, consensus, chunk_size=10000):
+    """
+    Load a classification export into `store` with
+    iter_load_classifications, aggregating every chunk into `consensus`
+    as soon as it is loaded, e.g. on a worker thread.
+
+    :param path: classification export CSV.
+    :param store: ClassificationStore to load into.
+    :param consensus: Consensus to aggregate into.
+    :param chunk_size: number of rows parsed at a time.
+    :return: yields (bytes read, file size, summary of the store) after
+             every chunk; returns a summary of the store and consensus.
+    """
+    for position, total in iter_load_classifications(path, chunk_size, store=store):
+        consensus.update(store)
+        yield position, total, store.summary()
+    consensus.update(store)
+    labels = consensus.labels()
+    n_agreed = int((labels['agreement'] > 0.5).sum())
+    return (f"{store.summary()}\n{n_agreed} of {len(labels['agreement'])} subject questions "
+            f"with a majority answer")
+
+
+def load_classifications(*args, **kwargs):
+    """
+    Run iter_load_classifications to completion.
+
+    :return: ClassificationStore.
+    """
+    load = iter_load_classifications(*args, **kwargs)
+    while True:
+        try:
+            next(load)
+        except StopIteration as e:
+            return e.value
+
+
+# Number of vertices every polygon is resampled to before polygons are averaged
+POLYGON_VERTICES = 32
+# Key columns of the point and polygon sums of a Consensus
+MARK_KEYS = ('subject_id', 'task', 'tool', 'frame', 'cell_y', 'cell_x')
+
+
+def _group_sum(keys, values):
+    """
+    :param keys: (n, k) int64 array of group keys.
+    :param values: (n, m) float64 array of values.
+    :return: sorted unique keys and the values summed per key.
+    """
+    if len(keys) == 0:
+        return keys, values
+    unique, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    sums = np.empty((len(unique), values.shape[1]))
+    for j in range(values.shape[1]):
+        sums[:, j] = np.bincount(inverse, weights=values[:, j], minlength=len(unique))
+    return unique, sums
+
+
+def _group_count(keys, members):
+    """
+    :param keys: (n, k) int64 array of group keys.
+    :param members: (n,) ids of what each row belongs to, e.g. a classification.
+    :return: sorted unique keys and the number of distinct members per key.
+    """
+    pairs = np.unique(np.column_stack([keys, members]), axis=0)
+    return _group_sum(pairs[:, :-1], np.ones((len(pairs), 1)))
+
+
+def _first_of_groups(keys):
+    """
+    :param keys: (n, k) array of keys, sorted.
+    :return: index of the first row of every run of equal keys.
+    """
+    if len(keys) == 0:
+        return np.empty(0, dtype=np.int64)
+    return np.flatnonzero(np.concatenate([[True], np.any(keys[1:] != keys[:-1], axis=1)]))
+
+
+def _connected_components(n, first, second):
+    """
+    :param n: number of nodes.
+    :param first: (m,) first node of every edge.
+    :param second: (m,) second node of every edge.
+    :return: (n,) smallest node of the connected component of every node.
+    """
+    labels = np.arange(n)
+    while True:
+        # Propagate the smallest label across every edge, then jump to the label's own label
+        low = np.minimum(labels[first], labels[second])
+        updated = labels.copy()
+        np.minimum.at(updated, first, low)
+        np.minimum.at(updated, second, low)
+        updated = updated[updated]
+        if np.array_equal(updated, labels):
+            return labels
+        labels = updated
+
+
+def resample_polygons(mark, x, y, n_vertices=POLYGON_VERTICES):
+    """
+    Resample polygons to `n_vertices` vertices equally spaced along their
+    outline, all wound the same way and starting from the vertex at the
+    smallest angle about their centroid, so polygons drawn from different
+    starting points and in either direction can be averaged vertex by
+    vertex.
+
+    :param mark: (n,) mark of every vertex, sorted.
+    :param x: (n,) x of every vertex.
+    :param y: (n,) y of every vertex.
+    :param n_vertices: number of vertices of the resampled polygons.
+    :return: the marks and a (marks, n_vertices, 2) array of their (y, x) vertices.
+    """
+    marks, start, counts = np.unique(mark, return_index=True, return_counts=True)
+    last = start + counts - 1
+    # Every vertex is joined to the next one of its polygon, the last one back to the first
+    following = np.arange(1, len(mark) + 1)
+    following[last] = start
+    length = np.hypot(x[following] - x, y[following] - y)
+    position = np.cumsum(length) - length
+    perimeter = np.add.reduceat(length, start) if len(mark) else length
+
+    targets = position[start, None] + perimeter[:, None] * np.arange(n_vertices) / n_vertices
+    edge = np.searchsorted(position, targets.ravel(), side='right') - 1
+    edge = np.clip(edge, np.repeat(start, n_vertices), np.repeat(last, n_vertices))
+    fraction = (targets.ravel() - position[edge]) / np.where(length[edge] > 0, length[edge], 1)
+    resampled = np.stack([y[edge] + fraction * (y[following[edge]] - y[edge]),
+                          x[edge] + fraction * (x[following[edge]] - x[edge])], axis=-1)
+    resampled = resampled.reshape(len(marks), n_vertices, 2)
+
+    # Shoelace signed area, reversed where negative
+    ry, rx = resampled[..., 0], resampled[..., 1]
+    area = np.sum(rx * np.roll(ry, -1, axis=1) - np.roll(rx, -1, axis=1) * ry, axis=1)
+    resampled[area < 0] = resampled[area < 0, ::-1]
+
+    centroid = resampled.mean(axis=1, keepdims=True)
+    angle = np.mod(np.arctan2(resampled[..., 0] - centroid[..., 0], resampled[..., 1] - centroid[..., 1]),
+                   2 * np.pi)
+    order = (np.argmin(angle, axis=1)[:, None] + np.arange(n_vertices)) % n_vertices
+    return marks, np.take_along_axis(resampled, order[..., None], axis=1)
+
+
+class Consensus:
+    """
+    Per-subject consensus of the classifications in a
+    ClassificationStore: the majority answer of every question task and
+    the averaged points and polygons of every drawing task, each with
+    the fraction of volunteers who agree with it.
+
+    Marks are grouped by subject, task, tool and frame, then clustered
+    on a grid of `cell_size` pixels, marks (or polygon centroids) in the
+    same cell being taken to be of the same feature. Only sums and
+    counts are kept per group, so `update` aggregates the rows loaded
+    since the last update, e.g. a newer export loaded into the same
+    store, without revisiting the others. The groups of an update are
+    folded into the totals once they are as many as the totals, or
+    when results are asked for, so loading a file a chunk at a time
+    does not regroup everything after every chunk. Results can be asked
+    for while another thread updates, and cover the rows aggregated so
+    far.
+
+    :param cell_size: edge length in pixels of the clustering grid.
+    :param workflow_id: only aggregate classifications of this workflow.
+    :param n_vertices: number of vertices of the averaged polygons.
+    """
+
+    def __init__(self, cell_size=20, workflow_id=None, n_vertices=POLYGON_VERTICES):
+        self.cell_size = cell_size
+        self.workflow_id = workflow_id
+        self.n_vertices = n_vertices
+        empty = np.empty((0, len(MARK_KEYS)), dtype=np.int64)
+        # Group keys and summed values of every statistic
+        self._stats = {
+            'subjects': (np.empty((0, 1), dtype=np.int64), np.empty((0, 1))),
+            'answers': (np.empty((0, 3), dtype=np.int64), np.empty((0, 1))),
+            'points': (empty, np.empty((0, 4))),
+            'polygons': (empty, np.empty((0, 2 * n_vertices + 2))),
+        }
+        self._pending = {name: [] for name in self._stats}
+        self._default_frame = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32))
+        self._done = {table: 0 for table in TABLES}
+        self.strings = []
+        self._lock = threading.RLock()
+
+    def _merge(self, name, keys, values):
+        pending = self._pending[name]
+        pending.append((keys, values))
+        if sum(len(k) for k, _ in pending) >= len(self._stats[name][0]):
+            self._stat(name)
+
+    def _stat(self, name):
+        """
+        :return: group keys and summed values of a statistic, with every
+                 pending update folded in.
+        """
+        pending = self._pending[name]
+        if pending:
+            keys, values = self._stats[name]
+            self._stats[name] = _group_sum(np.concatenate([keys] + [k for k, _ in pending]),
+                                           np.concatenate([values] + [v for _, v in pending]))
+            pending.clear()
+        return self._stats[name]
+
+    def _cells(self, y, x):
+        # Polygon marks have no position of their own, their NaN is filtered out by the caller
+        y, x = np.nan_to_num(y), np.nan_to_num(x)
+        return np.floor(y / self.cell_size).astype(np.int64), np.floor(x / self.cell_size).astype(np.int64)
+
+    def update(self, store):
+        """
+        Aggregate the rows of `store` added since the last update. Safe to
+        call while the store is still loading.
+
+        :param store: ClassificationStore.
+        """
+        with self._lock:
+            self._update(store)
+
+    def _update(self, store):
+        # Row counts are read in the order rows are appended, so every
+        # row counted refers only to rows also counted
+        n_rows = {table: store.n_rows[table] for table in TABLES}
+        done = self._done
+        self.strings = store.strings
+
+        classification_subject = store.column('classifications', 'subject_id')
+        keep = np.ones(len(classification_subject), dtype=bool)
+        if self.workflow_id is not None:
+            keep = store.column('classifications', 'workflow_id') == self.workflow_id
+
+        # CLASSIFICATIONS PER SUBJECT
+        rows = np.arange(done['classifications'], n_rows['classifications'])
+        rows = rows[keep[rows]]
+        self._merge('subjects', classification_subject[rows, None], np.ones((len(rows), 1)))
+
+        # SUBJECT DEFAULT FRAMES
+        subject_ids = store.column('subjects', 'subject_id')[done['subjects']:n_rows['subjects']]
+        default_frames = store.column('subjects', 'default_frame')[done['subjects']:n_rows['subjects']]
+        ids = np.concatenate([self._default_frame[0], subject_ids])
+        ids, first = np.unique(ids, return_index=True)
+        self._default_frame = (ids, np.concatenate([self._default_frame[1], default_frames])[first])
+
+        # ANSWERS
+        sl = slice(done['answers'], n_rows['answers'])
+        classification = store.column('answers', 'classification')[sl]
+        selected = keep[classification]
+        keys = np.column_stack([classification_subject[classification],
+                                store.column('answers', 'task')[sl],
+                                store.column('answers', 'answer')[sl]])[selected]
+        self._merge('answers', keys, np.ones((len(keys), 1)))
+
+        # POINTS
+        sl = slice(done['marks'], n_rows['marks'])
+        classification = store.column('marks', 'classification')[sl]
+        n_vertices = store.column('marks', 'n_vertices')[sl]
+        y, x = store.column('marks', 'y')[sl].astype(np.float64), store.column('marks', 'x')[sl].astype(np.float64)
+        selected = keep[classification] & (n_vertices == 0) & np.isfinite(x) & np.isfinite(y)
+        keys = np.column_stack([classification_subject[classification], store.column('marks', 'task')[sl],
+                                store.column('marks', 'tool')[sl], store.column('marks', 'frame')[sl],
+                                *self._cells(y, x)])
+        if selected.any():
+            unique, sums = _group_sum(keys[selected], np.column_stack([y, x, np.ones(len(y))])[selected])
+            _, n_classifications = _group_count(keys[selected], classification[selected])
+            self._merge('points', unique, np.hstack([sums, n_classifications]))
+
+        # POLYGONS
+        vertex_mark = store.column('vertices', 'mark')[done['vertices']:n_rows['vertices']]
+        # Vertices of marks appended after the marks were counted wait for the next update
+        n_vertex_rows = int(np.searchsorted(vertex_mark, n_rows['marks']))
+        vertex_sl = slice(done['vertices'], done['vertices'] + n_vertex_rows)
+        vertex_mark = vertex_mark[:n_vertex_rows]
+        polygon_rows = np.flatnonzero(keep[classification] & (n_vertices >= 3))
+        in_polygon = np.isin(vertex_mark - done['marks'], polygon_rows)
+        if in_polygon.any():
+            marks, vertices = resample_polygons(vertex_mark[in_polygon],
+                                                store.column('vertices', 'x')[vertex_sl][in_polygon].astype(float),
+                                                store.column('vertices', 'y')[vertex_sl][in_polygon].astype(float),
+                                                self.n_vertices)
+            finite = np.all(np.isfinite(vertices), axis=(1, 2))
+            marks, vertices = marks[finite], vertices[finite]
+            rows = marks - done['marks']
+            centroid = vertices.mean(axis=1)
+            polygon_keys = np.column_stack([keys[rows, :4], *self._cells(centroid[:, 0], centroid[:, 1])])
+            unique, sums = _group_sum(polygon_keys, np.column_stack([vertices.reshape(len(vertices), -1),
+                                                                     np.ones(len(vertices))]))
+            _, n_classifications = _group_count(polygon_keys, classification[rows])
+            self._merge('polygons', unique, np.hstack([sums, n_classifications]))
+
+        done.update(n_rows)
+        done['vertices'] = vertex_sl.stop
+
+    def _n_classifications(self, subject_id):
+        subjects, counts = self._stat('subjects')
+        if len(subjects) == 0:
+            return np.zeros(len(subject_id))
+        index = np.clip(np.searchsorted(subjects[:, 0], subject_id), 0, len(subjects) - 1)
+        return np.where(subjects[index, 0] == subject_id, counts[index, 0], 0)
+
+    def _is_default_frame(self, subject_id, frame):
+        ids, default_frames = self._default_frame
+        if len(ids) == 0:
+            return np.zeros(len(subject_id), dtype=bool)
+        index = np.clip(np.searchsorted(ids, subject_id), 0, len(ids) - 1)
+        return (ids[index] == subject_id) & (default_frames[index] - 1 == frame)
+
+    def labels(self):
+        """
+        :return: dict of columns, one row per subject and question task:
+                 subject_id, task, answer (the majority answer), votes,
+                 total (answers given) and agreement (votes / total).
+        """
+        with self._lock:
+            keys, votes = self._stat('answers')
+            strings = np.array(self.strings + [None], dtype=object)
+        votes = votes[:, 0]
+        # Most voted answer first within every subject and task
+        order = np.lexsort((-votes, keys[:, 1], keys[:, 0]))
+        keys, votes = keys[order], votes[order]
+        first = _first_of_groups(keys[:, :2])
+        total = np.add.reduceat(votes, first) if len(first) else votes
+        return {'subject_id': keys[first, 0], 'task': strings[keys[first, 1]],
+                'answer': strings[keys[first, 2]], 'votes': votes[first].astype(np.int64),
+                'total': total.astype(np.int64), 'agreement': votes[first] / np.maximum(total, 1)}
+
+    def _merge_cells(self, keys, sums, means):
+        """
+        Join the groups of neighbouring grid cells whose mean positions
+        are within a cell of each other, so a feature whose marks fall
+        either side of a cell boundary is one feature.
+
+        :param keys: (n, 6) sorted group keys, see MARK_KEYS.
+        :param sums: (n, m) summed values of every group.
+        :param means: (n, 2) mean (y, x) of every group.
+        :return: keys and sums of the joined groups.
+        """
+        if len(keys) == 0:
+            return keys, sums
+        neighbours = np.concatenate([keys + [0, 0, 0, 0, dy, dx] for dy, dx in ((0, 1), (1, -1), (1, 0), (1, 1))])
+        _, inverse = np.unique(np.concatenate([keys, neighbours]), axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        position = np.full(inverse.max() + 1, -1)
+        position[inverse[:len(keys)]] = np.arange(len(keys))
+        found = position[inverse[len(keys):]]
+        group = np.tile(np.arange(len(keys)), 4)
+        joined = found >= 0
+        group, found = group[joined], found[joined]
+        near = np.hypot(*(means[group] - means[found]).T) <= self.cell_size
+        labels = _connected_components(len(keys), group[near], found[near])
+        label_keys, label_sums = _group_sum(labels[:, None], sums)
+        _, first = np.unique(labels, return_index=True)
+        return keys[first], label_sums
+
+    def _select(self, name, subject_id, default_frame_only, min_agreement):
+        with self._lock:
+            return self._select_locked(name, subject_id, default_frame_only, min_agreement)
+
+    def _select_locked(self, name, subject_id, default_frame_only, min_agreement):
+        keys, sums = self._stat(name)
+        if name == 'points':
+            means = sums[:, :2] / sums[:, 2:3]
+        else:
+            means = sums[:, :-2].reshape(len(sums), -1, 2).mean(axis=1) / sums[:, -2:-1]
+        keys, sums = self._merge_cells(keys, sums, means)
+        # A volunteer with marks in two cells of one feature is counted twice
+        agreement = np.minimum(sums[:, -1] / np.maximum(self._n_classifications(keys[:, 0]), 1), 1)
+        selected = agreement >= min_agreement
+        if subject_id is not None:
+            selected &= keys[:, 0] == subject_id
+        if default_frame_only:
+            selected &= self._is_default_frame(keys[:, 0], keys[:, 3])
+        strings = np.array(self.strings + [None], dtype=object)
+        features = {'subject_id': keys[selected, 0], 'task': strings[keys[selected, 1]],
+                    'tool': keys[selected, 2], 'agreement': agreement[selected],
+                    'n_classifications': sums[selected, -1].astype(np.int64)}
+        return keys[selected], sums[selected], features
+
+    def points(self, subject_id=None, default_frame_only=False, min_agreement=0.0):
+        """
+        Averaged points, in the coordinates of the subject images.
+
+        :param subject_id: only the points of this subject.
+        :param default_frame_only: only points of the frame volunteers
+                                   were asked to annotate.
+        :param min_agreement: smallest fraction of a subject's volunteers
+                              who marked a point.
+        :return: (n, 3) array of (frame, y, x) and dict of feature
+                 columns, for a napari Points layer.
+        """
+        keys, sums, features = self._select('points', subject_id, default_frame_only, min_agreement)
+        data = np.column_stack([keys[:, 3], sums[:, 0] / sums[:, 2], sums[:, 1] / sums[:, 2]])
+        return data, features
+
+    def polygons(self, subject_id=None, default_frame_only=False, min_agreement=0.0):
+        """
+        Averaged polygons, in the coordinates of the subject images.
+
+        :param subject_id: only the polygons of this subject.
+        :param default_frame_only: only polygons of the frame volunteers
+                                   were asked to annotate.
+        :param min_agreement: smallest fraction of a subject's volunteers
+                              who drew a polygon.
+        :return: (n, n_vertices, 3) array of (frame, y, x) vertices and
+                 dict of feature columns, for a napari Shapes layer.
+        """
+        keys, sums, features = self._select('polygons', subject_id, default_frame_only, min_agreement)
+        vertices = sums[:, :-2].reshape(len(sums), self.n_vertices, 2) / sums[:, -2, None, None]
+        frame = np.broadcast_to(keys[:, 3, None, None], (len(keys), self.n_vertices, 1))
+        return np.concatenate([frame, vertices], axis=-1), features
@@ -0,0 +1,131 @@
+"""
+Command line front end to the pipeline for machines without a display.
+
+    napari-zooniverse run job.yaml
+    napari-zooniverse preprocess volume.npy export --tiles 4 4
+    napari-zooniverse preprocess volume.npy export --tiles 4 4 --shard $SLURM_ARRAY_TASK_ID 8
+    napari-zooniverse merge export
+    napari-zooniverse dry-run export/subject_sets/image_x0000_y0000
+    ZOONIVERSE_PASSWORD=... napari-zooniverse upload DIRECTORY --username user --project user/project
+"""
+import argparse
+import json
+import os
+import sys
+from ._pipeline import open_volume, preprocess, merge, upload, plan_report, run_config
+
+
+def load_config(path):
+    """
+    :return: dict of a YAML or JSON config file.
+    """
+    with open(path) as f:
+        if path.endswith('.json'):
+            return json.load(f)
+        import yaml
+        return yaml.safe_load(f)
+
+
+def _add_upload_arguments(parser):
+    parser.add_argument('--span', type=int, default=2, help="images either side of the centre image")
+    parser.add_argument('--step', type=int, default=10, help="distance in images between the images of a subject")
+    parser.add_argument('--subject-set-size', type=int, default=5, help="subjects per subject set")
+    parser.add_argument('--max-image-kb', type=float, help="re-encode images to at most this many kB for upload")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='napari-zooniverse', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help="run the preprocess and upload sections of a config file")
+    run_parser.add_argument('config', help="YAML or JSON config file")
+
+    preprocess_parser = commands.add_parser('preprocess', help="export a volume as subject set directories")
+    preprocess_parser.add_argument('image', help=".npy, .raw, .tif or .zarr volume")
+    preprocess_parser.add_argument('output', help="directory to write subject_sets to")
+    preprocess_parser.add_argument('--key', help="array inside a zarr group")
+    preprocess_parser.add_argument('--shape', type=int, nargs=3, metavar=('Z', 'Y', 'X'), help="shape of a raw volume")
+    preprocess_parser.add_argument('--dtype', help="dtype of a raw volume")
+    preprocess_parser.add_argument('--tiles', type=int, nargs=2, metavar=('X', 'Y'), help="number of tiles")
+    preprocess_parser.add_argument('--roi', type=int, nargs=4, action='append', dest='rois',
+                                   metavar=('MIN_ROW', 'MIN_COL', 'MAX_ROW', 'MAX_COL'), help="ROI to export")
+    preprocess_parser.add_argument('--slab-size', type=int, default=16, help="z slices read at once")
+    preprocess_parser.add_argument('--workers', type=int, default=min(os.cpu_count() or 1, 8),
+                                   help="images encoded at once")
+    preprocess_parser.add_argument('--format', choices=('jpeg', 'zarr'), default='jpeg', dest='output_format',
+                                   help="JPEG files, or an OME-Zarr store encoded to JPEG when uploading")
+    preprocess_parser.add_argument('--min-std', type=float,
+                                   help="skip tiles whose intensity standard deviation is lower")
+    preprocess_parser.add_argument('--background', type=float, help="background intensity, e.g. of resin")
+    preprocess_parser.add_argument('--tolerance', type=float, default=10.0,
+                                   help="intensity difference from the background counted as foreground")
+    preprocess_parser.add_argument('--min-foreground', type=float,
+                                   help="skip tiles with a lower fraction of foreground pixels, needs --background")
+    preprocess_parser.add_argument('--shard', type=int, nargs=2, metavar=('INDEX', 'COUNT'),
+                                   help="export only this shard of the work, merge once every shard has finished")
+    preprocess_parser.add_argument('--z-range', type=int, nargs=2, metavar=('START', 'STOP'),
+                                   help="export only these z slices")
+    preprocess_parser.add_argument('--tile-indices', type=int, nargs='+', metavar='INDEX',
+                                   help="export only these tiles")
+    preprocess_parser.add_argument('--force', action='store_true',
+                                   help="write every image again, even if it is up to date")
+
+    merge_parser = commands.add_parser('merge', help="merge the partial manifests of a sharded export")
+    merge_parser.add_argument('output', help="directory the shards wrote subject_sets to")
+
+    dry_run_parser = commands.add_parser('dry-run', help="plan the upload of a subject set directory")
+    dry_run_parser.add_argument('directory')
+    _add_upload_arguments(dry_run_parser)
+
+    upload_parser = commands.add_parser('upload', help="upload a subject set directory to Zooniverse")
+    upload_parser.add_argument('directory')
+    upload_parser.add_argument('--username', required=True)
+    upload_parser.add_argument('--project', required=True, help="project slug")
+    upload_parser.add_argument('--workers', type=int, default=16, help="subjects uploaded at once")
+    upload_parser.add_argument('--cache-mb', type=float, default=256,
+                               help="MB of images kept for overlapping subjects, 0 to disable")
+    upload_parser.add_argument('--no-downscale', dest='downscale', action='store_false',
+                               help="only lower the JPEG quality to fit --max-image-kb, never shrink images")
+    _add_upload_arguments(upload_parser)
+
+    args = parser.parse_args(argv)
+    password = os.environ.get('ZOONIVERSE_PASSWORD')
+
+    if args.command == 'run':
+        results = run_config(load_config(args.config), password=password)
+        if any(failed_subjects for _, failed_subjects in results.get('upload', {}).values()):
+            return 1
+    elif args.command == 'preprocess':
+        if args.rois is None and args.tiles is None:
+            parser.error("preprocess needs --tiles or --roi")
+        tile_filter = None
+        if args.min_std is not None or args.min_foreground is not None:
+            if args.min_foreground is not None and args.background is None:
+                parser.error("--min-foreground needs --background")
+            tile_filter = {'min_std': args.min_std or 0.0, 'background': args.background,
+                           'tolerance': args.tolerance, 'min_foreground': args.min_foreground or 0.0}
+        preprocess(open_volume(args.image, args.key, args.shape, args.dtype), args.output, rois=args.rois, n_tiles=args.tiles,
+                   slab_size=args.slab_size, n_workers=args.workers, shard=args.shard, z_range=args.z_range,
+                   tile_indices=args.tile_indices, output_format=args.output_format, tile_filter=tile_filter,
+                   incremental=not args.force)
+    elif args.command == 'merge':
+        merge(args.output)
+    elif args.command == 'dry-run':
+        plan_report(args.directory, args.span, args.step, args.subject_set_size,
+                    max_image_bytes=int(args.max_image_kb * 1e3) if args.max_image_kb else None)
+    elif args.command == 'upload':
+        if password is None:
+            parser.error("set the Zooniverse password in ZOONIVERSE_PASSWORD")
+        _, failed_subjects = upload(args.directory, args.username, password, args.project,
+                                    span=args.span, step=args.step, subject_set_size=args.subject_set_size,
+                                    n_workers=args.workers, cache_bytes=int(args.cache_mb * 2 ** 20),
+                                    max_image_bytes=int(args.max_image_kb * 1e3) if args.max_image_kb else None,
+                                    downscale=args.downscale)
+        if failed_subjects:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
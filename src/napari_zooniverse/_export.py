@@ -0,0 +1,453 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import imageio.v3 as imageio
+import numpy as np
+from imageio import __version__ as imageio_version
+from PIL import Image
+from skimage.io import imsave
+from ._manifest import MANIFEST_NAME, read_manifest, write_manifest, write_partial_manifest
+from ._zarr_store import chunk_path, open_tile_array, require_tile_array, write_plane
+
+# Encoder the JPEGs are written with, part of every tile's fingerprint
+ENCODER = f"imageio {imageio_version} jpeg"
+_TILE_DIR_NAME = re.compile(r'^image_x\d+_y\d+$')
+
+# Tiles filter_tiles skipped, written next to the tile directories
+SKIPPED_TILES_NAME = 'skipped_tiles.json'
+
+# A region of the (z, row, column) volume written to one subject set directory.
+# `x` and `y` are the offsets used in the directory and file names.
+Tile = namedtuple('Tile', ['x', 'y', 'rows', 'cols', 'file_prefix'])
+
+
+def roi_tiles(shapes):
+    """
+    Tiles for the rectangles of a Shapes layer.
+
+    :param shapes: data of a napari Shapes layer of (z, row, column) rectangles.
+    :return: list of Tile.
+    """
+    rectangles = []
+    for shape in shapes:
+        shape = np.array(shape[:, 1:], dtype=np.int32)
+        rectangles.append((shape[0][0], shape[0][1], shape[2][0], shape[1][1]))
+    return rectangle_tiles(rectangles)
+
+
+def rectangle_tiles(rectangles):
+    """
+    Tiles for explicit rectangles, named like Shapes layer ROIs.
+
+    :param rectangles: sequence of (min row, min column, max row, max column).
+    :return: list of Tile.
+    """
+    tiles = []
+    for min_y, min_x, max_y, max_x in rectangles:
+        tiles.append(Tile(int(min_x), int(min_y), slice(int(min_y), int(max_y)), slice(int(min_x), int(max_x)),
+                          'image'))
+    return tiles
+
+
+def grid_tiles(shape, n_tiles_x, n_tiles_y):
+    """
+    Tiles of a regular grid over the last two axes of a volume. Partial
+    tiles at the far edges are dropped.
+
+    :param shape: shape of the (z, row, column) volume.
+    :param n_tiles_x: number of tiles along the rows.
+    :param n_tiles_y: number of tiles along the columns.
+    :return: list of Tile.
+    """
+    M = shape[1] // n_tiles_x
+    N = shape[2] // n_tiles_y
+    tiles = []
+    for y in range(0, shape[2], N):
+        for x in range(0, shape[1], M):
+            if x + M <= shape[1] and y + N <= shape[2]:
+                tiles.append(Tile(x, y, slice(x, x + M), slice(y, y + N), 'img'))
+    return tiles
+
+
+def filter_tiles(image, tiles, min_std=0.0, background=None, tolerance=10.0, min_foreground=0.0, n_samples=8,
+                 stride=4):
+    """
+    Find tiles that are empty or background, e.g. only resin, from
+    statistics of a sample of the volume: `n_samples` z slices spread
+    evenly through it, read every `stride` rows and columns. Each
+    sampled slice is read once for all tiles.
+
+    :param image: (z, row, column) array-like.
+    :param tiles: list of Tile.
+    :param min_std: tiles whose intensity standard deviation is lower are skipped.
+    :param background: background intensity, None to not filter on foreground.
+    :param tolerance: intensity difference from `background` counted as foreground.
+    :param min_foreground: tiles with a lower fraction of foreground pixels are skipped.
+    :param n_samples: number of z slices sampled.
+    :param stride: sampling step along rows and columns.
+    :return: boolean array, True for the tiles to keep, and a list of
+             dicts recording each skipped tile and its statistics.
+    """
+    n_z = image.shape[0]
+    z_samples = np.unique(np.linspace(0, n_z - 1, min(n_samples, n_z)).round().astype(np.int64))
+    samples = np.stack([np.asarray(image[z, ::stride, ::stride], dtype=np.float32) for z in z_samples])
+
+    keep = np.ones(len(tiles), dtype=bool)
+    skipped = []
+    for tile_idx, tile in enumerate(tiles):
+        block = samples[:, -(-tile.rows.start // stride):-(-tile.rows.stop // stride),
+                        -(-tile.cols.start // stride):-(-tile.cols.stop // stride)]
+        std = float(block.std()) if block.size else 0.0
+        foreground = float(np.mean(np.abs(block - background) > tolerance)) \
+            if background is not None and block.size else 1.0
+        if std < min_std or foreground < min_foreground:
+            keep[tile_idx] = False
+            skipped.append({'name': tile_dir_name(tile), 'x': int(tile.x), 'y': int(tile.y),
+                            'rows': [int(tile.rows.start), int(tile.rows.stop)],
+                            'cols': [int(tile.cols.start), int(tile.cols.stop)],
+                            'std': std, 'foreground': foreground})
+    return keep, skipped
+
+
+def write_skipped_tiles(output_path, skipped, thresholds):
+    """
+    Record the tiles filter_tiles skipped in `output_path`, so they are
+    never uploaded or browsed.
+
+    :param output_path: directory, or OME-Zarr store, the tiles are written to.
+    :param skipped: skipped tiles from filter_tiles.
+    :param thresholds: arguments filter_tiles was called with.
+    """
+    tmp_path = os.path.join(output_path, SKIPPED_TILES_NAME + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump({'thresholds': thresholds, 'tiles': skipped}, f, indent=1)
+    os.replace(tmp_path, os.path.join(output_path, SKIPPED_TILES_NAME))
+
+
+def read_skipped_tiles(output_path):
+    """
+    :param output_path: directory, or OME-Zarr store, holding the tiles.
+    :return: set of the directory names of the tiles skipped by the export.
+    """
+    try:
+        with open(os.path.join(output_path, SKIPPED_TILES_NAME)) as f:
+            return {tile['name'] for tile in json.load(f)['tiles']}
+    except FileNotFoundError:
+        return set()
+
+
+def is_skipped_tile(directory):
+    """
+    :return: whether the export skipped the tile of `directory`.
+    """
+    directory = os.path.abspath(directory)
+    return os.path.basename(directory) in read_skipped_tiles(os.path.dirname(directory))
+
+
+def tile_dir_name(tile):
+    return 'image_x{0:04d}_y{1:04d}'.format(tile.x, tile.y)
+
+
+def tile_file_name(tile, z):
+    return '{0}_x{1:04d}_y{2:04d}_z{3:04d}.jpeg'.format(tile.file_prefix, tile.x, tile.y, z)
+
+
+def tile_origin(file_prefix, x, y):
+    """
+    ROI tiles are named by their first column and row, grid tiles by
+    their first row and column.
+
+    :return: (row, column) of the first pixel of a tile in the volume,
+             from the prefix, x and y of its file names.
+    """
+    return (x, y) if file_prefix == 'img' else (y, x)
+
+
+def _write_plane(path, plane):
+    imsave(path, plane)
+    return os.path.getsize(path)
+
+
+def encode_jpeg(plane, quality=None):
+    """
+    :param quality: JPEG quality from 1 to 100, None for the quality
+                    `_write_plane` writes with.
+    :return: the bytes `_write_plane` would write for `plane`, or the
+             JPEG bytes of `plane` at `quality`.
+    """
+    if quality is None:
+        return imageio.imwrite('<bytes>', plane, extension='.jpeg')
+    return imageio.imwrite('<bytes>', plane, extension='.jpeg', quality=int(quality))
+
+
+# Luminance quantization table of the JPEG standard, which libjpeg scales by quality
+_STANDARD_LUMINANCE = np.array([16, 11, 10, 16, 24, 40, 51, 61, 12, 12, 14, 19, 26, 58, 60, 55,
+                                14, 13, 16, 24, 40, 57, 69, 56, 14, 17, 22, 29, 51, 87, 80, 62,
+                                18, 22, 37, 56, 68, 109, 103, 77, 24, 35, 55, 64, 81, 104, 113, 92,
+                                49, 64, 78, 87, 103, 121, 120, 101, 72, 92, 95, 98, 112, 100, 103, 99])
+_QUALITY_TABLES = np.clip((_STANDARD_LUMINANCE * np.array([5000 // q if q < 50 else 200 - 2 * q
+                                                           for q in range(1, 101)])[:, None] + 50) // 100, 1, 255)
+
+
+def jpeg_quality(path):
+    """
+    :param path: JPEG file or file object.
+    :return: the libjpeg quality closest to the file's luminance
+             quantization table, None if it is not a JPEG.
+    """
+    try:
+        with Image.open(path) as image:
+            table = np.asarray(image.quantization[0])
+    except (OSError, AttributeError, KeyError):
+        return None
+    return int(np.argmin(np.abs(_QUALITY_TABLES - table).sum(axis=1))) + 1
+
+
+def shard_units(n_z, n_tiles, slab_size, shard=None, z_range=None, tile_indices=None):
+    """
+    Split an export into units of one tile over one slab of z slices and
+    pick the units of one shard. Units are ordered slab by slab so each
+    shard reads a contiguous run of z. The split depends only on the
+    arguments, so every node computes the same assignment and no unit
+    is given to two shards of the same `shard_count`.
+
+    :param n_z: number of z slices in the volume.
+    :param n_tiles: number of tiles.
+    :param slab_size: number of z slices read at once.
+    :param shard: (shard index, shard count), None for all units.
+    :param z_range: (start, stop) z slices to export, None for all.
+    :param tile_indices: indices of the tiles to export, None for all.
+    :return: (n_units, 3) array of tile index, first and one past the
+             last z slice of each unit.
+    """
+    z_start, z_stop = z_range if z_range is not None else (0, n_z)
+    z_start, z_stop = max(0, int(z_start)), min(n_z, int(z_stop))
+    starts = np.arange(z_start, z_stop, slab_size, dtype=np.int64)
+    stops = np.minimum(starts + slab_size, z_stop)
+    tile_indices = np.arange(n_tiles, dtype=np.int64) if tile_indices is None \
+        else np.unique(np.asarray(tile_indices, dtype=np.int64))
+
+    units = np.empty((len(starts) * len(tile_indices), 3), dtype=np.int64)
+    units[:, 0] = np.tile(tile_indices, len(starts))
+    units[:, 1] = np.repeat(starts, len(tile_indices))
+    units[:, 2] = np.repeat(stops, len(tile_indices))
+    if shard is not None:
+        shard_index, shard_count = shard
+        if not 0 <= shard_index < shard_count:
+            raise ValueError(f"Shard index {shard_index} is not in 0-{shard_count - 1}")
+        units = np.array_split(units, shard_count)[shard_index]
+    return units
+
+
+def tile_fingerprint(image, tile, output_format='jpeg'):
+    """
+    Fingerprint of how a tile is exported: its crop, the shape and dtype
+    of the volume, the output format and the encoder. The content of
+    the tile is compared plane by plane, see plane_digest.
+
+    :return: hex digest.
+    """
+    return hashlib.sha1(json.dumps({
+        'rows': [int(tile.rows.start), int(tile.rows.stop)],
+        'cols': [int(tile.cols.start), int(tile.cols.stop)],
+        'file_prefix': tile.file_prefix,
+        'shape': [int(n) for n in image.shape],
+        'dtype': str(image.dtype),
+        'format': output_format,
+        'encoder': ENCODER,
+    }, sort_keys=True).encode()).hexdigest()
+
+
+def plane_digest(plane):
+    """
+    :return: hex digest of every pixel of a plane of a tile.
+    """
+    return hashlib.blake2b(np.ascontiguousarray(plane), digest_size=16).hexdigest()
+
+
+def _plane_exists(subject_path, file_name, z, nbytes, output_format):
+    if output_format == 'zarr':
+        # A chunk of only the fill value may not be stored, write_plane then records 0 bytes
+        return nbytes == 0 or os.path.isfile(chunk_path(open_tile_array(subject_path), z))
+    return os.path.isfile(os.path.join(subject_path, file_name))
+
+
+def remove_orphan_tiles(output_path, tiles):
+    """
+    Remove tile directories, or OME-Zarr tile groups, of `output_path`
+    that are not one of `tiles`, e.g. left behind by an ROI that was
+    moved or a tiling that changed.
+
+    :return: names of the removed directories.
+    """
+    names = {tile_dir_name(tile) for tile in tiles}
+    orphans = sorted(entry.name for entry in os.scandir(output_path)
+                     if entry.is_dir() and _TILE_DIR_NAME.match(entry.name) and entry.name not in names)
+    for name in orphans:
+        print(f"Removing {name}, it is no longer one of the exported tiles")
+        shutil.rmtree(os.path.join(output_path, name), ignore_errors=True)
+    return orphans
+
+
+def iter_export_tiles(image, output_path, tiles, slab_size=16, n_workers=4, shard=None, z_range=None,
+                      tile_indices=None, output_format='jpeg', incremental=True):
+    """
+    Write every z slice of every tile as a JPEG. The volume is walked in
+    slabs of `slab_size` slices and only the region of each tile is read
+    from a slab, so `image` can be any array-like (numpy, dask, zarr)
+    and is never loaded whole. Encoding and writing run on a pool of
+    `n_workers` threads while the next region is read. A manifest is
+    written to each tile directory once all of its images are written.
+
+    With a shard specification only part of the export is written, see
+    shard_units. Tiles the shard writes completely get their manifest;
+    tiles it writes in part get a partial manifest for merge_manifests.
+
+    With `output_format='zarr'`, `output_path` is an OME-Zarr store and
+    each tile is a group holding one array chunked one z slice by the
+    whole tile, instead of a directory of JPEGs. The manifest still
+    lists the JPEG names, which are encoded when they are uploaded.
+
+    Exports are incremental: the manifest records the plane_digest of
+    every plane, and while a tile whose manifest has the same
+    tile_fingerprint is read, only the planes whose digest changed or
+    whose file is missing are written again. A tile exported
+    differently is removed and written again when this export covers
+    all of its z slices, and otherwise overwritten in place by the
+    shards that cover it.
+
+    :param image: (z, row, column) array-like.
+    :param output_path: directory the tile directories are written to.
+    :param tiles: list of Tile to export.
+    :param slab_size: number of z slices read at once.
+    :param n_workers: number of images encoded at once.
+    :param shard: (shard index, shard count) to export.
+    :param z_range: (start, stop) z slices to export.
+    :param tile_indices: indices in `tiles` of the tiles to export.
+    :param output_format: 'jpeg' for JPEG files or 'zarr' for OME-Zarr.
+    :param incremental: False to write every tile even if it is up to date.
+    :return: yields (files exported, total files) after every file, up
+             to date files included; returns (files written, files up
+             to date).
+    """
+    if output_format not in ('jpeg', 'zarr'):
+        raise ValueError(f"Unknown output format {output_format!r}, expected 'jpeg' or 'zarr'")
+    n_z = image.shape[0]
+    units = shard_units(n_z, len(tiles), slab_size, shard, z_range, tile_indices)
+
+    fingerprints = {}
+    known = {}
+    for tile_idx in np.unique(units[:, 0]):
+        subject_path = os.path.join(output_path, tile_dir_name(tiles[tile_idx]))
+        fingerprints[tile_idx] = tile_fingerprint(image, tiles[tile_idx], output_format)
+        manifest = read_manifest(subject_path)
+        if incremental and manifest is not None and manifest.get('fingerprint') == fingerprints[tile_idx] \
+                and 'digests' in manifest and len(manifest['z']) == n_z:
+            # Digest and size of the planes still on disk, compared as the planes are read
+            known[tile_idx] = {int(z): (digest, int(n)) for z, name, digest, n
+                               in zip(manifest['z'], manifest['files'], manifest['digests'], manifest['nbytes'])
+                               if _plane_exists(subject_path, name, z, n, output_format)}
+            continue
+        if not os.path.isdir(subject_path):
+            continue
+        # Only remove a tile no other shard is writing
+        if np.sum(np.diff(units[units[:, 0] == tile_idx, 1:], axis=1)) == n_z:
+            shutil.rmtree(subject_path)
+        elif manifest is not None:
+            try:
+                os.remove(os.path.join(subject_path, MANIFEST_NAME))
+            except FileNotFoundError:
+                pass
+
+    arrays = {}
+    for tile_idx in np.unique(units[:, 0]):
+        if output_format == 'zarr':
+            arrays[tile_idx] = require_tile_array(output_path, tiles[tile_idx], n_z, image.dtype,
+                                                     image.shape[3:])
+        else:
+            os.makedirs(os.path.join(output_path, tile_dir_name(tiles[tile_idx])), exist_ok=True)
+
+    n_total = int(np.sum(units[:, 2] - units[:, 1]))
+    n_files = 0
+    nbytes = np.zeros((len(tiles), n_z), dtype=np.int64)
+    written = np.zeros((len(tiles), n_z), dtype=bool)
+    digests = {tile_idx: [None] * n_z for tile_idx in np.unique(units[:, 0])}
+    n_up_to_date = 0
+    # Cap the queued planes so memory stays bounded when reading outpaces encoding
+    max_pending = max(1, n_workers) * 4
+    pending = deque()
+
+    def finish_oldest():
+        future, tile_idx, z = pending.popleft()
+        nbytes[tile_idx, z] = future.result()
+        written[tile_idx, z] = True
+
+    with ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:
+        for tile_idx, z_start, z_stop in units:
+            tile = tiles[tile_idx]
+            slab = np.asarray(image[z_start:z_stop, tile.rows, tile.cols])
+            subject_path = os.path.join(output_path, tile_dir_name(tile))
+            for z, plane in enumerate(slab, start=int(z_start)):
+                digest = digests[tile_idx][z] = plane_digest(plane)
+                previous = known.get(tile_idx, {}).get(z)
+                if previous is not None and previous[0] == digest:
+                    nbytes[tile_idx, z] = previous[1]
+                    written[tile_idx, z] = True
+                    n_up_to_date += 1
+                    n_files += 1
+                    yield n_files, n_total
+                    continue
+                while len(pending) >= max_pending:
+                    finish_oldest()
+                    n_files += 1
+                    yield n_files, n_total
+                if output_format == 'zarr':
+                    future = executor.submit(write_plane, arrays[tile_idx], z, plane)
+                else:
+                    future = executor.submit(_write_plane, os.path.join(subject_path, tile_file_name(tile, z)),
+                                             plane)
+                pending.append((future, tile_idx, z))
+        while pending:
+            finish_oldest()
+            n_files += 1
+            yield n_files, n_total
+    if n_up_to_date:
+        print(f"{n_up_to_date} of {n_total} images are up to date")
+    n_written = n_files - n_up_to_date
+
+    for tile_idx in np.unique(units[:, 0]):
+        tile = tiles[tile_idx]
+        z_indices = np.flatnonzero(written[tile_idx])
+        file_names = [tile_file_name(tile, z) for z in z_indices]
+        tile_digests = [digests[tile_idx][z] for z in z_indices]
+        subject_path = os.path.join(output_path, tile_dir_name(tile))
+        if len(z_indices) == n_z:
+            write_manifest(subject_path, tile, file_names, z_indices, nbytes[tile_idx, z_indices], image.dtype,
+                           fingerprints[tile_idx], tile_digests)
+        else:
+            # The manifest of the whole tile no longer holds once part of it is exported again
+            try:
+                os.remove(os.path.join(subject_path, MANIFEST_NAME))
+            except FileNotFoundError:
+                pass
+            write_partial_manifest(subject_path, tile, file_names, z_indices, nbytes[tile_idx, z_indices],
+                                   image.dtype, n_z, fingerprints[tile_idx], tile_digests)
+    return n_written, n_up_to_date
+
+
+def export_tiles(*args, **kwargs):
+    """
+    Run iter_export_tiles to completion.
+
+    :return: number of files written, not counting those up to date.
+    """
+    export = iter_export_tiles(*args, **kwargs)
+    while True:
+        try:
+            next(export)
+        except StopIteration as e:
+            return e.value[0]
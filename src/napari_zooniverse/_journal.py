@@ -0,0 +1,143 @@
+import json
+import os
+import threading
+
+PLANNED = "planned"
+SAVED = "saved"
+LINKED = "linked"
+
+
+def journal_path(subject_set_dir):
+    """
+    Location of the upload journal for a subject set directory. The
+    journal sits next to the directory rather than inside it so that it
+    is never picked up as an image.
+
+    :param subject_set_dir: directory of the subject set images.
+    :return: path to the journal file.
+    """
+    subject_set_dir = os.path.normpath(subject_set_dir)
+    return os.path.join(os.path.dirname(subject_set_dir),
+                        os.path.basename(subject_set_dir) + '_upload_journal.jsonl')
+
+
+class UploadJournal:
+    """
+    Append-only record of an upload. Every planned subject set and
+    subject is written as one JSON line together with its state
+    (planned, saved, linked) and the Zooniverse ID it was given, so a
+    re-run can skip everything that has already been uploaded. A torn
+    last line left by a crash is ignored on load.
+
+    Records are tagged with the project and API endpoint they were
+    uploaded to, and records of another project or endpoint are ignored,
+    so uploading the same directory somewhere else starts afresh.
+
+    :param path: journal file, see journal_path.
+    :param project_id: ID of the project uploaded to.
+    :param endpoint: URL of the Zooniverse API uploaded to.
+    """
+
+    def __init__(self, path, project_id=None, endpoint=None):
+        self.path = path
+        self.scope = {'project': None if project_id is None else str(project_id), 'endpoint': endpoint}
+        self.subject_sets = {}
+        self.subjects = {}
+        self.n_ignored = 0
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            valid_bytes = 0
+            with open(path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    if not line.endswith(b'\n'):
+                        break
+                    if all(record.get(key) == value for key, value in self.scope.items()):
+                        self._apply(record)
+                    else:
+                        self.n_ignored += 1
+                    valid_bytes += len(line)
+            # Drop a partially written last record so new records start on a fresh line
+            if valid_bytes != os.path.getsize(path):
+                with open(path, 'rb+') as f:
+                    f.truncate(valid_bytes)
+
+        self._file = open(path, 'a')
+
+    def _apply(self, record):
+        name = record['subject_set']
+        if record.get('reset'):
+            self.subject_sets[name] = {'id': None, 'state': record['state']}
+            self.subjects[name] = {}
+            return
+        if 'subject' in record:
+            entry = self.subjects.setdefault(name, {}).setdefault(record['subject'], {'id': None})
+        else:
+            entry = self.subject_sets.setdefault(name, {'id': None})
+            self.subjects.setdefault(name, {})
+        entry['state'] = record['state']
+        if record.get('id') is not None:
+            entry['id'] = record['id']
+
+    def _write(self, records):
+        with self._lock:
+            for record in records:
+                record.update(self.scope)
+                self._apply(record)
+                self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+
+    def plan_subject_set(self, name):
+        if name not in self.subject_sets:
+            self._write([{'subject_set': name, 'state': PLANNED}])
+
+    def subject_set_saved(self, name, subject_set_id):
+        self._write([{'subject_set': name, 'state': SAVED, 'id': str(subject_set_id)}])
+
+    def subject_set_linked(self, name):
+        self._write([{'subject_set': name, 'state': LINKED}])
+
+    def reset_subject_set(self, name):
+        """
+        Forget a subject set and its subjects, e.g. once it has been
+        deleted on Zooniverse, so they are uploaded again.
+        """
+        self._write([{'subject_set': name, 'state': PLANNED, 'reset': True}])
+
+    def plan_subjects(self, name, centres):
+        known = self.subjects.get(name, {})
+        self._write([{'subject_set': name, 'subject': int(c), 'state': PLANNED}
+                     for c in centres if int(c) not in known])
+
+    def subject_saved(self, name, centre_idx, subject_id):
+        self._write([{'subject_set': name, 'subject': int(centre_idx), 'state': SAVED,
+                      'id': str(subject_id)}])
+
+    def subjects_linked(self, name, centres):
+        self._write([{'subject_set': name, 'subject': int(c), 'state': LINKED} for c in centres])
+
+    def subject_set_id(self, name):
+        return self.subject_sets.get(name, {}).get('id')
+
+    def subject_set_state(self, name):
+        return self.subject_sets.get(name, {}).get('state')
+
+    def subject(self, name, centre_idx):
+        """
+        :return: dict with the `state` and `id` of a subject, or None if
+                 it has never been planned.
+        """
+        return self.subjects.get(name, {}).get(int(centre_idx))
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,120 @@
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from skimage.transform import resize
+from ._export import encode_jpeg, jpeg_quality
+from ._utils import read_image
+
+# JPEG qualities tried, best first
+QUALITIES = tuple(range(95, 25, -5))
+# Scales tried, largest first, when even the lowest quality is over budget
+SCALES = (1.0, 0.75, 0.5)
+
+
+def rescale_stack(stack, scale):
+    """
+    :param stack: (z, row, column) stack of planes.
+    :param scale: factor the rows and columns are resized by.
+    :return: every plane of `stack` resized in one call.
+    """
+    if scale == 1:
+        return stack
+    shape = (stack.shape[0], max(1, round(stack.shape[1] * scale)), max(1, round(stack.shape[2] * scale)))
+    return resize(stack, shape + stack.shape[3:], order=1, anti_aliasing=True,
+                  preserve_range=True).astype(stack.dtype)
+
+
+def choose_encoding(stack, max_bytes, qualities=QUALITIES, scales=SCALES, n_workers=4):
+    """
+    Find the best quality, at the largest scale, at which every plane of
+    a stack encodes within `max_bytes`. Qualities are binary searched,
+    the size of a JPEG growing with its quality, and the planes of each
+    candidate are encoded in parallel.
+
+    :param stack: (z, row, column) sample of the planes to encode.
+    :param max_bytes: largest size of an encoded plane.
+    :param qualities: qualities to choose from, best first.
+    :param scales: scales to choose from, largest first.
+    :param n_workers: number of planes encoded at once.
+    :return: (quality, scale); the lowest quality and scale if no
+             quality and scale fit.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:
+        for scale in scales:
+            scaled = rescale_stack(stack, scale)
+            low, high = 0, len(qualities)
+            while low < high:
+                middle = (low + high) // 2
+                sizes = list(executor.map(lambda plane: len(encode_jpeg(plane, qualities[middle])), scaled))
+                if max(sizes) <= max_bytes:
+                    high = middle
+                else:
+                    low = middle + 1
+            if low < len(qualities):
+                return qualities[low], scale
+    return qualities[-1], scales[-1]
+
+
+class BudgetEncoder:
+    """
+    Re-encode the images of a tile directory to a per-image byte budget
+    for upload. One quality and scale is chosen for the whole z-stack,
+    from evenly spaced sample planes, so every frame of every subject is
+    encoded alike; a plane still over budget with them is encoded again
+    at lower qualities on its own. Qualities above that of exported
+    JPEGs are never tried, and at full scale a JPEG already within the
+    budget is uploaded as it is. The quality each image was uploaded at
+    is kept in `qualities`.
+
+    :param file_list: sorted list of image paths.
+    :param max_bytes: largest size of an uploaded image.
+    :param n_samples: number of planes the quality and scale are chosen from.
+    :param downscale: whether images may be shrunk to fit the budget.
+    """
+
+    def __init__(self, file_list, max_bytes, n_samples=8, downscale=True):
+        self.file_list = file_list
+        self.max_bytes = max_bytes
+        self.n_samples = n_samples
+        self.scales = SCALES if downscale else (1.0,)
+        self.quality = None
+        self.scale = None
+        self.source_quality = None
+        self.qualities = {}
+        self._lock = threading.Lock()
+
+    def _choose(self):
+        with self._lock:
+            if self.quality is not None:
+                return
+            samples = np.unique(np.linspace(0, len(self.file_list) - 1, self.n_samples).round().astype(int))
+            stack = np.stack([read_image(str(self.file_list[i])) for i in samples])
+            first = str(self.file_list[0])
+            self.source_quality = jpeg_quality(first) if os.path.isfile(first) else None
+            qualities = [q for q in QUALITIES if self.source_quality is None or q <= self.source_quality]
+            self.quality, self.scale = choose_encoding(stack, self.max_bytes, qualities or QUALITIES[-1:],
+                                                       self.scales)
+            print(f"Encoding images at quality {self.quality}, scale {self.scale} "
+                  f"to fit {self.max_bytes / 1e3:.0f} kB each")
+
+    def encode(self, path):
+        """
+        :param path: image path from load_image_list.
+        :return: JPEG bytes of the image within the budget, or at the
+                 lowest quality if it cannot fit.
+        """
+        self._choose()
+        if self.scale == 1 and os.path.isfile(path) and os.path.getsize(path) <= self.max_bytes:
+            with open(path, 'rb') as f:
+                data = f.read()
+            self.qualities[path] = jpeg_quality(io.BytesIO(data)) or self.quality
+            return data
+        plane = rescale_stack(read_image(path)[None], self.scale)[0]
+        for quality in (q for q in QUALITIES if q <= self.quality):
+            data = encode_jpeg(plane, quality)
+            if len(data) <= self.max_bytes:
+                break
+        self.qualities[path] = quality
+        return data
@@ -0,0 +1,149 @@
+import glob
+import json
+import os
+import numpy as np
+
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 1
+# Partial manifests of a sharded export, named by the z slices they cover
+PARTIAL_MANIFEST_NAME = 'manifest.z{0:04d}-{1:04d}.part.json'
+PARTIAL_MANIFEST_GLOB = 'manifest.z*.part.json'
+
+
+def _manifest_dict(tile, file_names, z_indices, nbytes, dtype, fingerprint=None, digests=None):
+    order = np.argsort(z_indices, kind='stable')
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'x': int(tile.x),
+        'y': int(tile.y),
+        'rows': [int(tile.rows.start), int(tile.rows.stop)],
+        'cols': [int(tile.cols.start), int(tile.cols.stop)],
+        'file_prefix': tile.file_prefix,
+        'dtype': str(np.dtype(dtype)),
+        'files': [file_names[i] for i in order],
+        'z': [int(z_indices[i]) for i in order],
+        'nbytes': [int(nbytes[i]) for i in order],
+    }
+    if fingerprint is not None:
+        manifest['fingerprint'] = fingerprint
+    if digests is not None:
+        manifest['digests'] = [digests[i] for i in order]
+    return manifest
+
+
+def _write_json(path, manifest):
+    # Write then rename so a reader never sees a half written manifest
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+def write_manifest(subject_path, tile, file_names, z_indices, nbytes, dtype, fingerprint=None, digests=None):
+    """
+    Record the images of a tile directory so they can be planned without
+    listing the directory or parsing file names. Columns are stored as
+    flat lists, one entry per image, sorted by z.
+
+    :param subject_path: tile directory the manifest is written to.
+    :param tile: Tile the images were cut from.
+    :param file_names: image file names relative to `subject_path`.
+    :param z_indices: z index of each image in the source volume.
+    :param nbytes: size in bytes of each written image.
+    :param dtype: dtype of the source volume.
+    :param fingerprint: tile_fingerprint of the images, to tell whether
+                        a later export would write them again.
+    :param digests: plane_digest of the source plane of each image.
+    """
+    _write_json(os.path.join(subject_path, MANIFEST_NAME),
+                _manifest_dict(tile, file_names, z_indices, nbytes, dtype, fingerprint, digests))
+
+
+def write_partial_manifest(subject_path, tile, file_names, z_indices, nbytes, dtype, n_z, fingerprint=None,
+                           digests=None):
+    """
+    Record the images one shard wrote to a tile directory, for
+    merge_manifests. Takes the arguments of write_manifest and the
+    number of z slices of the whole volume.
+    """
+    manifest = _manifest_dict(tile, file_names, z_indices, nbytes, dtype, fingerprint, digests)
+    manifest['n_z'] = int(n_z)
+    name = PARTIAL_MANIFEST_NAME.format(min(manifest['z']), max(manifest['z']))
+    _write_json(os.path.join(subject_path, name), manifest)
+
+
+def merge_manifests(output_path):
+    """
+    Combine the partial manifests the shards of an export wrote into one
+    manifest per tile directory, the same manifest a single node export
+    writes, and remove the partial manifests.
+
+    :param output_path: directory holding the tile directories.
+    :return: number of tile directories merged.
+    :raises ValueError: if shards overlap or a tile is missing z slices,
+                        before anything is changed.
+    """
+    merges = []
+    for subject_path in sorted(entry.path for entry in os.scandir(output_path) if entry.is_dir()):
+        part_paths = sorted(glob.glob(os.path.join(glob.escape(subject_path), PARTIAL_MANIFEST_GLOB)))
+        if not part_paths:
+            continue
+        parts = []
+        for part_path in part_paths:
+            with open(part_path) as f:
+                parts.append(json.load(f))
+        existing = read_manifest(subject_path)
+        if existing is not None and len(existing['z']) == parts[0]['n_z']:
+            # Merged by an earlier merge that stopped before removing the partial manifests
+            merges.append((subject_path, part_paths, None))
+            continue
+
+        if len({part.get('fingerprint') for part in parts}) > 1:
+            raise ValueError(f"{subject_path} has partial manifests of different exports, "
+                             f"remove the older ones and export their shards again")
+        z = np.concatenate([np.asarray(part['z'], dtype=np.int64) for part in parts])
+        z_unique, counts = np.unique(z, return_counts=True)
+        n_z = parts[0]['n_z']
+        if np.any(counts > 1):
+            raise ValueError(f"Shards overlap in {subject_path} at z {z_unique[counts > 1].tolist()}")
+        if len(z_unique) != n_z:
+            raise ValueError(f"{subject_path} has {len(z_unique)} of {n_z} z slices, "
+                             f"a shard has not finished")
+        merges.append((subject_path, part_paths, parts))
+
+    for subject_path, part_paths, parts in merges:
+        if parts is not None:
+            _write_merged(subject_path, parts)
+        for part_path in part_paths:
+            os.remove(part_path)
+        print(f"Merged {len(part_paths)} partial manifests in {subject_path}")
+    return len(merges)
+
+
+def _write_merged(subject_path, parts):
+    manifest = {key: parts[0][key] for key in ('version', 'x', 'y', 'rows', 'cols', 'file_prefix', 'dtype')}
+    z = np.concatenate([np.asarray(part['z'], dtype=np.int64) for part in parts])
+    order = np.argsort(z, kind='stable')
+    keys = ('files', 'z', 'nbytes', 'digests') if all('digests' in part for part in parts) else ('files', 'z', 'nbytes')
+    for key in keys:
+        column = [value for part in parts for value in part[key]]
+        manifest[key] = [column[i] for i in order]
+    if 'fingerprint' in parts[0]:
+        manifest['fingerprint'] = parts[0]['fingerprint']
+    _write_json(os.path.join(subject_path, MANIFEST_NAME), manifest)
+
+
+def read_manifest(subject_path):
+    """
+    :param subject_path: tile directory.
+    :return: manifest dict with `z` and `nbytes` as NumPy arrays, or None
+             if the directory has no manifest.
+    """
+    try:
+        with open(os.path.join(subject_path, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+    manifest['z'] = np.asarray(manifest['z'], dtype=np.int64)
+    manifest['nbytes'] = np.asarray(manifest['nbytes'], dtype=np.int64)
+    return manifest
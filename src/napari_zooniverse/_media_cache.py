@@ -0,0 +1,91 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Default bound of a MediaCache, enough for the overlapping windows of
+# many workers at span 2 on tiles of a few MB
+DEFAULT_CACHE_BYTES = 256 * 2 ** 20
+
+
+class MediaCache:
+    """
+    Bounded, thread-safe LRU cache of the bytes of subject images and
+    their MD5 digests, shared by every subject of an upload. With
+    overlapping subject windows every image belongs to up to
+    2 * span + 1 subjects; through the cache each is read, or encoded,
+    once while it is in use. Threads asking for an image another thread
+    is reading wait for that read instead of starting their own.
+
+    :param max_bytes: most bytes of media held, least recently used
+                      images are dropped first.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_read = 0
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, load):
+        """
+        :param key: path of the image.
+        :param load: function of `key` returning its bytes, called on a miss.
+        :return: bytes and MD5 hex digest of the image.
+        """
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = threading.Event()
+                    self.misses += 1
+                    break
+            # Another thread is reading the image, take its result once it is cached
+            loading.wait()
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry
+
+        try:
+            data = load(key)
+            entry = (data, hashlib.md5(data).hexdigest())
+            with self._lock:
+                self.bytes_read += len(data)
+                if len(data) <= self.max_bytes:
+                    self._entries[key] = entry
+                    self.n_bytes += len(data)
+                    while self.n_bytes > self.max_bytes:
+                        _, (old, _) = self._entries.popitem(last=False)
+                        self.n_bytes -= len(old)
+            return entry
+        finally:
+            with self._lock:
+                del self._loading[key]
+            loading.set()
+
+    def digest(self, key):
+        """
+        :return: MD5 hex digest of a cached image, None if it is not cached.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        return entry[1] if entry is not None else None
+
+    def summary(self):
+        """
+        :return: one line summary of the reads saved.
+        """
+        total = self.hits + self.misses
+        return (f"Media cache: {self.misses} images read ({self.bytes_read / 2 ** 20:.1f} MB), "
+                f"{self.hits} of {total} requests served from memory")
@@ -0,0 +1,448 @@
+"""
+Qt-free entry points for the preprocessing export and the subject set
+upload. The napari widgets and the command line both run through these
+functions, so a job configured in one behaves the same in the other.
+"""
+import os
+import time
+import numpy as np
+from ._backend import PanoptesBackend
+from ._export import (rectangle_tiles, grid_tiles, iter_export_tiles, filter_tiles, write_skipped_tiles,
+                      read_skipped_tiles, is_skipped_tile, remove_orphan_tiles)
+from ._jpeg_budget import BudgetEncoder
+from ._journal import UploadJournal, journal_path, LINKED
+from ._manifest import read_manifest, merge_manifests
+from ._media_cache import MediaCache, DEFAULT_CACHE_BYTES
+from ._planner import plan_upload, subject_set_names, subject_members, estimate_upload
+from ._scheduler import RequestScheduler, ScheduledBackend, status_code
+from ._zarr_store import ZARR_STORE_NAME
+from ._utils import (load_image_list, iter_upload_subject_set, initialise_subject_set, find_subject_set,
+                     DEFAULT_BACKEND)
+
+
+def open_volume(path, key=None, shape=None, dtype=None):
+    """
+    Open a (z, row, column) volume without reading it into memory.
+    `.npy` and raw files are memory-mapped, TIFF stacks and zarr stores
+    are read chunk by chunk, so opening costs the same whatever the
+    size of the file and only the slices and tiles indexed are read.
+
+    :param path: `.npy` file, `.raw`/`.bin` file, `.tif`/`.tiff` stack
+                 or `.zarr` store.
+    :param key: array inside a zarr group, if `path` is a group.
+    :param shape: (z, row, column) shape of a raw file.
+    :param dtype: dtype of a raw file.
+    :return: array-like that is read on indexing.
+    """
+    extension = os.path.splitext(path.rstrip('/\\'))[1].lower()
+    if extension == '.npy':
+        return np.load(path, mmap_mode='r')
+    if extension in ('.raw', '.bin'):
+        if shape is None or dtype is None:
+            raise ValueError("A raw volume needs its shape and dtype")
+        return np.memmap(path, dtype=dtype, mode='r', shape=tuple(shape))
+    if extension in ('.tif', '.tiff'):
+        import tifffile
+        import zarr
+        return zarr.open(tifffile.imread(path, aszarr=True), mode='r')
+    if extension == '.zarr':
+        import zarr
+        store = zarr.open(path, mode='r')
+        return store[key] if key is not None else store
+    raise ValueError(f"Unsupported volume format {extension!r}, expected .npy, .raw, .tif or .zarr")
+
+
+def output_store(output_path, output_format='jpeg'):
+    """
+    :return: directory, or OME-Zarr store, an export to `output_path` writes its tiles to.
+    """
+    return os.path.join(output_path, ZARR_STORE_NAME if output_format == 'zarr' else 'subject_sets')
+
+
+def iter_preprocess(image, output_path, tiles, slab_size=16, n_workers=4, shard=None, z_range=None,
+                    tile_indices=None, output_format='jpeg', tile_filter=None, incremental=True):
+    """
+    Export `tiles` of `image` to `output_path`/subject_sets, or to the
+    OME-Zarr store `output_path`/subject_sets.zarr when `output_format`
+    is 'zarr'. Only the part of the export given by `shard`, `z_range`
+    and `tile_indices` is written, see shard_units.
+
+    With a `tile_filter`, a dict of filter_tiles thresholds, empty and
+    background tiles are left out and recorded as skipped. Every shard
+    filters the same way, so the shards still split the remaining
+    tiles without overlap.
+
+    Images that are up to date are not written again unless
+    `incremental` is False, see iter_export_tiles. An export of every tile on a single node also
+    removes the tile directories of earlier exports that are no longer
+    among `tiles`, or that were skipped.
+
+    :return: yields (files exported, total files); returns a summary of
+             the export with its throughput over the files written.
+    """
+    output_path = output_store(output_path, output_format)
+    os.makedirs(output_path, exist_ok=True)
+
+    start_time = time.perf_counter()
+    complete = shard is None and z_range is None and tile_indices is None
+    skipped_summary = ""
+    if tile_filter is not None:
+        keep, skipped = filter_tiles(image, tiles, **tile_filter)
+        write_skipped_tiles(output_path, skipped, tile_filter)
+        kept_indices = np.flatnonzero(keep)
+        if tile_indices is not None:
+            kept_indices = np.intersect1d(kept_indices, tile_indices)
+        tile_indices = kept_indices
+        skipped_summary = f", skipped {len(skipped)} empty tiles"
+        print(f"Skipping {len(skipped)} of {len(tiles)} tiles: {', '.join(t['name'] for t in skipped)}")
+
+    # Up to date files cost a read but no write, so they are reported apart and left out of the rate
+    n_written, n_up_to_date = yield from iter_export_tiles(image, output_path, tiles, slab_size=slab_size,
+                                                           n_workers=n_workers, shard=shard, z_range=z_range,
+                                                           tile_indices=tile_indices, output_format=output_format,
+                                                           incremental=incremental)
+    if complete:
+        kept = tiles if tile_indices is None else [tiles[i] for i in tile_indices]
+        remove_orphan_tiles(output_path, kept)
+    elapsed = time.perf_counter() - start_time
+    shard_name = f"shard {shard[0]} of {shard[1]}, " if shard is not None else ""
+    summary = (f"Exported {n_written} images, {n_up_to_date} already up to date, for {shard_name}{len(tiles)} tiles "
+               f"to {output_path} in {elapsed:.1f} s ({n_written / max(elapsed, 1e-9):.1f} files/s)"
+               f"{skipped_summary}")
+    print(summary)
+    return summary
+
+
+def preprocess(image, output_path, rois=None, n_tiles=None, slab_size=16, n_workers=4, shard=None, z_range=None,
+               tile_indices=None, output_format='jpeg', tile_filter=None, incremental=True):
+    """
+    Export a volume as subject set directories of JPEGs, either for
+    explicit ROIs or for a regular tiling.
+
+    :param image: (z, row, column) array-like or a path for open_volume.
+    :param output_path: directory the `subject_sets` directory is written to.
+    :param rois: sequence of (min row, min column, max row, max column).
+    :param n_tiles: (x, y) number of tiles, used when `rois` is not given.
+    :param slab_size: number of z slices read at once.
+    :param n_workers: number of images encoded at once.
+    :param shard: (shard index, shard count) to export on this node.
+    :param z_range: (start, stop) z slices to export on this node.
+    :param tile_indices: indices of the tiles to export on this node.
+    :param output_format: 'jpeg' for JPEG files or 'zarr' for an OME-Zarr store.
+    :param tile_filter: dict of filter_tiles thresholds to skip empty tiles with.
+    :param incremental: False to write every image again, even if it is up to date.
+    :return: summary of the export.
+    """
+    if isinstance(image, str):
+        image = open_volume(image)
+    if rois is not None:
+        tiles = rectangle_tiles(rois)
+    elif n_tiles is not None:
+        tiles = grid_tiles(image.shape, *n_tiles)
+    else:
+        raise ValueError("Either rois or n_tiles is required")
+
+    export = iter_preprocess(image, output_path, tiles, slab_size=slab_size, n_workers=n_workers, shard=shard,
+                             z_range=z_range, tile_indices=tile_indices, output_format=output_format,
+                             tile_filter=tile_filter, incremental=incremental)
+    while True:
+        try:
+            next(export)
+        except StopIteration as e:
+            return e.value
+
+
+def merge(output_path):
+    """
+    Merge the partial manifests of a sharded export once every shard has
+    finished, leaving `output_path`/subject_sets, or subject_sets.zarr,
+    as a single node export would.
+
+    :return: summary of the merge.
+    """
+    n_merged = 0
+    for output_format in ('jpeg', 'zarr'):
+        if os.path.isdir(output_store(output_path, output_format)):
+            n_merged += merge_manifests(output_store(output_path, output_format))
+    summary = f"Merged the shards of {n_merged} tile directories in {output_path}"
+    print(summary)
+    return summary
+
+
+def iter_upload(project, directory, span, step, subject_set_size, n_workers=16, backend=None,
+                cache_bytes=DEFAULT_CACHE_BYTES, max_image_bytes=None, downscale=True):
+    """
+    Upload a tile directory as subject sets, resuming from its journal.
+    Cancelling stops it between subjects; the journal lets a later run
+    carry on. Images are read through one MediaCache of `cache_bytes`
+    for the whole run, 0 to read every image for every subject. With
+    `max_image_bytes` images are re-encoded by a BudgetEncoder to at
+    most that size, shrunk as well if `downscale`; otherwise they are
+    uploaded as exported.
+
+    :return: yields (subjects finished, total subjects) as each subject
+             is saved or fails; returns the number of subject sets
+             completed and of subjects failed.
+    """
+    if is_skipped_tile(directory):
+        print(f"{directory} was skipped by the export as an empty tile, not uploading it")
+        return 0, 0
+
+    file_list, z = load_image_list(directory)
+    n_files = len(file_list)
+    print(f"There are {n_files} images in the directory {directory}")
+
+    endpoint = getattr(backend or DEFAULT_BACKEND, 'endpoint', None)
+    journal = UploadJournal(journal_path(directory), project.id, endpoint)
+    print(f"Recording upload progress in {journal.path}")
+    if journal.n_ignored:
+        print(f"Ignoring {journal.n_ignored} journal records of uploads to another project or endpoint")
+
+    plan = plan_upload(n_files, span, step, subject_set_size)
+    names = subject_set_names(plan, file_list, z, span, step)
+    media_cache = MediaCache(cache_bytes) if cache_bytes else None
+    encoder = BudgetEncoder(file_list, max_image_bytes, downscale=downscale) if max_image_bytes else None
+    successful_uploads = 0
+    failed_subjects = 0
+    n_subjects = len(plan.centre)
+    n_finished = 0
+    try:
+        for counter, (list_start, list_end, subject_set_name) in enumerate(zip(plan.set_start, plan.set_stop,
+                                                                              names)):
+            list_start, list_end = int(list_start), int(list_end)
+            n_set_subjects = list_end - list_start + 1
+            print(f"\n*******\nStep {counter}")
+            print(f"List start (centre index): {list_start}\n"
+                  f"List end (centre index): {list_end}\n"
+                  f"Indices to be included: {subject_members(list_start, span, step)}\n\n"
+                  f"Filename: {os.path.basename(file_list[list_start])}\n")
+            print(subject_set_name)
+
+            journal.plan_subject_set(subject_set_name)
+            # Completed sets cost no request, so resuming scales with the work left
+            if journal.subject_set_state(subject_set_name) == LINKED:
+                print(f"Subject set {subject_set_name} was completed by a previous upload, skipping\n\n")
+                successful_uploads += 1
+                n_finished += n_set_subjects
+                yield n_finished, n_subjects
+                continue
+
+            subject_set_id = journal.subject_set_id(subject_set_name)
+            subject_set = None
+            if subject_set_id is not None:
+                try:
+                    subject_set = find_subject_set(subject_set_id, backend)
+                except Exception as e:
+                    if status_code(e) != 404:
+                        print(f"Subject set {subject_set_name} ({subject_set_id}) could not be found ({e}), "
+                              f"skipping its {n_set_subjects} subjects\n\n")
+                        failed_subjects += n_set_subjects
+                        n_finished += n_set_subjects
+                        yield n_finished, n_subjects
+                        continue
+                    print(f"Subject set {subject_set_name} ({subject_set_id}) no longer exists, "
+                          f"uploading it again")
+                    journal.reset_subject_set(subject_set_name)
+
+            if subject_set is not None:
+                print(f"Resuming subject set {subject_set_name} ({subject_set_id})\n\n")
+            else:
+                try:
+                    subject_set = initialise_subject_set(project, subject_set_name, backend)
+                except Exception as e:
+                    print(f"Subject set {subject_set_name} could not be created ({e}), "
+                          f"skipping its {n_set_subjects} subjects\n\n")
+                    failed_subjects += n_set_subjects
+                    n_finished += n_set_subjects
+                    yield n_finished, n_subjects
+                    continue
+                journal.subject_set_saved(subject_set_name, subject_set.id)
+                print(f"Creating subject set name {subject_set_name}\n\n")
+
+            succeeded, failed = {}, {}
+            for centre_idx, subject, error in iter_upload_subject_set(project, subject_set, file_list,
+                                                                      list_start, list_end, span, step,
+                                                                      n_workers=n_workers, journal=journal,
+                                                                      subject_set_name=subject_set_name,
+                                                                      backend=backend, media_cache=media_cache,
+                                                                      encoder=encoder):
+                if centre_idx not in succeeded and centre_idx not in failed:
+                    n_finished += 1
+                if error is None:
+                    succeeded[centre_idx] = subject
+                    failed.pop(centre_idx, None)
+                else:
+                    failed[centre_idx] = error
+                    succeeded.pop(centre_idx, None)
+                yield n_finished, n_subjects
+
+            for centre_idx, error in sorted(failed.items()):
+                print(f"Subject centred on file {centre_idx} of {subject_set_name} failed: {error}")
+            print(f"{len(succeeded)} subjects uploaded, {len(failed)} failed for {subject_set_name}")
+            failed_subjects += len(failed)
+            if failed:
+                continue
+            journal.subject_set_linked(subject_set_name)
+            successful_uploads += 1
+    finally:
+        journal.close()
+
+    if media_cache is not None:
+        print(media_cache.summary())
+    print(f"Done, I have processed {successful_uploads} subject sets")
+    return successful_uploads, failed_subjects
+
+
+def connect(username, password, project_slug, backend=None, n_workers=16):
+    """
+    Log in to Zooniverse.
+
+    :param n_workers: most requests the default backend makes at once.
+    :return: the project and the backend to upload it with.
+    """
+    backend = backend or ScheduledBackend(PanoptesBackend(), RequestScheduler(max_concurrency=n_workers))
+    backend.connect(username=username, password=password)
+    return backend.find_project(project_slug), backend
+
+
+def upload(directory, username, password, project_slug, span=2, step=10, subject_set_size=5, n_workers=16,
+           backend=None, cache_bytes=DEFAULT_CACHE_BYTES, max_image_bytes=None, downscale=True):
+    """
+    Log in to Zooniverse and upload a tile directory as subject sets.
+
+    :return: number of subject sets completed and of subjects failed.
+    """
+    project, backend = connect(username, password, project_slug, backend, n_workers)
+    run = iter_upload(project, directory, span, step, subject_set_size, n_workers=n_workers, backend=backend,
+                      cache_bytes=cache_bytes, max_image_bytes=max_image_bytes, downscale=downscale)
+    while True:
+        try:
+            next(run)
+        except StopIteration as e:
+            return e.value
+
+
+def plan_report(directory, span, step, subject_set_size, max_image_bytes=None):
+    """
+    Plan an upload of `directory` without contacting Zooniverse. With
+    `max_image_bytes` images are counted at most that size, as the
+    budgeted encoding would upload them.
+
+    :return: summary of the requests and bytes the upload would send.
+    """
+    file_list, z = load_image_list(directory)
+    manifest = read_manifest(directory)
+    if manifest is not None:
+        nbytes = manifest['nbytes']
+    else:
+        nbytes = np.array([os.path.getsize(f) for f in file_list], dtype=np.int64)
+    if max_image_bytes:
+        nbytes = np.minimum(nbytes, max_image_bytes)
+
+    plan = plan_upload(len(file_list), span, step, subject_set_size)
+    for name, start, stop in zip(subject_set_names(plan, file_list, z, span, step),
+                                 plan.set_start, plan.set_stop):
+        print(f"{name}: subjects centred on files {start}-{stop}")
+    estimate = estimate_upload(plan, nbytes)
+    report = (f"Dry run: {estimate['subject sets']} subject sets, {estimate['subjects']} subjects, "
+              f"{estimate['media files']} media files, ~{estimate['requests']} requests, "
+              f"{estimate['bytes'] / 1e6:.1f} MB")
+    print(report)
+    return report
+
+
+def tile_directories(output_path, output_format='jpeg'):
+    """
+    :return: sorted subject set directories, or OME-Zarr tile groups,
+             written by `preprocess` to `output_path`, without the tiles
+             it skipped.
+    """
+    output_path = output_store(output_path, output_format)
+    skipped = read_skipped_tiles(output_path)
+    return sorted(entry.path for entry in os.scandir(output_path) if entry.is_dir() and entry.name not in skipped)
+
+
+def run_config(config, password=None):
+    """
+    Run the `preprocess` and then the `upload` section of a config, each
+    if present. Without `directories`, the upload section uploads every
+    tile directory the preprocess section wrote; a sharded preprocess
+    section has to be merged first, so it needs `directories`.
+
+        preprocess:
+          image: volume.npy      # .npy, .tif or .zarr, `key` for a zarr group,
+                                 # .raw with `shape: [z, y, x]` and `dtype`
+          output: export
+          n_tiles: [4, 4]        # or rois: [[min row, min col, max row, max col], ...]
+          slab_size: 16
+          workers: 8
+          shard: [0, 4]          # optional, or z_range: [0, 500] and tile_indices: [0, 1]
+          format: jpeg           # or zarr
+          force: false           # write every image again, even if it is up to date
+          filter:                # optional, skip empty tiles, see filter_tiles
+            min_std: 5
+            background: 230
+            tolerance: 20
+            min_foreground: 0.05
+        upload:
+          project: user/project
+          username: user         # password from ZOONIVERSE_PASSWORD
+          span: 2
+          step: 10
+          subject_set_size: 5
+          workers: 16
+          cache_mb: 256          # media cache shared by overlapping subjects, 0 to disable
+          max_image_kb: 150      # optional, re-encode images to at most this size, see BudgetEncoder
+          downscale: true        # whether images may also be shrunk to fit max_image_kb
+
+    :param config: dict of the config file.
+    :param password: Zooniverse password, overriding the config.
+    :return: dict with the result of each section run.
+    """
+    results = {}
+    section = config.get('preprocess')
+    if section is not None:
+        image = open_volume(section['image'], section.get('key'), section.get('shape'), section.get('dtype'))
+        results['preprocess'] = preprocess(image, section['output'],
+                                           rois=section.get('rois'),
+                                           n_tiles=section.get('n_tiles'),
+                                           slab_size=section.get('slab_size', 16),
+                                           n_workers=section.get('workers', 4),
+                                           shard=section.get('shard'),
+                                           z_range=section.get('z_range'),
+                                           tile_indices=section.get('tile_indices'),
+                                           output_format=section.get('format', 'jpeg'),
+                                           tile_filter=section.get('filter'),
+                                           incremental=not section.get('force', False))
+
+    section = config.get('upload')
+    if section is not None:
+        directories = section.get('directories')
+        if directories is None:
+            preprocess_section = config.get('preprocess')
+            if preprocess_section is None or any(preprocess_section.get(key) is not None
+                                                 for key in ('shard', 'z_range', 'tile_indices')):
+                raise ValueError("upload needs `directories` without a complete preprocess section")
+            directories = tile_directories(preprocess_section['output'], preprocess_section.get('format', 'jpeg'))
+        project, backend = connect(section['username'], password or section.get('password'), section['project'],
+                                   n_workers=section.get('workers', 16))
+
+        results['upload'] = {}
+        for directory in directories:
+            run = iter_upload(project, directory,
+                              section.get('span', 2),
+                              section.get('step', 10),
+                              section.get('subject_set_size', 5),
+                              n_workers=section.get('workers', 16),
+                              backend=backend,
+                              cache_bytes=int(section.get('cache_mb', DEFAULT_CACHE_BYTES / 2 ** 20) * 2 ** 20),
+                              max_image_bytes=int(section['max_image_kb'] * 1e3) if section.get('max_image_kb')
+                              else None,
+                              downscale=section.get('downscale', True))
+            while True:
+                try:
+                    next(run)
+                except StopIteration as e:
+                    results['upload'][directory] = e.value
+                    break
+    return results
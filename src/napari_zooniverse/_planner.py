@@ -0,0 +1,92 @@
+from collections import namedtuple
+import numpy as np
+
+# Indices are positions in the z-sorted image list of a tile directory.
+#   centre:      (n_subjects,) list index of each subject's centre image
+#   subject_set: (n_subjects,) subject set each subject belongs to
+#   members:     (n_subjects, 2 * span + 1) list indices of each subject's images
+#   set_start:   (n_sets,) centre index of the first subject of each set
+#   set_stop:    (n_sets,) centre index of the last subject of each set, inclusive
+UploadPlan = namedtuple('UploadPlan', ['centre', 'subject_set', 'members', 'set_start', 'set_stop'])
+
+
+def subject_members(centre_idx, span, step):
+    """
+    :return: list indices of the images of the subject centred on `centre_idx`.
+    """
+    return centre_idx + step * np.arange(-span, span + 1)
+
+
+def centre_bounds(n_files, span, step):
+    """
+    Only images with a full window of images either side can be the
+    centre of a subject.
+
+    :return: first and one past the last list index that can be a centre.
+    """
+    first = span * step
+    return first, max(first, n_files - span * step)
+
+
+def plan_upload(n_files, span, step, subject_set_size):
+    """
+    Plan every subject and subject set of a tile directory. Each subject
+    is `2 * span + 1` images, `step` apart, centred on one image; only
+    images with a full window either side can be centres. Consecutive
+    centres are grouped into subject sets of `subject_set_size`, the
+    last set taking what is left.
+
+    :param n_files: number of images in the directory.
+    :param span: number of images either side of the centre image.
+    :param step: distance in images between the images of a subject.
+    :param subject_set_size: number of subjects per subject set.
+    :return: UploadPlan of NumPy index arrays.
+    """
+    first, stop = centre_bounds(n_files, span, step)
+    centre = np.arange(first, stop, dtype=np.int64)
+    subject_set = (centre - first) // subject_set_size
+    set_start = centre[::subject_set_size]
+    set_stop = np.minimum(set_start + subject_set_size - 1, centre[-1] if len(centre) else first)
+    return UploadPlan(centre=centre,
+                      subject_set=subject_set,
+                      members=subject_members(centre[:, np.newaxis], span, step),
+                      set_start=set_start,
+                      set_stop=set_stop)
+
+
+def subject_set_names(plan, file_list, z, span, step):
+    """
+    :param plan: UploadPlan.
+    :param file_list: z-sorted image paths the plan indexes.
+    :param z: z index of each image.
+    :return: display name of each planned subject set.
+    """
+    names = []
+    for start, stop in zip(plan.set_start, plan.set_stop):
+        prefix = file_list[start].replace('\\', '/').rsplit('/', 1)[-1].rsplit('_z', 1)[0]
+        names.append(f"{span}_{step}_{prefix}_z{z[start]}-{z[stop]:04d}")
+    return names
+
+
+def estimate_upload(plan, nbytes, batch_size=50):
+    """
+    Requests and bytes an upload of `plan` will send, before anything is
+    sent: one request per subject set, one per subject and one per media
+    file, plus one per batch of links.
+
+    :param plan: UploadPlan.
+    :param nbytes: size in bytes of every image in the list.
+    :param batch_size: number of subjects linked per request.
+    :return: dict with the numbers of subject sets, subjects, media
+             files and requests, and the number of bytes.
+    """
+    subjects_per_set = plan.set_stop - plan.set_start + 1
+    n_links = int(np.sum(-(-subjects_per_set // batch_size)))
+    n_media = plan.members.size
+    return {
+        'subject sets': len(plan.set_start),
+        'subjects': len(plan.centre),
+        'media files': n_media,
+        'requests': len(plan.set_start) + len(plan.centre) + n_media + n_links,
+        'bytes': int(np.asarray(nbytes, dtype=np.int64)[plan.members].sum()),
+    }
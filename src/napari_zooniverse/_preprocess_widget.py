@@ -1,8 +1,11 @@
 import os
 import warnings
 import cv2
+import dask.array as da
 import numpy as np
 from napari.layers import Image, Shapes
+from napari.qt.threading import thread_worker
+from napari.utils.notifications import show_info
 from pathlib import Path
 from qtpy.QtGui import QFont
 from qtpy.QtWidgets import (QHBoxLayout,
@@ -13,12 +16,16 @@ from qtpy.QtWidgets import (QHBoxLayout,
                             QLabel,
                             QComboBox,
                             QSpinBox,
+                            QDoubleSpinBox,
                             QFileDialog,
+                            QInputDialog,
                             QLineEdit)
 from skimage.color import rgb2gray
-from skimage.io import imsave
 from superqt import QCollapsible
-from ._utils import make_widget, set_border
+from ._export import roi_tiles, grid_tiles
+from ._pipeline import open_volume, iter_preprocess, merge
+from ._qt_utils import make_widget, set_border, ProgressWidget
+from ._utils import lazy_volume
 
 
 class PreprocessWidget(QWidget):
@@ -43,6 +50,14 @@ class PreprocessWidget(QWidget):
         image_select_w, self.image_select = make_widget(annotation=Image, label="Image")
         image_select_w.setToolTip('The selected image used for preprocessing.')
         self.layout().addWidget(image_select_w)
+
+        # OPEN VOLUME FROM DISK
+        self.open_volume_button = QPushButton("Open Volume")
+        self.open_volume_button.setToolTip('Open a .npy, .raw, .tif or .zarr volume without loading it into memory. '
+                                           'Only the slices and tiles used are read.')
+        self.open_volume_button.clicked.connect(self._open_volume)
+        set_border(self.open_volume_button)
+        self.layout().addWidget(self.open_volume_button)
         napari_viewer.layers.selection.events.changed.connect(self._on_selection)
 
         # TILING/ROI COLLAPSABLE
@@ -109,9 +124,114 @@ class PreprocessWidget(QWidget):
         self.tile_collapse.addWidget(self.preview_tiling_button)
         set_border(self.preview_tiling_button)
 
+        # SKIP EMPTY TILES
+        filter_widget = QWidget()
+        filter_widget.setLayout(QHBoxLayout())
+        set_border(filter_widget)
+        self.filter_checkbox = QCheckBox("Skip Empty Tiles")
+        filter_widget.layout().addWidget(self.filter_checkbox)
+        filter_widget.layout().addWidget(QLabel("Min Std"))
+        self.filter_min_std = QDoubleSpinBox()
+        self.filter_min_std.setRange(0, 1e6)
+        self.filter_min_std.setValue(5)
+        filter_widget.layout().addWidget(self.filter_min_std)
+        filter_widget.setToolTip('Leave out tiles whose intensity varies less than Min Std, measured on a '
+                                 'sample of z slices. Skipped tiles are recorded and never uploaded.')
+        self.tile_collapse.addWidget(filter_widget)
+
+        foreground_widget = QWidget()
+        foreground_widget.setLayout(QHBoxLayout())
+        set_border(foreground_widget)
+        self.filter_foreground_checkbox = QCheckBox("Background")
+        foreground_widget.layout().addWidget(self.filter_foreground_checkbox)
+        self.filter_background = QDoubleSpinBox()
+        self.filter_background.setRange(-1e9, 1e9)
+        self.filter_background.setValue(255)
+        foreground_widget.layout().addWidget(self.filter_background)
+        foreground_widget.layout().addWidget(QLabel("±"))
+        self.filter_tolerance = QDoubleSpinBox()
+        self.filter_tolerance.setRange(0, 1e9)
+        self.filter_tolerance.setValue(10)
+        foreground_widget.layout().addWidget(self.filter_tolerance)
+        foreground_widget.layout().addWidget(QLabel("Min Foreground (%)"))
+        self.filter_min_foreground = QDoubleSpinBox()
+        self.filter_min_foreground.setRange(0, 100)
+        self.filter_min_foreground.setValue(5)
+        foreground_widget.layout().addWidget(self.filter_min_foreground)
+        foreground_widget.setToolTip('Also leave out tiles where fewer pixels than Min Foreground differ from the '
+                                     'background intensity, e.g. of resin, by more than the tolerance.')
+        self.tile_collapse.addWidget(foreground_widget)
+
         set_border(self.tile_collapse)
         self.layout().addWidget(self.tile_collapse)
 
+        # SLAB SIZE
+        slab_widget = QWidget()
+        slab_widget.setLayout(QHBoxLayout())
+        set_border(slab_widget)
+        slab_widget.layout().addWidget(QLabel("Slab Size (z)"))
+        self.slab_size = QSpinBox()
+        self.slab_size.setRange(1, 4096)
+        self.slab_size.setValue(16)
+        slab_widget.setToolTip('Number of z slices read from the image at once while exporting.')
+        slab_widget.layout().addWidget(self.slab_size)
+        self.layout().addWidget(slab_widget)
+
+        # ENCODING WORKERS
+        workers_widget = QWidget()
+        workers_widget.setLayout(QHBoxLayout())
+        set_border(workers_widget)
+        workers_widget.layout().addWidget(QLabel("Encoding Workers"))
+        self.workers_value = QSpinBox()
+        self.workers_value.setRange(1, 256)
+        self.workers_value.setValue(min(os.cpu_count() or 1, 8))
+        workers_widget.setToolTip('Number of JPEG images encoded and written at the same time.')
+        workers_widget.layout().addWidget(self.workers_value)
+        self.layout().addWidget(workers_widget)
+
+        # OUTPUT FORMAT
+        format_widget = QWidget()
+        format_widget.setLayout(QHBoxLayout())
+        set_border(format_widget)
+        format_widget.layout().addWidget(QLabel("Output Format"))
+        self.format_select = QComboBox()
+        self.format_select.addItem("JPEG", 'jpeg')
+        self.format_select.addItem("OME-Zarr", 'zarr')
+        format_widget.setToolTip('JPEG writes one file per tile and z slice. OME-Zarr writes one chunked store, '
+                                 'the JPEGs are encoded when uploading.')
+        format_widget.layout().addWidget(self.format_select)
+        self.layout().addWidget(format_widget)
+
+        # FORCE REWRITE
+        force_widget = QWidget()
+        force_widget.setLayout(QHBoxLayout())
+        set_border(force_widget)
+        self.force_checkbox = QCheckBox("Rewrite Up To Date Images")
+        force_widget.layout().addWidget(self.force_checkbox)
+        force_widget.setToolTip('Images whose source planes have not changed since the last export are skipped '
+                                'unless this is checked.')
+        self.layout().addWidget(force_widget)
+
+        # SHARD
+        shard_widget = QWidget()
+        shard_widget.setLayout(QHBoxLayout())
+        set_border(shard_widget)
+        shard_widget.layout().addWidget(QLabel("Shard"))
+        self.shard_index = QSpinBox()
+        self.shard_index.setRange(0, 0)
+        shard_widget.layout().addWidget(self.shard_index)
+        shard_widget.layout().addWidget(QLabel("of"))
+        self.shard_count = QSpinBox()
+        self.shard_count.setRange(1, 4096)
+        self.shard_count.valueChanged.connect(lambda count: self.shard_index.setMaximum(count - 1))
+        shard_widget.layout().addWidget(self.shard_count)
+        self.merge_button = QPushButton("Merge Shards")
+        self.merge_button.clicked.connect(self._merge)
+        shard_widget.layout().addWidget(self.merge_button)
+        shard_widget.setToolTip('Export only this share of the tiles and z slices, e.g. one node of a cluster. '
+                                'Merge Shards once every shard has finished.')
+        self.layout().addWidget(shard_widget)
+
         # OUTPUT DIRECTORY FILE DIALOGUE
         # ------------------------------
         # OPEN FILE DIALOGUE
@@ -131,6 +251,11 @@ class PreprocessWidget(QWidget):
         self.preprocess_button.clicked.connect(self._preprocess)
         self.layout().addWidget(self.preprocess_button)
 
+        # EXPORT PROGRESS
+        # ---------------
+        self.progress = ProgressWidget()
+        self.layout().addWidget(self.progress)
+
     def _roi_on_click(self):
         if self.roi_checkbox.isChecked():
             self.tiling_checkbox.setChecked(False)
@@ -161,14 +286,18 @@ class PreprocessWidget(QWidget):
             warnings.warn("Image not selected")
             return
 
-        image = np.array(self.image_select.value.data)
-
-        if image.ndim == 2:
-            print(image.reshape((1,) + image.shape).shape)
-        elif image.ndim == 3 & image.shape[2] == 3:
-            image = rgb2gray(image)
-            image = image.reshape((1,) + image.shape)
-            print(image.shape)
+        # Lazy one chunk per z slice, only the slices napari displays are read
+        layer = self.image_select.value
+        image = layer.data
+        # napari keeps the colour channels of an RGB(A) layer on its last axis
+        if image.ndim == (3 if layer.rgb else 2):
+            image = image[np.newaxis]
+        image = lazy_volume(image)
+        if layer.rgb:
+            # Converted slice by slice as napari reads them
+            image = image[..., :3].map_blocks(rgb2gray, drop_axis=3, dtype=np.float64,
+                                              meta=np.empty((0, 0, 0), dtype=np.float64))
+        print(image.shape)
 
         if self.roi_checkbox.isChecked():
             if self.roi_select.currentText() is None:
@@ -177,13 +306,13 @@ class PreprocessWidget(QWidget):
 
             shapes = self.viewer.layers[self.roi_select.currentText()].data
             shape_types = self.viewer.layers[self.roi_select.currentText()].shape_type
-            mask = np.zeros(image[0].shape)
+            mask = np.zeros(image.shape[1:], dtype=np.uint8)
             for shape_count, [shape, shape_type] in enumerate(zip(shapes,
                                                                   shape_types)):
                 shape = np.array(shape[:, 1:], dtype=np.int32)
                 shape = np.array([shape[i][::-1] for i in range(len(shape))])
                 cv2.fillPoly(mask, [shape], 1)
-            self.viewer.add_image(image * mask)
+            self.viewer.add_image(da.where(mask.astype(bool), image, 0))
             return
 
         if self.tiling_checkbox.isChecked():
@@ -192,16 +321,71 @@ class PreprocessWidget(QWidget):
             x = self.tiling_n_tiles_x.value()
             y = self.tiling_n_tiles_y.value()
 
-            image_w_grid = []
-            for i in range(len(image)):
-                im = image[i]
-                dx, dy = round(im.shape[0] / y), round(im.shape[1] / x)
-                im[:, ::dy] = 0
-                im[::dx, :] = 0
-                image_w_grid.append(im)
+            grid = np.zeros(image.shape[1:], dtype=bool)
+            dx, dy = round(image.shape[1] / y), round(image.shape[2] / x)
+            grid[:, ::dy] = True
+            grid[::dx, :] = True
+            self.viewer.add_image(da.where(grid, 0, image))
+            return
+
+    def _open_volume(self):
+        """
+        Open a volume file as a memory-mapped or chunked array and add it
+        as an image layer. Nothing but the middle slice, for the contrast
+        limits, is read until napari displays a slice or it is exported.
+        """
+        path, _ = QFileDialog.getOpenFileName(self, 'Open Volume', str(Path),
+                                              'Volumes (*.npy *.raw *.bin *.tif *.tiff *.zarr .zarray)')
+        if path == '':
+            return
+        if os.path.basename(path) == '.zarray':
+            path = os.path.dirname(path)
 
-            self.viewer.add_image(np.asarray(image_w_grid))
+        shape = dtype = None
+        if path.lower().endswith(('.raw', '.bin')):
+            text, ok = QInputDialog.getText(self, 'Raw Volume', 'Shape (z y x) and dtype, e.g. 500 2048 2048 uint16')
+            if not ok:
+                return
+            *shape, dtype = text.replace(',', ' ').split()
+            shape = tuple(int(n) for n in shape)
+
+        try:
+            volume = open_volume(path, shape=shape, dtype=dtype)
+            if hasattr(volume, 'visititems'):
+                # A zarr group, e.g. an OME-Zarr image: open one of its arrays
+                key = self._choose_zarr_array(volume)
+                if key is None:
+                    return
+                volume = volume[key]
+        except Exception as e:
+            show_info(f"Could not open {path}: {e}")
             return
+        middle = np.asarray(volume[volume.shape[0] // 2])
+        contrast_limits = [float(middle.min()), float(middle.max())]
+        if contrast_limits[0] == contrast_limits[1]:
+            contrast_limits[1] += 1
+        # Volumes are (z, row, column), never RGB even when 3 or 4 columns wide
+        layer = self.viewer.add_image(volume, name=os.path.basename(path.rstrip('/\\')),
+                                      contrast_limits=contrast_limits, rgb=False)
+        self.image_select.reset_choices()
+        if layer in self.image_select.choices:
+            self.image_select.value = layer
+
+    def _choose_zarr_array(self, group):
+        """
+        :return: path of the array of a zarr group to open, asking which
+                 one when it holds several; None if there is none or the
+                 user cancels.
+        """
+        keys = []
+        group.visititems(lambda name, item: keys.append(name) if getattr(item, 'ndim', 0) >= 2 else None)
+        if not keys:
+            show_info("The zarr group holds no image arrays")
+            return None
+        if len(keys) == 1:
+            return keys[0]
+        key, ok = QInputDialog.getItem(self, 'Zarr Group', 'Array to open', keys, 0, False)
+        return key if ok else None
 
     def _on_selection(self, event=None):
         """
@@ -226,70 +410,63 @@ class PreprocessWidget(QWidget):
             warnings.warn("Image not selected")
             return
 
-        image = np.array(self.image_select.value.data)
+        # Layer data is only read tile by tile, so dask/zarr layers are never loaded whole
+        image = self.image_select.value.data
 
         if self.roi_checkbox.isChecked():
             if self.roi_select.currentText() == "":
                 warnings.warn("No Shapes ROI selected")
                 return
 
-            shapes = self.viewer.layers[self.roi_select.currentText()].data
-
-            output_path = self._open_file_path.text()
-            if output_path == '':
-                warnings.warn("Output directory not selected")
-                return
-            output_path += '/subject_sets'
-
-            if not os.path.exists(output_path):
-                os.mkdir(output_path)
-
-            for shape in shapes:
-                shape = np.array(shape[:, 1:], dtype=np.int32)
-                print(shape.shape)
-                print(shape)
-
-                min_y, max_y = shape[0][0], shape[2][0]
-                min_x, max_x = shape[0][1], shape[1][1]
-
-                subject_path = output_path + '/image_x{0}_y{1}'.format(str(min_x).rjust(4, "0"),
-                                                                       str(min_y).rjust(4, "0"))
-
-                os.mkdir(subject_path)
-
-                for i in range(len(image)):
-                    imsave(subject_path + '/image_x{0}_y{1}_z{2}.jpeg'.format(str(min_x).rjust(4, "0"),
-                                                                              str(min_y).rjust(4, "0"),
-                                                                              str(i).rjust(4, "0"))
-                           , image[i][min_y:max_y, min_x:max_x])
-
-        if self.tiling_checkbox.isChecked():
-            x = self.tiling_n_tiles_x.value()
-            y = self.tiling_n_tiles_y.value()
+            tiles = roi_tiles(self.viewer.layers[self.roi_select.currentText()].data)
+        elif self.tiling_checkbox.isChecked():
+            tiles = grid_tiles(image.shape, self.tiling_n_tiles_x.value(), self.tiling_n_tiles_y.value())
+        else:
+            return
 
-            output_path = self._open_file_path.text()
-            if output_path == '':
-                warnings.warn("Output directory not selected")
-                return
-            output_path += '/subject_sets'
-
-            if not os.path.exists(output_path):
-                os.mkdir(output_path)
-
-            M = image.shape[1] // x
-            N = image.shape[2] // y
-            for y in range(0, image.shape[2], N):
-                for x in range(0, image.shape[1], M):
-                    tile = np.asarray(image[:, x:x + M, y:y + N])
-                    if tile.shape[1] == M and tile.shape[2] == N:
-                        subject_path = output_path + '/image_x{0}_y{1}'.format(str(x).rjust(4, "0"),
-                                                                               str(y).rjust(4, "0"))
-                        os.mkdir(subject_path)
-                        for z in range(len(tile)):
-                            file_name = "img_x{}_y{}_z{}.jpeg".format(str(x).rjust(4, "0"),
-                                                                      str(y).rjust(4, "0"),
-                                                                      str(z).rjust(4, "0"))
-                            imsave(subject_path + '/' + file_name, tile[z])
+        output_path = self._open_file_path.text()
+        if output_path == '':
+            warnings.warn("Output directory not selected")
+            return
+        shard = None
+        if self.shard_count.value() > 1:
+            shard = (self.shard_index.value(), self.shard_count.value())
+        tile_filter = None
+        if self.filter_checkbox.isChecked():
+            tile_filter = {'min_std': self.filter_min_std.value()}
+            if self.filter_foreground_checkbox.isChecked():
+                tile_filter.update(background=self.filter_background.value(),
+                                   tolerance=self.filter_tolerance.value(),
+                                   min_foreground=self.filter_min_foreground.value() / 100)
+        worker = thread_worker(iter_preprocess)(image, output_path, tiles,
+                                                slab_size=self.slab_size.value(),
+                                                n_workers=self.workers_value.value(),
+                                                shard=shard,
+                                                output_format=self.format_select.currentData(),
+                                                tile_filter=tile_filter,
+                                                incremental=not self.force_checkbox.isChecked())
+        worker.returned.connect(show_info)
+        self._start(worker, "Exporting tiles", unit="files")
+
+    def _start(self, worker, description, unit="items"):
+        # The progress bar follows one worker, so exporting and merging wait for each other
+        worker.finished.connect(lambda: self._set_busy(False))
+        self._set_busy(True)
+        self.progress.start(worker, description, unit=unit)
+
+    def _set_busy(self, busy):
+        for button in (self.preprocess_button, self.merge_button):
+            button.setEnabled(not busy)
+
+    def _merge(self):
+        output_path = self._open_file_path.text()
+        if output_path == '':
+            warnings.warn("Output directory not selected")
+            return
+        worker = thread_worker(merge)(output_path)
+        worker.returned.connect(show_info)
+        worker.errored.connect(lambda e: show_info(str(e)))
+        self._start(worker, "Merging shards")
 
     def open_file_dialogue(self):
         """
@@ -0,0 +1,104 @@
+import time
+from qtpy.QtWidgets import (QLabel,
+                            QWidget,
+                            QHBoxLayout,
+                            QVBoxLayout,
+                            QProgressBar,
+                            QPushButton)
+from magicgui.widgets import create_widget
+from napari.utils.notifications import show_info
+
+
+def make_widget(annotation, label):
+    w = QWidget()
+    w.setLayout(QHBoxLayout())
+    w.layout().addWidget(QLabel(label))
+
+    magic_w = create_widget(annotation=annotation, label=label)
+    w.layout().addWidget(magic_w.native)
+
+    set_border(w)
+
+    return w, magic_w
+
+
+def set_border(widget: QWidget, spacing=2, margin=0):
+    if hasattr(widget.layout(), "setContentsMargins"):
+        widget.layout().setContentsMargins(margin, margin, margin, margin)
+    if hasattr(widget.layout(), "setSpacing"):
+        widget.layout().setSpacing(spacing)
+
+
+class ProgressWidget(QWidget):
+    """
+    Progress bar, ETA and cancel button for a napari generator worker
+    that yields (done, total, ...) tuples. Hidden while no worker is
+    running.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.setLayout(QVBoxLayout())
+        set_border(self)
+
+        self.label = QLabel()
+        self.layout().addWidget(self.label)
+
+        bar_widget = QWidget()
+        bar_widget.setLayout(QHBoxLayout())
+        set_border(bar_widget)
+        self.bar = QProgressBar()
+        bar_widget.layout().addWidget(self.bar)
+        self.cancel_button = QPushButton("Cancel")
+        bar_widget.layout().addWidget(self.cancel_button)
+        self.layout().addWidget(bar_widget)
+
+        self.worker = None
+        self.cancel_button.clicked.connect(self.cancel)
+        self.setVisible(False)
+
+    def start(self, worker, description, unit="items"):
+        """
+        Show progress for `worker` and start it.
+
+        :param worker: napari GeneratorWorker or FunctionWorker.
+        :param description: text shown above the progress bar.
+        :param unit: name of the counted units of work.
+        """
+        self.worker = worker
+        self._description = description
+        self._unit = unit
+        self._start_time = time.perf_counter()
+
+        self.label.setText(description)
+        self.bar.setRange(0, 0)
+        self.setVisible(True)
+
+        # Only generator workers report progress and can stop part way
+        cancellable = hasattr(worker, 'yielded')
+        self.cancel_button.setEnabled(cancellable)
+        if cancellable:
+            worker.yielded.connect(self.update_progress)
+            worker.aborted.connect(lambda: show_info(f"{description} cancelled"))
+        worker.finished.connect(self._on_finished)
+        worker.start()
+
+    def update_progress(self, progress):
+        done, total = progress[:2]
+        self.bar.setRange(0, total)
+        self.bar.setValue(done)
+        elapsed = time.perf_counter() - self._start_time
+        eta = elapsed / done * (total - done) if done else 0
+        self.label.setText(f"{self._description}: {done}/{total} {self._unit}, "
+                           f"ETA {time.strftime('%H:%M:%S', time.gmtime(eta))}")
+
+    def cancel(self):
+        """Ask the worker to stop after its current unit of work."""
+        if self.worker is not None:
+            self.cancel_button.setEnabled(False)
+            self.label.setText(f"{self._description}: cancelling...")
+            self.worker.quit()
+
+    def _on_finished(self):
+        self.worker = None
+        self.setVisible(False)
@@ -0,0 +1,202 @@
+import random
+import re
+import threading
+import time
+from ._backend import save_subject
+
+# Status codes of requests the server did not handle and that can succeed later
+RETRYABLE_STATUS = (408, 429, 500, 502, 503, 504)
+# panoptes_client reports server errors it gave up retrying only by their message
+_STATUS_MESSAGE = re.compile(r'Received HTTP status code (\d+)')
+
+
+def status_code(error):
+    """
+    :return: HTTP status code of the response that caused `error`, or None.
+    """
+    status = getattr(error, 'status_code', None)
+    response = getattr(error, 'response', None)
+    if status is None and response is not None:
+        status = getattr(response, 'status_code', None)
+    if status is None:
+        match = _STATUS_MESSAGE.search(str(error))
+        status = int(match.group(1)) if match else None
+    return status
+
+
+def retry_after(error):
+    """
+    :return: seconds the server asked to wait before retrying, or None.
+    """
+    headers = getattr(error, 'headers', None)
+    response = getattr(error, 'response', None)
+    if headers is None and response is not None:
+        headers = getattr(response, 'headers', None)
+    value = (headers or {}).get('Retry-After')
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        # HTTP-date form of Retry-After, fall back to backoff
+        return None
+
+
+def _is_connection_error(error, refused_only=False):
+    from requests.exceptions import ConnectionError as RequestsConnectionError, ConnectTimeout, Timeout
+    if refused_only:
+        return isinstance(error, (ConnectionRefusedError, ConnectTimeout))
+    return isinstance(error, (ConnectionError, TimeoutError, RequestsConnectionError, Timeout))
+
+
+def is_retryable(error):
+    """
+    :return: whether a request that failed with `error` can succeed when
+             it is made again, from the status code of the response.
+    """
+    status = status_code(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    return _is_connection_error(error)
+
+
+def is_refused(error):
+    """
+    :return: whether a request that failed with `error` was certainly
+             not handled by the server, so that even a request that is
+             not idempotent, like creating a subject, can be made again.
+    """
+    if status_code(error) == 429:
+        return True
+    return _is_connection_error(error, refused_only=True)
+
+
+class RequestScheduler:
+    """
+    Runs Zooniverse requests with retries and an adaptive concurrency
+    limit shared by every thread.
+
+    Failed requests that can succeed on a retry are retried with
+    exponential backoff and full jitter, waiting at least as long as a
+    Retry-After sent by the server. The number of requests in flight
+    follows additive increase, multiplicative decrease: it grows by
+    about one per round of successful requests and halves when the
+    server throttles, errors or slows to more than `latency_factor`
+    times the fastest latency seen for the same kind of request, so
+    throughput settles just under what the server accepts.
+
+    :param initial_concurrency: requests in flight to start with.
+    :param min_concurrency: lower bound of the concurrency limit.
+    :param max_concurrency: upper bound of the concurrency limit.
+    :param max_retries: retries before a request's error is raised.
+    :param base_delay: backoff before the first retry, in seconds.
+    :param max_delay: longest backoff, in seconds.
+    :param latency_factor: slowdown treated as congestion.
+    """
+
+    def __init__(self, initial_concurrency=4, min_concurrency=1, max_concurrency=32, max_retries=6,
+                 base_delay=0.5, max_delay=60.0, latency_factor=3.0):
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.latency_factor = latency_factor
+
+        self.limit = float(initial_concurrency)
+        self.in_flight = 0
+        self.n_retries = 0
+        self.min_latency = {}
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    @property
+    def concurrency(self):
+        return max(self.min_concurrency, int(self.limit))
+
+    def _acquire(self):
+        with self._condition:
+            while self.in_flight >= self.concurrency:
+                self._condition.wait()
+            self.in_flight += 1
+
+    def _release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def _increase(self, key, latency):
+        with self._condition:
+            min_latency = self.min_latency[key] = min(latency, self.min_latency.get(key, latency))
+            if latency > self.latency_factor * min_latency:
+                self._decrease_locked()
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    def _decrease(self):
+        with self._condition:
+            self._decrease_locked()
+
+    def _decrease_locked(self):
+        # Requests already in flight when the limit was cut report the same congestion
+        now = time.monotonic()
+        if now - self._last_decrease > max(self.min_latency.values(), default=0.0):
+            self.limit = max(float(self.min_concurrency), self.limit / 2)
+            self._last_decrease = now
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, func, *args, retryable=is_retryable, **kwargs):
+        """
+        Call `func(*args, **kwargs)` once a concurrency slot is free,
+        retrying it while it fails with a retryable error.
+
+        :param retryable: function of an error telling whether to retry.
+        :return: what `func` returns.
+        """
+        for attempt in range(self.max_retries + 1):
+            self._acquire()
+            start_time = time.monotonic()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                self._release()
+                if attempt == self.max_retries or not retryable(e):
+                    raise
+                self._decrease()
+                delay = max(retry_after(e) or 0.0, self.backoff(attempt))
+                with self._condition:
+                    self.n_retries += 1
+                print(f"Zooniverse request failed ({e}), retry {attempt + 1} in {delay:.1f} s")
+                time.sleep(delay)
+                continue
+            self._release()
+            self._increase(getattr(func, '__name__', None), time.monotonic() - start_time)
+            return result
+
+
+class ScheduledBackend:
+    """
+    Zooniverse backend that sends every call of `backend` through a
+    RequestScheduler. Requests creating something are only retried when
+    the server refused them, see is_refused, so that a request that was
+    handled but whose response was lost does not create a duplicate.
+    """
+
+    METHODS = ('connect', 'find_project', 'find_subject_set', 'link_subjects', 'upload_media')
+    CREATE_METHODS = ('create_subject_set', 'create_subject')
+
+    def __init__(self, backend, scheduler=None):
+        self.backend = backend
+        self.scheduler = scheduler or RequestScheduler()
+
+    def __getattr__(self, name):
+        method = getattr(self.backend, name)
+        if name in self.CREATE_METHODS:
+            return lambda *args, **kwargs: self.scheduler.call(method, *args, retryable=is_refused, **kwargs)
+        if name not in self.METHODS:
+            return method
+        return lambda *args, **kwargs: self.scheduler.call(method, *args, **kwargs)
+
+    def save_subject(self, project, locations, metadata):
+        return save_subject(self, project, locations, metadata)
@@ -0,0 +1,162 @@
+import os
+import numpy as np
+from ._manifest import read_manifest
+
+
+def run_tile_shapes(run_directory):
+    """
+    :param run_directory: `subject_sets` directory or the directory holding it.
+    :return: dict of (row, column) tile origin to (rows, columns) tile
+             shape, from the manifests of an export.
+    """
+    for store in (run_directory, os.path.join(run_directory, 'subject_sets')):
+        if not os.path.isdir(store):
+            continue
+        shapes = {}
+        for entry in os.scandir(store):
+            manifest = read_manifest(entry.path) if entry.is_dir() else None
+            if manifest is not None:
+                rows, cols = manifest['rows'], manifest['cols']
+                shapes[(rows[0], cols[0])] = (rows[1] - rows[0], cols[1] - cols[0])
+        if shapes:
+            return shapes
+    return {}
+
+
+class SubjectIndex:
+    """
+    Where every subject of a ClassificationStore sits in the source
+    volume: the origin and extent of its tile and the z of its frames,
+    parsed once from the `Image <frame>` names build_subject uploads.
+    Subjects are looked up by ID in O(1), and are kept sorted by tile and
+    then first z so the subjects intersecting a box of the volume are
+    found by binary search in the runs of the tiles the box overlaps, so
+    annotations can be placed without parsing names again.
+
+    :param store: ClassificationStore.
+    :param tile_shapes: dict of tile origin to tile shape, see
+                        run_tile_shapes, for the extent of tiles.
+    :param tile_shape: (rows, columns) of tiles missing from `tile_shapes`.
+    """
+
+    def __init__(self, store, tile_shapes=None, tile_shape=(0, 0)):
+        n = store.n_rows['subjects']
+        columns = {name: np.asarray(store.column('subjects', name)[:n])
+                   for name in ('subject_id', 'row', 'col', 'z_first', 'z_step', 'n_frames', 'default_frame',
+                                'scale')}
+        located = columns['row'] >= 0
+        for name in columns:
+            columns[name] = columns[name][located]
+        self.subject_id = columns['subject_id']
+        self.row = columns['row']
+        self.col = columns['col']
+        self.z_first = columns['z_first']
+        self.z_step = columns['z_step']
+        self.n_frames = columns['n_frames']
+        self.default_frame = columns['default_frame']
+        self.scale = columns['scale']
+        self.z_last = self.z_first + self.z_step * np.maximum(self.n_frames - 1, 0)
+
+        tile_shapes = tile_shapes or {}
+        shapes = np.array([tile_shapes.get((r, c), tile_shape) for r, c in zip(self.row.tolist(), self.col.tolist())],
+                          dtype=np.int64).reshape(-1, 2)
+        self.n_rows, self.n_cols = shapes[:, 0], shapes[:, 1]
+        self._position = dict(zip(self.subject_id.tolist(), range(len(self.subject_id))))
+        self._order = np.argsort(self.subject_id, kind='stable')
+
+        # Spatial order: one run of subjects per tile, sorted by first z, searched on a key of both
+        origins, tile = np.unique(np.stack([self.row, self.col], axis=1).reshape(-1, 2), axis=0, return_inverse=True)
+        tile = tile.reshape(-1)
+        self._tile_row, self._tile_col = origins[:, 0], origins[:, 1]
+        self._tile_rows = np.zeros(len(origins), dtype=np.int64)
+        self._tile_cols = np.zeros(len(origins), dtype=np.int64)
+        np.maximum.at(self._tile_rows, tile, np.maximum(self.n_rows, 1))
+        np.maximum.at(self._tile_cols, tile, np.maximum(self.n_cols, 1))
+        self._z_min = int(self.z_first.min()) if len(self) else 0
+        self._z_span = int(self.z_first.max()) - self._z_min + 1 if len(self) else 1
+        self._z_extent = int((self.z_last - self.z_first).max()) if len(self) else 0
+        key = tile * self._z_span + (self.z_first - self._z_min)
+        self._spatial_order = np.argsort(key, kind='stable')
+        self._spatial_key = key[self._spatial_order]
+
+    def __len__(self):
+        return len(self.subject_id)
+
+    def __contains__(self, subject_id):
+        return subject_id in self._position
+
+    def lookup(self, subject_id):
+        """
+        :return: dict of the tile origin (row, col), tile shape (n_rows,
+                 n_cols), z range (z_first, z_last), z_step and
+                 default_frame of a subject.
+        """
+        i = self._position[subject_id]
+        return {'row': int(self.row[i]), 'col': int(self.col[i]), 'n_rows': int(self.n_rows[i]),
+                'n_cols': int(self.n_cols[i]), 'z_first': int(self.z_first[i]), 'z_last': int(self.z_last[i]),
+                'z_step': int(self.z_step[i]), 'default_frame': int(self.default_frame[i])}
+
+    def positions(self, subject_ids):
+        """
+        :return: index of every subject in the index arrays, -1 for
+                 subjects it does not hold.
+        """
+        subject_ids = np.asarray(subject_ids)
+        if len(self) == 0:
+            return np.full(subject_ids.shape, -1, dtype=np.int64)
+        i = self._order[np.clip(np.searchsorted(self.subject_id, subject_ids, sorter=self._order), 0, len(self) - 1)]
+        return np.where(self.subject_id[i] == subject_ids, i, -1)
+
+    def query(self, z_range=None, row_range=None, col_range=None):
+        """
+        Subjects whose frames and tile intersect a box of the volume,
+        e.g. what a viewer currently shows. Bounds are inclusive of the
+        start and exclusive of the stop; None leaves an axis unbounded.
+        Only the tiles overlapping the box are visited, and in each the
+        subjects starting in reach of the z range are found by binary
+        search.
+
+        :return: IDs of the subjects intersecting the box.
+        """
+        tiles = np.ones(len(self._tile_row), dtype=bool)
+        if row_range is not None:
+            tiles &= (self._tile_row + self._tile_rows > row_range[0]) & (self._tile_row < row_range[1])
+        if col_range is not None:
+            tiles &= (self._tile_col + self._tile_cols > col_range[0]) & (self._tile_col < col_range[1])
+        tiles = np.flatnonzero(tiles)
+        if not len(tiles):
+            return self.subject_id[:0]
+        if z_range is None:
+            z_start, z_stop = 0, self._z_span
+        else:
+            # A subject starting more than the longest z extent before the range ends before it
+            z_start = min(max(z_range[0] - self._z_extent - self._z_min, 0), self._z_span)
+            z_stop = min(max(z_range[1] - self._z_min, 0), self._z_span)
+        starts = np.searchsorted(self._spatial_key, tiles * self._z_span + z_start)
+        stops = np.searchsorted(self._spatial_key, tiles * self._z_span + z_stop)
+        selected = self._spatial_order[np.concatenate([np.arange(a, b) for a, b in zip(starts, stops)])]
+        if z_range is not None:
+            selected = selected[self.z_last[selected] >= z_range[0]]
+        return self.subject_id[selected]
+
+    def to_volume(self, subject_ids, coordinates):
+        """
+        Place (frame, y, x) coordinates in the subject images into the
+        volume, undoing the scale the images were uploaded at.
+
+        :param subject_ids: (n,) subject of every coordinate.
+        :param coordinates: (n, ..., 3) (frame, y, x) coordinates, e.g. the
+                            data returned by Consensus.points or polygons.
+        :return: (z, row, column) coordinates and a mask of the ones whose
+                 subject the index holds.
+        """
+        i = self.positions(subject_ids)
+        found = i >= 0
+        i = np.where(found, i, 0)
+        shape = (len(i),) + (1,) * (coordinates.ndim - 2)
+        placed = np.empty(coordinates.shape)
+        placed[..., 0] = self.z_first[i].reshape(shape) + coordinates[..., 0] * self.z_step[i].reshape(shape)
+        scale = self.scale[i].reshape(shape)
+        placed[..., 1] = self.row[i].reshape(shape) + coordinates[..., 1] / scale
+        placed[..., 2] = self.col[i].reshape(shape) + coordinates[..., 2] / scale
+        return placed, found
@@ -0,0 +1,148 @@
+import csv
+import json
+import threading
+import numpy as np
+import pytest
+from napari_zooniverse._classifications import (ClassificationStore, Consensus, load_classifications,
+                                                iter_load_consensus, resample_polygons)
+
+FIELDS = ['classification_id', 'user_name', 'workflow_id', 'workflow_version', 'created_at', 'metadata',
+          'annotations', 'subject_data', 'subject_ids']
+
+
+def _subject_data(subject_id, z_first, scale=None):
+    subject = {'default_frame': '2', 'Image 0': f"img_x0000_y0064_z{z_first:04d}.jpeg",
+               'Image 1': f"img_x0000_y0064_z{z_first + 10:04d}.jpeg",
+               'Image 2': f"img_x0000_y0064_z{z_first + 20:04d}.jpeg"}
+    if scale is not None:
+        subject['Upload scale'] = scale
+    return json.dumps({str(subject_id): subject})
+
+
+def _row(classification_id, user, subject_id, answer, point, square):
+    annotations = [{'task': 'T0', 'value': answer},
+                   {'task': 'T1', 'value': [
+                       {'tool': 0, 'frame': 1, 'x': point[1], 'y': point[0]},
+                       {'tool': 1, 'frame': 1, 'points': [{'x': square[1] + dx, 'y': square[0] + dy}
+                                                          for dy, dx in ((0, 0), (0, 10), (10, 10), (10, 0))]}]}]
+    return {'classification_id': classification_id, 'user_name': user, 'workflow_id': 7,
+            'workflow_version': '1.1', 'created_at': '2023-01-31 12:00:00 UTC',
+            'metadata': json.dumps({'started_at': '2023-01-31T12:00:00Z', 'finished_at': '2023-01-31T12:00:10Z'}),
+            'annotations': json.dumps(annotations), 'subject_data': _subject_data(subject_id, 10 * subject_id),
+            'subject_ids': str(subject_id)}
+
+
+@pytest.fixture
+def export(tmp_path):
+    """Three volunteers on subject 1, two agreeing, and one on subject 2."""
+    path = tmp_path / 'classifications.csv'
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, FIELDS)
+        writer.writeheader()
+        writer.writerow(_row(1, 'a', 1, 'Yes', (40, 50), (20, 20)))
+        writer.writerow(_row(2, 'b', 1, 'Yes', (42, 52), (22, 20)))
+        writer.writerow(_row(3, 'c', 1, 'No', (200, 200), (100, 100)))
+        writer.writerow(_row(4, 'a', 2, 'No', (10, 10), (50, 50)))
+    return str(path)
+
+
+def test_store_columns(export):
+    store = load_classifications(export, chunk_size=2)
+    assert store.n_rows == {'classifications': 4, 'answers': 4, 'marks': 8, 'vertices': 16, 'subjects': 2}
+    np.testing.assert_array_equal(store.column('classifications', 'subject_id'), [1, 1, 1, 2])
+    np.testing.assert_array_equal(store.column('marks', 'n_vertices'), [0, 4] * 4)
+    assert list(store.decode(store.column('answers', 'answer'))) == ['Yes', 'Yes', 'No', 'No']
+    np.testing.assert_array_equal(store.column('subjects', 'z_first'), [10, 20])
+    np.testing.assert_array_equal(store.column('subjects', 'row'), [0, 0])
+    np.testing.assert_array_equal(store.column('subjects', 'col'), [64, 64])
+    assert store.column('classifications', 'duration')[0] == 10
+
+
+def test_store_spills_to_disk(export, tmp_path):
+    store = load_classifications(export, chunk_size=1, spill_dir=str(tmp_path / 'spill'))
+    column = store.column('marks', 'x')
+    assert isinstance(column, np.memmap)
+    np.testing.assert_array_equal(column, load_classifications(export).column('marks', 'x'))
+    assert (tmp_path / 'spill' / 'strings.json').exists()
+
+
+def test_reloading_only_adds_new_classifications(export):
+    store = load_classifications(export)
+    load_classifications(export, store=store)
+    assert store.n_rows['classifications'] == 4
+
+
+def test_consensus(export):
+    store = load_classifications(export)
+    consensus = Consensus(cell_size=20)
+    consensus.update(store)
+
+    labels = consensus.labels()
+    subject_1 = np.flatnonzero(labels['subject_id'] == 1)[0]
+    assert labels['answer'][subject_1] == 'Yes'
+    assert labels['votes'][subject_1] == 2
+    assert labels['total'][subject_1] == 3
+
+    data, features = consensus.points(subject_id=1, min_agreement=0.5)
+    np.testing.assert_allclose(data, [[1, 41, 51]])
+    assert features['agreement'][0] == pytest.approx(2 / 3)
+
+    polygons, features = consensus.polygons(subject_id=1, min_agreement=0.5)
+    assert polygons.shape == (1, consensus.n_vertices, 3)
+    np.testing.assert_allclose(polygons[0, :, 1:].mean(axis=0), [26, 25], atol=0.5)
+    assert len(consensus.points(min_agreement=0.0)[0]) == 3
+
+
+def test_consensus_of_chunks_equals_one_pass(export):
+    store = ClassificationStore()
+    chunked = Consensus()
+    run = iter_load_consensus(export, store, chunked, chunk_size=1)
+    while True:
+        try:
+            next(run)
+        except StopIteration as e:
+            assert "majority answer" in e.value
+            break
+    whole = Consensus()
+    whole.update(store)
+    for name in ('subjects', 'answers', 'points', 'polygons'):
+        np.testing.assert_array_equal(chunked._stat(name)[0], whole._stat(name)[0])
+        np.testing.assert_allclose(chunked._stat(name)[1], whole._stat(name)[1])
+
+
+def test_consensus_joins_features_across_cell_boundaries(tmp_path):
+    path = tmp_path / 'classifications.csv'
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, FIELDS)
+        writer.writeheader()
+        writer.writerow(_row(1, 'a', 1, 'Yes', (39, 50), (20, 20)))
+        writer.writerow(_row(2, 'b', 1, 'Yes', (41, 50), (20, 20)))
+    consensus = Consensus(cell_size=20)
+    consensus.update(load_classifications(str(path)))
+    data, features = consensus.points()
+    np.testing.assert_allclose(data, [[1, 40, 50]])
+    assert features['agreement'][0] == 1
+
+
+def test_resample_polygons_ignores_start_and_winding():
+    square = np.array([[0, 0], [0, 10], [10, 10], [10, 0]], dtype=float)
+    reordered = square[[2, 1, 0, 3]]
+    mark = np.repeat([0, 1], 4)
+    _, resampled = resample_polygons(mark, np.concatenate([square[:, 1], reordered[:, 1]]),
+                                     np.concatenate([square[:, 0], reordered[:, 0]]), n_vertices=8)
+    np.testing.assert_allclose(resampled[0], resampled[1])
+
+
+def test_consensus_can_be_read_while_loading(export):
+    store = ClassificationStore()
+    consensus = Consensus()
+    loader = threading.Thread(target=lambda: list(iter_load_consensus(export, store, consensus, chunk_size=1)))
+    loader.start()
+    while loader.is_alive():
+        data, features = consensus.points()
+        assert len(data) == len(features['agreement'])
+        consensus.labels()
+    loader.join()
+    whole = Consensus()
+    whole.update(store)
+    np.testing.assert_allclose(consensus.points()[0], whole.points()[0])
@@ -0,0 +1,83 @@
+import os
+import numpy as np
+import pytest
+from napari_zooniverse._export import grid_tiles, shard_units, export_tiles, tile_dir_name, tile_file_name
+from napari_zooniverse._manifest import read_manifest, merge_manifests
+
+
+def test_shard_units_cover_every_unit_once():
+    units = shard_units(n_z=50, n_tiles=3, slab_size=16, shard=None)
+    assert len(units) == 4 * 3
+    shards = [shard_units(50, 3, 16, shard=(i, 5)) for i in range(5)]
+    joined = np.concatenate(shards)
+    np.testing.assert_array_equal(joined, units)
+    # Slab by slab, so a shard reads a contiguous run of z
+    np.testing.assert_array_equal(units[:3, 1:], [[0, 16]] * 3)
+    np.testing.assert_array_equal(units[-1], [2, 48, 50])
+
+
+def test_shard_units_restrict_z_and_tiles():
+    units = shard_units(n_z=50, n_tiles=4, slab_size=10, z_range=(5, 30), tile_indices=[3, 1, 3])
+    np.testing.assert_array_equal(np.unique(units[:, 0]), [1, 3])
+    assert units[:, 1].min() == 5
+    assert units[:, 2].max() == 30
+    assert np.sum(units[:, 2] - units[:, 1]) == 2 * 25
+
+
+def test_shard_units_rejects_bad_shard():
+    with pytest.raises(ValueError):
+        shard_units(10, 1, 4, shard=(2, 2))
+
+
+def _mtimes(path):
+    return {os.path.join(root, name): os.stat(os.path.join(root, name)).st_mtime_ns
+            for root, _, names in os.walk(path) for name in names if name.endswith('.jpeg')}
+
+
+def test_export_rewrites_only_changed_planes(tmp_path):
+    image = np.random.default_rng(0).integers(0, 255, (6, 32, 32), dtype=np.uint8)
+    tiles = grid_tiles(image.shape, 2, 1)
+    assert export_tiles(image, str(tmp_path), tiles) == 12
+    before = _mtimes(tmp_path)
+    manifest = read_manifest(str(tmp_path / tile_dir_name(tiles[0])))
+    assert len(manifest['digests']) == 6
+
+    image[1] = 0
+    removed = tmp_path / tile_dir_name(tiles[1]) / tile_file_name(tiles[1], 4)
+    os.remove(removed)
+    assert export_tiles(image, str(tmp_path), tiles) == 3
+    after = _mtimes(tmp_path)
+    changed = sorted(os.path.basename(path) for path in after if after[path] != before.get(path))
+    assert changed == sorted([tile_file_name(tiles[0], 1), tile_file_name(tiles[1], 1), tile_file_name(tiles[1], 4)])
+
+
+def test_sharded_export_merges_to_a_single_node_export(tmp_path):
+    image = np.random.default_rng(1).integers(0, 255, (7, 16, 16), dtype=np.uint8)
+    tiles = grid_tiles(image.shape, 1, 1)
+    export_tiles(image, str(tmp_path / 'single'), tiles, slab_size=2)
+    for shard in range(3):
+        export_tiles(image, str(tmp_path / 'sharded'), tiles, slab_size=2, shard=(shard, 3))
+    assert merge_manifests(str(tmp_path / 'sharded')) == 1
+
+    single = read_manifest(str(tmp_path / 'single' / tile_dir_name(tiles[0])))
+    sharded = read_manifest(str(tmp_path / 'sharded' / tile_dir_name(tiles[0])))
+    for key in ('files', 'digests', 'fingerprint'):
+        assert single[key] == sharded[key]
+    np.testing.assert_array_equal(single['z'], sharded['z'])
+
+
+@pytest.mark.parametrize('shape', [(5, 32, 32), (5, 32, 32, 3)])
+def test_zarr_export_matches_the_volume(tmp_path, shape):
+    from napari_zooniverse._zarr_store import chunk_path, open_tile_array
+    image = np.random.default_rng(2).integers(0, 255, shape, dtype=np.uint8)
+    tiles = grid_tiles(image.shape, 2, 2)
+    assert export_tiles(image, str(tmp_path), tiles, output_format='zarr') == 5 * 4
+    chunks = []
+    for tile in tiles:
+        array = open_tile_array(str(tmp_path / tile_dir_name(tile)))
+        np.testing.assert_array_equal(array[:], image[:, tile.rows, tile.cols])
+        chunks += [chunk_path(array, z) for z in range(shape[0])]
+    before = {path: os.stat(path).st_mtime_ns for path in chunks}
+    # Every chunk is found on disk, so exporting again rewrites none
+    assert export_tiles(image, str(tmp_path), tiles, output_format='zarr') == 0
+    assert {path: os.stat(path).st_mtime_ns for path in chunks} == before
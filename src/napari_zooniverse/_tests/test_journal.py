@@ -0,0 +1,69 @@
+from napari_zooniverse._journal import UploadJournal, journal_path, PLANNED, SAVED, LINKED
+
+
+def test_journal_path_is_next_to_the_directory(tmp_path):
+    path = journal_path(str(tmp_path / 'image_x0000_y0000') + '/')
+    assert path == str(tmp_path / 'image_x0000_y0000_upload_journal.jsonl')
+
+
+def test_journal_resumes(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    with UploadJournal(path, project_id=1) as journal:
+        journal.plan_subject_set('set')
+        journal.subject_set_saved('set', 10)
+        journal.plan_subjects('set', [3, 4, 5])
+        journal.subject_saved('set', 3, 100)
+        journal.subject_saved('set', 4, 101)
+        journal.subjects_linked('set', [3])
+
+    with UploadJournal(path, project_id=1) as journal:
+        assert journal.subject_set_state('set') == SAVED
+        assert journal.subject_set_id('set') == '10'
+        assert journal.subject('set', 3) == {'state': LINKED, 'id': '100'}
+        assert journal.subject('set', 4) == {'state': SAVED, 'id': '101'}
+        assert journal.subject('set', 5) == {'state': PLANNED, 'id': None}
+        assert journal.subject('set', 6) is None
+
+
+def test_journal_ignores_torn_last_line(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    with UploadJournal(path) as journal:
+        journal.plan_subject_set('set')
+        journal.subject_set_saved('set', 10)
+    with open(path, 'a') as f:
+        f.write('{"subject_set": "set", "sta')
+
+    with UploadJournal(path) as journal:
+        assert journal.subject_set_state('set') == SAVED
+        journal.subject_set_linked('set')
+    with UploadJournal(path) as journal:
+        assert journal.subject_set_state('set') == LINKED
+    with open(path) as f:
+        assert all(line.endswith('}\n') for line in f)
+
+
+def test_journal_ignores_other_projects(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    with UploadJournal(path, project_id=1, endpoint='https://a') as journal:
+        journal.plan_subject_set('set')
+        journal.subject_set_linked('set')
+
+    with UploadJournal(path, project_id=2, endpoint='https://a') as journal:
+        assert journal.subject_set_state('set') is None
+        assert journal.n_ignored == 2
+    with UploadJournal(path, project_id=1, endpoint='https://b') as journal:
+        assert journal.subject_set_state('set') is None
+    with UploadJournal(path, project_id=1, endpoint='https://a') as journal:
+        assert journal.subject_set_state('set') == LINKED
+
+
+def test_journal_reset_subject_set(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    with UploadJournal(path) as journal:
+        journal.subject_set_saved('set', 10)
+        journal.plan_subjects('set', [3])
+        journal.subject_saved('set', 3, 100)
+        journal.reset_subject_set('set')
+    with UploadJournal(path) as journal:
+        assert journal.subject_set_id('set') is None
+        assert journal.subject('set', 3) is None
@@ -0,0 +1,102 @@
+import io
+import numpy as np
+from napari_zooniverse import _utils
+from napari_zooniverse._backend import FakePanoptesBackend
+from napari_zooniverse._export import encode_jpeg, jpeg_quality
+from napari_zooniverse._jpeg_budget import BudgetEncoder, choose_encoding, rescale_stack
+from napari_zooniverse._media_cache import MediaCache
+from skimage.io import imsave
+
+
+def _stack(n=6, size=96, seed=0):
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[:size, :size]
+    base = 128 + 60 * np.sin(x / 7) * np.cos(y / 11)
+    return np.stack([np.clip(base + rng.normal(0, 25, base.shape), 0, 255).astype(np.uint8) for _ in range(n)])
+
+
+def _write_stack(directory, stack, quality=None):
+    paths = []
+    for z, plane in enumerate(stack):
+        path = str(directory / f"img_x0000_y0000_z{z:04d}.jpeg")
+        if quality is None:
+            imsave(path, plane)
+        else:
+            with open(path, 'wb') as f:
+                f.write(encode_jpeg(plane, quality))
+        paths.append(path)
+    return paths
+
+
+def test_jpeg_quality():
+    plane = _stack(1)[0]
+    for quality in (30, 75, 95):
+        assert jpeg_quality(io.BytesIO(encode_jpeg(plane, quality))) == quality
+    assert jpeg_quality(io.BytesIO(b'not a jpeg')) is None
+
+
+def test_rescale_stack():
+    stack = _stack(2, size=40)
+    assert rescale_stack(stack, 1.0) is stack
+    assert rescale_stack(stack, 0.5).shape == (2, 20, 20)
+
+
+def test_choose_encoding_fits_budget():
+    stack = _stack(4)
+    sizes = [len(encode_jpeg(plane, 90)) for plane in stack]
+    quality, scale = choose_encoding(stack, max(sizes) // 2)
+    assert scale == 1.0
+    assert quality < 90
+    assert max(len(encode_jpeg(plane, quality)) for plane in stack) <= max(sizes) // 2
+
+
+def test_budget_encoder_fits_and_records_quality(tmp_path):
+    paths = _write_stack(tmp_path, _stack(), quality=90)
+    budget = min(len(open(path, 'rb').read()) for path in paths) // 2
+    encoder = BudgetEncoder(paths, budget, n_samples=3)
+    for path in paths:
+        data = encoder.encode(path)
+        assert len(data) <= budget
+        assert jpeg_quality(io.BytesIO(data)) == encoder.qualities[path]
+    assert encoder.source_quality == 90
+    assert encoder.quality <= 90
+
+
+def test_budget_encoder_passes_through_images_within_budget(tmp_path):
+    paths = _write_stack(tmp_path, _stack(3))
+    encoder = BudgetEncoder(paths, 10 ** 7)
+    with open(paths[0], 'rb') as f:
+        assert encoder.encode(paths[0]) == f.read()
+    assert encoder.scale == 1.0
+    # Exported JPEGs are never re-encoded above their own quality
+    assert encoder.quality <= encoder.source_quality == 75
+
+
+def test_budget_encoder_downscales(tmp_path):
+    paths = _write_stack(tmp_path, _stack(2, size=128), quality=90)
+    budget = len(encode_jpeg(_stack(1, size=128)[0], 30)) // 3
+    encoder = BudgetEncoder(paths, budget)
+    assert encoder.encode(paths[0]) is not None
+    assert encoder.scale < 1.0
+    fixed = BudgetEncoder(paths, budget, downscale=False)
+    fixed.encode(paths[0])
+    assert fixed.scale == 1.0
+
+
+def test_subject_quality_is_parsed_once_per_image(tmp_path, monkeypatch):
+    paths = _write_stack(tmp_path, _stack(7), quality=80)
+    parsed = []
+    monkeypatch.setattr(_utils, 'jpeg_quality', lambda path: parsed.append(path) or jpeg_quality(path))
+    backend = FakePanoptesBackend()
+    project = backend.find_project('project')
+    # Subjects of span 2 and step 1 around z 2, 3 and 4 share their frames
+    subjects = [_utils.build_subject(project, paths, centre, 2, 1, backend, MediaCache()) for centre in (2, 3, 4)]
+    assert [s.metadata['jpeg quality (%)'] for s in subjects] == [80] * 3
+    assert len(parsed) == 7
+
+    parsed.clear()
+    encoder = BudgetEncoder(paths, 10 ** 7)
+    subject = _utils.build_subject(project, paths, 3, 2, 1, backend, MediaCache(), encoder)
+    assert subject.metadata['jpeg quality (%)'] == 80
+    # The encoder already knows what it uploaded
+    assert parsed == []
@@ -0,0 +1,68 @@
+import os
+import numpy as np
+import pytest
+from napari_zooniverse._export import Tile, tile_file_name
+from napari_zooniverse._manifest import (MANIFEST_NAME, PARTIAL_MANIFEST_GLOB, write_manifest,
+                                         write_partial_manifest, merge_manifests, read_manifest)
+
+TILE = Tile(x=0, y=64, rows=slice(64, 128), cols=slice(0, 32), file_prefix='img')
+
+
+def _write_part(subject_path, z, n_z=6, fingerprint='f'):
+    z = np.asarray(z)
+    write_partial_manifest(str(subject_path), TILE, [tile_file_name(TILE, i) for i in z], z, z * 10, np.uint8,
+                           n_z, fingerprint, [f"d{i}" for i in z])
+
+
+def test_manifest_round_trip(tmp_path):
+    z = np.array([2, 0, 1])
+    write_manifest(str(tmp_path), TILE, ['c', 'a', 'b'], z, [30, 10, 20], np.uint16, 'f', ['dc', 'da', 'db'])
+    manifest = read_manifest(str(tmp_path))
+    assert manifest['files'] == ['a', 'b', 'c']
+    np.testing.assert_array_equal(manifest['z'], [0, 1, 2])
+    np.testing.assert_array_equal(manifest['nbytes'], [10, 20, 30])
+    assert manifest['digests'] == ['da', 'db', 'dc']
+    assert manifest['dtype'] == 'uint16'
+    assert manifest['rows'] == [64, 128]
+    assert read_manifest(str(tmp_path / 'missing')) is None
+
+
+def test_merge_shards(tmp_path):
+    subject_path = tmp_path / 'image_x0000_y0064'
+    subject_path.mkdir()
+    _write_part(subject_path, [3, 4, 5])
+    _write_part(subject_path, [0, 1, 2])
+
+    assert merge_manifests(str(tmp_path)) == 1
+    manifest = read_manifest(str(subject_path))
+    np.testing.assert_array_equal(manifest['z'], np.arange(6))
+    np.testing.assert_array_equal(manifest['nbytes'], np.arange(6) * 10)
+    assert manifest['files'] == [tile_file_name(TILE, i) for i in range(6)]
+    assert manifest['digests'] == [f"d{i}" for i in range(6)]
+    assert manifest['fingerprint'] == 'f'
+    assert not list(subject_path.glob(PARTIAL_MANIFEST_GLOB))
+    # Nothing left to merge
+    assert merge_manifests(str(tmp_path)) == 0
+
+
+def test_merge_rejects_incomplete_and_overlapping_shards(tmp_path):
+    subject_path = tmp_path / 'image_x0000_y0064'
+    subject_path.mkdir()
+    _write_part(subject_path, [0, 1, 2])
+    with pytest.raises(ValueError, match="3 of 6"):
+        merge_manifests(str(tmp_path))
+
+    _write_part(subject_path, [2, 3, 4, 5])
+    with pytest.raises(ValueError, match="overlap"):
+        merge_manifests(str(tmp_path))
+    assert not os.path.exists(subject_path / MANIFEST_NAME)
+    assert len(list(subject_path.glob(PARTIAL_MANIFEST_GLOB))) == 2
+
+
+def test_merge_rejects_shards_of_different_exports(tmp_path):
+    subject_path = tmp_path / 'image_x0000_y0064'
+    subject_path.mkdir()
+    _write_part(subject_path, [0, 1, 2], fingerprint='old')
+    _write_part(subject_path, [3, 4, 5], fingerprint='new')
+    with pytest.raises(ValueError, match="different exports"):
+        merge_manifests(str(tmp_path))
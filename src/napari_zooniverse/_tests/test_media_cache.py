@@ -0,0 +1,73 @@
+import hashlib
+import threading
+from napari_zooniverse._media_cache import MediaCache
+
+
+def test_media_cache_reads_each_image_once():
+    reads = []
+
+    def load(key):
+        reads.append(key)
+        return key.encode() * 10
+
+    cache = MediaCache(max_bytes=1000)
+    for key in ['a', 'b', 'a', 'b', 'a']:
+        data, digest = cache.get(key, load)
+        assert data == key.encode() * 10
+        assert digest == hashlib.md5(data).hexdigest()
+    assert reads == ['a', 'b']
+    assert (cache.hits, cache.misses, cache.bytes_read) == (3, 2, 20)
+    assert cache.digest('a') == hashlib.md5(b'a' * 10).hexdigest()
+    assert cache.digest('c') is None
+
+
+def test_media_cache_evicts_least_recently_used():
+    cache = MediaCache(max_bytes=25)
+    load = lambda key: b'x' * 10
+    cache.get('a', load)
+    cache.get('b', load)
+    cache.get('a', load)
+    cache.get('c', load)
+    assert cache.n_bytes == 20
+    assert cache.digest('b') is None
+    assert cache.digest('a') is not None
+    # Larger than the whole cache, returned but never kept
+    data, _ = cache.get('d', lambda key: b'y' * 30)
+    assert len(data) == 30 and cache.digest('d') is None
+
+
+def test_media_cache_shares_concurrent_reads():
+    started, release = threading.Event(), threading.Event()
+    reads = []
+
+    def load(key):
+        reads.append(key)
+        started.set()
+        release.wait()
+        return b'data'
+
+    cache = MediaCache()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get('a', load))) for _ in range(4)]
+    threads[0].start()
+    started.wait()
+    for thread in threads[1:]:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert reads == ['a']
+    assert len(results) == 4 and all(result[0] == b'data' for result in results)
+
+
+def test_media_cache_failed_read_is_not_cached():
+    cache = MediaCache()
+
+    def fail(key):
+        raise OSError("unreadable")
+
+    try:
+        cache.get('a', fail)
+    except OSError:
+        pass
+    assert cache.get('a', lambda key: b'ok')[0] == b'ok'
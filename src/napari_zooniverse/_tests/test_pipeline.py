@@ -0,0 +1,81 @@
+import os
+import numpy as np
+from skimage.io import imsave
+from napari_zooniverse import _pipeline
+from napari_zooniverse._backend import FakePanoptesBackend, ZooniverseAPIError
+from napari_zooniverse._journal import UploadJournal
+from napari_zooniverse._pipeline import iter_upload, preprocess
+
+
+def _subject_set_dir(tmp_path, n_images=12):
+    directory = str(tmp_path / 'image_x0000_y0000')
+    os.makedirs(directory)
+    for z in range(n_images):
+        imsave(os.path.join(directory, f"img_x0000_y0000_z{z:04d}.jpeg"), np.full((16, 16), z, dtype=np.uint8),
+               check_contrast=False)
+    return directory
+
+
+def _run(upload):
+    progress = []
+    while True:
+        try:
+            progress.append(next(upload))
+        except StopIteration as e:
+            return progress, e.value
+
+
+def test_resuming_a_finished_upload_makes_no_requests(tmp_path):
+    directory = _subject_set_dir(tmp_path)
+    backend = FakePanoptesBackend()
+    project = backend.find_project('project')
+    # 8 subjects of span 2 and step 1, in 4 sets of 2
+    _, result = _run(iter_upload(project, directory, 2, 1, 2, n_workers=2, backend=backend))
+    assert result == (4, 0)
+
+    n_requests = backend.n_requests
+    progress, result = _run(iter_upload(project, directory, 2, 1, 2, n_workers=2, backend=backend))
+    assert result == (4, 0)
+    assert backend.n_requests == n_requests
+    assert progress[-1] == (8, 8)
+
+
+def test_sets_that_cannot_be_created_count_as_failed(tmp_path):
+    directory = _subject_set_dir(tmp_path)
+
+    class Backend(FakePanoptesBackend):
+        def create_subject_set(self, project, display_name):
+            if len(self.subject_sets) == 1:
+                raise ZooniverseAPIError("Forbidden", 403)
+            return super().create_subject_set(project, display_name)
+
+    backend = Backend()
+    project = backend.find_project('project')
+    progress, result = _run(iter_upload(project, directory, 2, 1, 2, n_workers=2, backend=backend))
+    assert result == (1, 6)
+    assert progress[-1] == (8, 8)
+
+
+def test_cancelling_closes_the_journal(tmp_path, monkeypatch):
+    directory = _subject_set_dir(tmp_path)
+    journals = []
+
+    class Journal(UploadJournal):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            journals.append(self)
+
+    monkeypatch.setattr(_pipeline, 'UploadJournal', Journal)
+    backend = FakePanoptesBackend()
+    upload = iter_upload(backend.find_project('project'), directory, 2, 1, 2, n_workers=2, backend=backend)
+    next(upload)
+    upload.close()
+    assert journals[0]._file.closed
+
+
+def test_preprocess_rate_counts_only_written_files(tmp_path):
+    image = np.random.default_rng(0).integers(0, 255, (4, 32, 32), dtype=np.uint8)
+    assert preprocess(image, str(tmp_path), n_tiles=(2, 1)).startswith("Exported 8 images, 0 already up to date")
+    summary = preprocess(image, str(tmp_path), n_tiles=(2, 1))
+    assert summary.startswith("Exported 0 images, 8 already up to date")
+    assert "(0.0 files/s)" in summary
@@ -0,0 +1,39 @@
+import numpy as np
+from napari_zooniverse._planner import plan_upload, subject_members, estimate_upload
+
+
+def test_plan_upload_centres_have_full_windows():
+    plan = plan_upload(100, span=2, step=10, subject_set_size=5)
+    assert plan.centre[0] == 20
+    assert plan.centre[-1] == 79
+    assert plan.members.shape == (60, 5)
+    assert plan.members.min() == 0
+    assert plan.members.max() == 99
+    np.testing.assert_array_equal(plan.members[0], subject_members(20, 2, 10))
+
+
+def test_plan_upload_groups_subject_sets():
+    plan = plan_upload(100, span=2, step=10, subject_set_size=7)
+    # 60 centres in sets of 7, the last set taking the 4 left
+    assert len(plan.set_start) == 9
+    np.testing.assert_array_equal(plan.set_stop - plan.set_start + 1, [7] * 8 + [4])
+    np.testing.assert_array_equal(np.bincount(plan.subject_set), [7] * 8 + [4])
+    assert plan.set_stop[-1] == plan.centre[-1]
+
+
+def test_plan_upload_without_centres():
+    plan = plan_upload(10, span=2, step=10, subject_set_size=5)
+    assert len(plan.centre) == 0
+    assert len(plan.set_start) == 0
+    assert estimate_upload(plan, np.zeros(10))['requests'] == 0
+
+
+def test_estimate_upload():
+    plan = plan_upload(12, span=1, step=1, subject_set_size=5)
+    estimate = estimate_upload(plan, np.full(12, 1000), batch_size=3)
+    assert estimate['subjects'] == 10
+    assert estimate['subject sets'] == 2
+    assert estimate['media files'] == 30
+    # 2 sets, 10 subjects, 30 media files and 2 link batches per set
+    assert estimate['requests'] == 2 + 10 + 30 + 4
+    assert estimate['bytes'] == 30000
@@ -0,0 +1,58 @@
+import pytest
+import requests
+from napari_zooniverse._backend import FakePanoptesBackend, FakeRateLimitError, ZooniverseAPIError
+from napari_zooniverse._scheduler import (RequestScheduler, ScheduledBackend, is_refused, is_retryable,
+                                          retry_after, status_code)
+
+
+def test_errors_are_classified_by_status_code():
+    assert is_retryable(ZooniverseAPIError("busy", 503))
+    assert is_retryable(ZooniverseAPIError("Received HTTP status code 502 from API"))
+    assert not is_retryable(ZooniverseAPIError("Subject set already exists", 422))
+    assert not is_retryable(ZooniverseAPIError("no status"))
+    assert is_retryable(requests.ConnectionError())
+    assert status_code(ZooniverseAPIError("x", 404)) == 404
+
+
+def test_retry_after_header():
+    error = FakeRateLimitError(1.5)
+    assert status_code(error) == 429
+    assert retry_after(error) == pytest.approx(1.5)
+    assert is_refused(error)
+    assert not is_refused(ZooniverseAPIError("x", 500))
+
+
+def test_scheduler_retries_then_raises():
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise ZooniverseAPIError("busy", 503)
+        return 'done'
+
+    scheduler = RequestScheduler(base_delay=0.001)
+    assert scheduler.call(flaky) == 'done'
+    assert scheduler.n_retries == 2
+
+    def permanent():
+        raise ZooniverseAPIError("invalid", 422)
+
+    with pytest.raises(ZooniverseAPIError):
+        scheduler.call(permanent)
+    assert scheduler.n_retries == 2
+
+
+def test_saved_subjects_are_never_duplicated():
+    backend = FakePanoptesBackend(failure_rate=0.3, seed=0)
+    client = ScheduledBackend(backend, RequestScheduler(base_delay=0.001))
+    project = backend.find_project('project')
+    saved = []
+    for _ in range(40):
+        try:
+            saved.append(client.save_subject(project, [b'a' * 10, b'b' * 10], {}))
+        except ZooniverseAPIError:
+            pass
+    # Every subject on the server is one that was reported saved, with all of its media
+    assert sorted(backend.subjects) == sorted(subject.id for subject in saved)
+    assert all(subject.media == 2 for subject in backend.subjects.values())
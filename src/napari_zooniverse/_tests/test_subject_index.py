@@ -0,0 +1,63 @@
+import numpy as np
+from napari_zooniverse._classifications import ClassificationStore, TABLES
+from napari_zooniverse._subject_index import SubjectIndex
+
+
+def _store():
+    store = ClassificationStore()
+    subjects = {'subject_id': [30, 10, 20, 40], 'centre_image': [0, 0, 0, 0], 'row': [0, 64, 0, -1],
+                'col': [0, 0, 32, -1], 'z_first': [0, 10, 20, -1], 'z_step': [10, 10, 5, 0],
+                'n_frames': [3, 3, 3, 0], 'default_frame': [2, 2, 2, 1], 'scale': [1.0, 1.0, 0.5, 1.0]}
+    assert set(subjects) == set(TABLES['subjects'])
+    store.append('subjects', subjects)
+    return store
+
+
+def test_lookup_and_positions():
+    index = SubjectIndex(_store(), {(64, 0): (64, 32)}, tile_shape=(32, 32))
+    assert len(index) == 3
+    assert 40 not in index
+    assert index.lookup(10) == {'row': 64, 'col': 0, 'n_rows': 64, 'n_cols': 32, 'z_first': 10, 'z_last': 30,
+                                'z_step': 10, 'default_frame': 2}
+    assert index.lookup(30)['n_rows'] == 32
+    np.testing.assert_array_equal(index.subject_id[index.positions([20, 99, 30])[[0, 2]]], [20, 30])
+    assert index.positions([99])[0] == -1
+
+
+def test_query():
+    index = SubjectIndex(_store(), tile_shape=(32, 32))
+    assert sorted(index.query(z_range=(25, 26))) == [10, 20]
+    assert sorted(index.query(row_range=(0, 32))) == [20, 30]
+    assert sorted(index.query(z_range=(0, 5), col_range=(0, 32))) == [30]
+    assert sorted(index.query()) == [10, 20, 30]
+    assert len(index.query(row_range=(500, 600))) == 0
+
+
+def test_query_matches_a_scan():
+    rng = np.random.default_rng(0)
+    n = 2000
+    store = ClassificationStore()
+    z_step = rng.integers(1, 4, n)
+    n_frames = rng.integers(1, 6, n)
+    store.append('subjects', {'subject_id': np.arange(n), 'centre_image': np.zeros(n, dtype=int),
+                              'row': rng.integers(0, 4, n) * 32, 'col': rng.integers(0, 4, n) * 32,
+                              'z_first': rng.integers(0, 200, n), 'z_step': z_step, 'n_frames': n_frames,
+                              'default_frame': np.ones(n, dtype=int), 'scale': np.ones(n)})
+    index = SubjectIndex(store, tile_shape=(32, 32))
+    for _ in range(50):
+        z0, r0, c0 = rng.integers(-10, 210), rng.integers(-10, 130), rng.integers(-10, 130)
+        z_range, row_range, col_range = (z0, z0 + rng.integers(1, 20)), (r0, r0 + 20), (c0, c0 + 40)
+        expected = index.subject_id[(index.z_last >= z_range[0]) & (index.z_first < z_range[1]) &
+                                    (index.row + 32 > row_range[0]) & (index.row < row_range[1]) &
+                                    (index.col + 32 > col_range[0]) & (index.col < col_range[1])]
+        np.testing.assert_array_equal(np.sort(index.query(z_range, row_range, col_range)), np.sort(expected))
+
+
+def test_to_volume():
+    index = SubjectIndex(_store())
+    coordinates = np.array([[1, 4, 6], [2, 4, 6], [0, 0, 0]], dtype=float)
+    placed, found = index.to_volume(np.array([10, 20, 99]), coordinates)
+    np.testing.assert_array_equal(found, [True, True, False])
+    np.testing.assert_allclose(placed[0], [20, 68, 6])
+    # Uploaded at half scale, so image pixels are two volume pixels
+    np.testing.assert_allclose(placed[1], [30, 8, 44])
@@ -0,0 +1,37 @@
+import os
+import numpy as np
+from skimage.io import imsave
+from napari_zooniverse import _thumbnails
+from napari_zooniverse._thumbnails import update_thumbnails
+
+
+def _write_images(directory, n_images, value=0):
+    os.makedirs(directory, exist_ok=True)
+    for z in range(n_images):
+        imsave(os.path.join(directory, f"img_x0000_y0000_z{z:04d}.jpeg"),
+               np.full((256, 256), value + z, dtype=np.uint8), check_contrast=False)
+
+
+def test_levels_in_use_are_removed_later(tmp_path, monkeypatch):
+    directory = str(tmp_path / 'image_x0000_y0000')
+    cache_root = str(tmp_path / 'cache')
+    _write_images(directory, 4)
+    first = update_thumbnails(directory, cache_root)
+    assert [level.shape for level in first] == [(4, 128, 128), (4, 64, 64)]
+
+    # Deleting a memory-mapped file fails on Windows
+    def locked(path):
+        raise PermissionError(path)
+
+    os.remove(os.path.join(directory, 'img_x0000_y0000_z0003.jpeg'))
+    monkeypatch.setattr(_thumbnails.os, 'remove', locked)
+    second = update_thumbnails(directory, cache_root)
+    assert second[0].shape == (3, 128, 128)
+    np.testing.assert_array_equal(first[0][1], second[0][1])
+    cache = _thumbnails.cache_path(directory, cache_root)
+    assert len(os.listdir(cache)) == 5
+
+    monkeypatch.undo()
+    del first
+    update_thumbnails(directory, cache_root)
+    assert sorted(os.listdir(cache)) == ['index.json', 'level1.1.npy', 'level2.1.npy']
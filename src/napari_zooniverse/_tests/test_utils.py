@@ -0,0 +1,27 @@
+import os
+import numpy as np
+from skimage.io import imsave
+from napari_zooniverse import _utils
+from napari_zooniverse._utils import lazy_imread_stack
+
+
+def test_lazy_imread_stack_reads_pixels_on_demand(tmp_path, monkeypatch):
+    file_list = []
+    for z in range(20):
+        path = os.path.join(str(tmp_path), f"img_x0000_y0000_z{z:04d}.jpeg")
+        imsave(path, np.full((32, 48), 10 * z, dtype=np.uint8), check_contrast=False)
+        file_list.append(path)
+
+    reads = []
+    imread = _utils.imread
+    monkeypatch.setattr(_utils, 'imread', lambda path: (reads.append(path), imread(path))[1])
+
+    stack = lazy_imread_stack(file_list)
+    # Only the first image is decoded, for the shape and dtype
+    assert reads == file_list[:1]
+    assert stack.shape == (20, 32, 48)
+    assert stack.dtype == np.uint8
+
+    plane = np.asarray(stack[7])
+    assert reads == [file_list[0], file_list[7]]
+    assert abs(int(plane.mean()) - 70) <= 1
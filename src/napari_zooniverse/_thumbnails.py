@@ -0,0 +1,198 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from ._utils import load_image_list, lazy_imread_stack, read_image
+from ._zarr_store import chunk_path, is_zarr_tile, open_tile_array
+
+# Thumbnails of every directory browsed, shared between runs and sessions
+THUMBNAIL_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'napari-zooniverse', 'thumbnails')
+# Levels are halved until the longest edge is at most this many pixels
+MIN_THUMBNAIL_SIZE = 64
+INDEX_NAME = 'index.json'
+
+
+def cache_path(directory, cache_root=None):
+    """
+    :return: cache directory of the thumbnails of a tile directory.
+    """
+    directory = os.path.abspath(directory)
+    digest = hashlib.sha1(directory.encode()).hexdigest()[:16]
+    return os.path.join(cache_root or THUMBNAIL_CACHE, f"{os.path.basename(directory)}_{digest}")
+
+
+def level_shapes(shape):
+    """
+    :param shape: (row, column) shape of a full resolution image.
+    :return: shapes of the thumbnail levels, each half the one before.
+    """
+    shapes = []
+    while max(shape) > MIN_THUMBNAIL_SIZE and min(shape) >= 2:
+        shape = (shape[0] // 2, shape[1] // 2)
+        shapes.append(shape)
+    return shapes
+
+
+def downsample(image):
+    """
+    :return: `image` halved along its first two axes by 2x2 mean.
+    """
+    rows, cols = image.shape[0] // 2, image.shape[1] // 2
+    blocks = image[:rows * 2, :cols * 2].reshape((rows, 2, cols, 2) + image.shape[2:])
+    return blocks.mean(axis=(1, 3)).astype(image.dtype)
+
+
+def _media_stat(path):
+    # Images of an OME-Zarr tile group are keyed by their chunk
+    if not os.path.isfile(path) and is_zarr_tile(os.path.dirname(path)):
+        z = int(path.rsplit('_z', 1)[1].split('.', 1)[0])
+        path = chunk_path(open_tile_array(os.path.dirname(path)), z)
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _load_index(path):
+    try:
+        with open(os.path.join(path, INDEX_NAME)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _open_levels(path, index):
+    return [np.load(os.path.join(path, name), mmap_mode='r') for name in index['levels']]
+
+
+def _level_files(path):
+    """
+    :return: dict of the name of every level file in a cache to its generation.
+    """
+    files = {}
+    for name in os.listdir(path):
+        parts = name.split('.')
+        if name.startswith('level') and len(parts) == 3 and parts[1].isdigit() and parts[2] == 'npy':
+            files[name] = int(parts[1])
+    return files
+
+
+def _remove_stale_levels(path, names):
+    """
+    Delete the level files of a cache not in `names`. A level napari
+    still has memory-mapped cannot be deleted on Windows; it is left for
+    a later update to remove.
+    """
+    for name in _level_files(path):
+        if name not in names:
+            try:
+                os.remove(os.path.join(path, name))
+            except OSError:
+                pass
+
+
+def iter_update_thumbnails(directory, cache_root=None, n_workers=4):
+    """
+    Bring the thumbnail pyramid of a tile directory up to date. Every
+    image is keyed by its path, mtime and size; only images that are
+    new or changed since the last update are decoded again, the others
+    are copied from the cached levels. Levels are written under a new
+    generation and the index is replaced last, so an interrupted update
+    leaves the previous pyramid usable. Levels of earlier generations are
+    removed once they can be, which on Windows is only after napari lets
+    go of their memory maps.
+
+    :param directory: tile directory or OME-Zarr tile group.
+    :param cache_root: directory holding the caches of every directory.
+    :param n_workers: number of images decoded at once.
+    :return: yields (images done, total images); returns the cached
+             levels as read-only memory-mapped (z, row, column) arrays,
+             largest first, or None if the directory has no images.
+    """
+    file_list, _ = load_image_list(directory)
+    if len(file_list) == 0:
+        return None
+    path = cache_path(directory, cache_root)
+    os.makedirs(path, exist_ok=True)
+
+    keys = [_media_stat(f) for f in file_list]
+    index = _load_index(path)
+    old_rows = {}
+    if index is not None:
+        old_rows = {(f, tuple(k)): row for row, (f, k) in enumerate(zip(index['files'], index['keys']))}
+    rows = [old_rows.get((f, k)) for f, k in zip(file_list, keys)]
+    if index is not None and all(row is not None for row in rows) and len(rows) == len(index['files']):
+        _remove_stale_levels(path, index['levels'])
+        yield len(rows), len(rows)
+        return _open_levels(path, index)
+
+    first = read_image(file_list[rows.index(None)] if None in rows else file_list[0])
+    shapes = level_shapes(first.shape[:2])
+    if index is not None and ([list(s) for s in shapes] != index['shapes'] or str(first.dtype) != index['dtype']):
+        rows = [None] * len(file_list)
+    old_levels = _open_levels(path, index) if index is not None and any(r is not None for r in rows) else []
+
+    # Never reuse the name of a level an earlier update left behind, which may still be mapped
+    generations = list(_level_files(path).values()) + ([index['generation']] if index is not None else [])
+    generation = max(generations) + 1 if generations else 0
+    names = [f"level{k + 1}.{generation}.npy" for k in range(len(shapes))]
+    levels = [np.lib.format.open_memmap(os.path.join(path, name), mode='w+', dtype=first.dtype,
+                                        shape=(len(file_list),) + shape + first.shape[2:])
+              for name, shape in zip(names, shapes)]
+
+    for i, row in enumerate(rows):
+        if row is not None:
+            for level, old_level in zip(levels, old_levels):
+                level[i] = old_level[row]
+
+    def build(i):
+        image = read_image(file_list[i])
+        for level in levels:
+            image = downsample(image)
+            level[i] = image
+
+    to_build = [i for i, row in enumerate(rows) if row is None]
+    n_done = len(file_list) - len(to_build)
+    print(f"Updating thumbnails of {directory}: {len(to_build)} new or changed images, {n_done} cached")
+    with ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:
+        for _ in executor.map(build, to_build):
+            n_done += 1
+            yield n_done, len(file_list)
+
+    for level in levels:
+        level.flush()
+    del levels, old_levels
+    index = {'generation': generation, 'files': file_list, 'keys': [list(k) for k in keys],
+             'shapes': [list(s) for s in shapes], 'dtype': str(first.dtype), 'levels': names}
+    with open(os.path.join(path, INDEX_NAME + '.tmp'), 'w') as f:
+        json.dump(index, f)
+    os.replace(os.path.join(path, INDEX_NAME + '.tmp'), os.path.join(path, INDEX_NAME))
+
+    # Levels of earlier generations, including ones an interrupted update left behind
+    _remove_stale_levels(path, names)
+    return _open_levels(path, index)
+
+
+def update_thumbnails(*args, **kwargs):
+    """
+    Run iter_update_thumbnails to completion.
+
+    :return: the cached levels, or None if the directory has no images.
+    """
+    update = iter_update_thumbnails(*args, **kwargs)
+    while True:
+        try:
+            next(update)
+        except StopIteration as e:
+            return e.value
+
+
+def multiscale_stack(directory, levels):
+    """
+    :param directory: tile directory or OME-Zarr tile group.
+    :param levels: thumbnail levels from iter_update_thumbnails.
+    :return: list of arrays, the lazily read full resolution stack
+             followed by the thumbnail levels, for a napari multiscale
+             image layer.
+    """
+    file_list, _ = load_image_list(directory)
+    return [lazy_imread_stack(file_list)] + list(levels)
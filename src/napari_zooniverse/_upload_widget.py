@@ -1,7 +1,8 @@
 import os
 import numpy as np
+from napari.layers import Image
+from napari.qt.threading import thread_worker
 from napari.utils.notifications import show_info, show_error
-from panoptes_client import Project, Panoptes
 from qtpy.QtGui import QFont
 from qtpy.QtWidgets import (QHBoxLayout,
                             QPushButton,
@@ -11,11 +12,21 @@ from qtpy.QtWidgets import (QHBoxLayout,
                             QLineEdit,
                             QFileDialog,
                             QFrame,
-                            QSpinBox)
-from skimage.io import imread
+                            QSpinBox,
+                            QCheckBox)
 from superqt import QCollapsible
 from pathlib import Path
-from ._utils import set_border, get_image_list, build_subject_set, initialise_subject_set
+from ._backend import PanoptesBackend
+from ._pipeline import iter_upload, plan_report
+from ._planner import plan_upload
+from ._qt_utils import set_border, ProgressWidget
+from ._export import read_skipped_tiles
+from ._manifest import read_manifest
+from ._scheduler import ScheduledBackend
+from ._thumbnails import iter_update_thumbnails, update_thumbnails, multiscale_stack
+from ._utils import load_image_list, lazy_imread_stack
+
+NO_IMAGES = "Directory selected contains no images of type .jpeg or .jpg"
 
 
 class QHLine(QFrame):
@@ -32,6 +43,7 @@ class UploadWidget(QWidget):
         # INITIALISE WIDGET
         # -----------------
         self.viewer = napari_viewer
+        self.backend = ScheduledBackend(PanoptesBackend())
         self.setLayout(QVBoxLayout())
 
         # ADDING PLUGIN TOOL NAME
@@ -63,6 +75,15 @@ class UploadWidget(QWidget):
         self.open_subject_collapsible.addWidget(self.view_subject_set)
         self.view_subject_set.clicked.connect(self._view_subject_set_napari)
 
+        # BROWSE RUN
+        self.browse_run_button = QPushButton("Browse Run")
+        self.browse_run_button.setToolTip('Show every subject set directory of a preprocessing run from cached '
+                                          'thumbnails, placed where each tile is in the volume. Only new or '
+                                          'changed images are decoded.')
+        set_border(self.browse_run_button)
+        self.open_subject_collapsible.addWidget(self.browse_run_button)
+        self.browse_run_button.clicked.connect(self._browse_run)
+
         set_border(self.open_subject_collapsible)
         self.layout().addWidget(self.open_subject_collapsible)
 
@@ -146,6 +167,39 @@ class UploadWidget(QWidget):
         subject_set_size_widget.layout().addWidget(self.subject_set_size_value)
         self.subject_collapse.addWidget(subject_set_size_widget)
 
+        # UPLOAD WORKERS
+        workers_widget = QWidget()
+        workers_widget.setLayout(QHBoxLayout())
+        set_border(workers_widget)
+        workers_label = QLabel("Upload Workers")
+        workers_widget.layout().addWidget(workers_label)
+        self.workers_value = QSpinBox()
+        self.workers_value.setMinimum(1)
+        self.workers_value.setValue(16)
+        self.workers_value.valueChanged.connect(self._set_max_concurrency)
+        self._set_max_concurrency(self.workers_value.value())
+        workers_widget.setToolTip('Maximum number of subjects uploaded to Zooniverse at the same time. '
+                                  'Requests are throttled further when Zooniverse slows down or rate limits.')
+        workers_widget.layout().addWidget(self.workers_value)
+        self.subject_collapse.addWidget(workers_widget)
+
+        # IMAGE SIZE BUDGET
+        budget_widget = QWidget()
+        budget_widget.setLayout(QHBoxLayout())
+        set_border(budget_widget)
+        budget_label = QLabel("Max Image Size (kB)")
+        budget_widget.layout().addWidget(budget_label)
+        self.max_image_kb_value = QSpinBox()
+        self.max_image_kb_value.setRange(0, 100000)
+        self.max_image_kb_value.setSpecialValueText("Off")
+        budget_widget.layout().addWidget(self.max_image_kb_value)
+        self.downscale_checkbox = QCheckBox("Downscale")
+        self.downscale_checkbox.setChecked(True)
+        budget_widget.layout().addWidget(self.downscale_checkbox)
+        budget_widget.setToolTip('Re-encode every image to at most this size before uploading it, lowering the '
+                                 'JPEG quality and, with Downscale, the image size. Off uploads images as exported.')
+        self.subject_collapse.addWidget(budget_widget)
+
         # SUBJECT SET NAME
         subject_set_label = QLabel("Subject Set Name:")
         self.subject_set_name = QLineEdit()
@@ -162,6 +216,14 @@ class UploadWidget(QWidget):
         self.subject_collapse.addWidget(self.subject_preview_button)
         self.subject_preview_button.clicked.connect(self._subject_set_preview)
 
+        # DRY RUN BUTTON
+        self.dry_run_button = QPushButton("Dry Run")
+        self.dry_run_button.setToolTip('Plan the upload and estimate the requests and bytes it will send, '
+                                       'without contacting Zooniverse.')
+        set_border(self.dry_run_button)
+        self.subject_collapse.addWidget(self.dry_run_button)
+        self.dry_run_button.clicked.connect(self._dry_run)
+
         set_border(self.subject_collapse)
         self.layout().addWidget(self.subject_collapse)
 
@@ -171,67 +233,62 @@ class UploadWidget(QWidget):
         self.upload_button.clicked.connect(self._upload)
         self.layout().addWidget(self.upload_button)
 
-    # TODO : UPLOAD SELECTED SUBJECT SET TO ZOONIVERSE PROJECT
+        # PROGRESS
+        # --------
+        self.progress = ProgressWidget()
+        self.layout().addWidget(self.progress)
+
     def _upload(self):
         print("napari has", len(self.viewer.layers), "layers")
 
-        span = self.span_value.value()
-        step = self.step_value.value()
-        subject_set_size = self.subject_set_size_value.value()
-
-        project = self.project
-
-        file_list, n_files = get_image_list(self._open_dir_path.text())
-        file_list.sort()
-
-        *prefix_list, z_str = file_list[0].split('_z')
-
-        minimum_z = int(z_str.split('.jpeg')[0])
-        starting_index = span * step + minimum_z  # This is the first index that we can build a 5 slice subject from
-        successful_uploads = 0
-        for counter, list_start_abs in enumerate(
-                range(starting_index, starting_index + n_files - 2 * span * step, subject_set_size)):
-            print(f"\n*******\nStep {counter}")
-            list_start = list_start_abs - minimum_z  # Make sure we subtract the offset
-            # Perform some text manipulation to extract the x, y, z values from the file name
-            file_name = os.path.split(file_list[list_start])[-1]  # Changed from [list_start_abs] - is this correct?!
-            *prefix_list, z_str = file_name.split('_z')
-            if len(prefix_list) > 1:
-                prefix = "_z".join(prefix_list)
-            else:
-                prefix = prefix_list[0]
-            z_start = int(z_str.split('.jpeg')[0])
-            z_end = int(z_start) + subject_set_size - 1
-            if int(z_end) >= (minimum_z + n_files - span * step):
-                z_end = minimum_z + n_files - span * step - 1
-                print(f"There are fewer than the requested {subject_set_size} subjects in this subject set")
-            if int(z_start) < starting_index or int(z_end) > (
-                    starting_index + n_files - span * step):  # Skip the highest and lowest z slices
-                print(f"Skipping, can't build {2 * span + 1} slice subject from slice {z_start}")
-                continue
-
-            print(f"List start (abs): {list_start_abs}\n"
-                  f"List start (centre index): {list_start}\n"
-                  f"Z start: {z_start}\n"
-                  f"Indices to be included: {z_start - 2 * step}, {z_start - 1 * step}, {z_start}, {z_start + 1 * step}, {z_start + 2 * step}\n\n"
-                  f"Filename: {file_name}\n"
-                  f"Start index: {starting_index}\n")
-            list_end = z_end - minimum_z  # list_start + subject_set_size
-            subject_set_name = f"{span}_{step}_{prefix}_z{z_start}-{z_end:04d}"
-            print(subject_set_name)
-
-            try:
-                subject_set = initialise_subject_set(project, subject_set_name)
-            except:
-                print(f"Subject set name {subject_set_name} appears to already be taken, skipping\n\n")
-                continue
-                # TODO: output a logfile with skipped subject set names
-            print(f"Creating subject set name {subject_set_name}\n\n")
-            subjects = build_subject_set(project, file_list, list_start, list_end, span, step, testing=False)
-            subject_set.add(subjects)
-            successful_uploads += 1
-
-        print(f"Done, I have processed {successful_uploads} subject sets")
+        worker = thread_worker(iter_upload)(self.project,
+                                            self._open_dir_path.text(),
+                                            self.span_value.value(),
+                                            self.step_value.value(),
+                                            self.subject_set_size_value.value(),
+                                            n_workers=self.workers_value.value(),
+                                            backend=self.backend,
+                                            max_image_bytes=self._max_image_bytes(),
+                                            downscale=self.downscale_checkbox.isChecked())
+        worker.returned.connect(self._on_upload_finished)
+        self._start(worker, "Uploading subjects", unit="subjects")
+
+    def _start(self, worker, description, unit="items"):
+        # The progress bar follows one worker, so the other actions wait for it. Exceptions
+        # raised in the worker are shown by napari once they reach the main thread
+        worker.finished.connect(lambda: self._set_busy(False))
+        self._set_busy(True)
+        self.progress.start(worker, description, unit=unit)
+
+    def _set_busy(self, busy):
+        for button in (self.view_subject_set, self.browse_run_button, self.subject_preview_button,
+                       self.dry_run_button, self.upload_button):
+            button.setEnabled(not busy)
+
+    def _set_max_concurrency(self, n_workers):
+        # Never more requests in flight than upload workers
+        scheduler = self.backend.scheduler
+        scheduler.max_concurrency = n_workers
+        scheduler.limit = min(scheduler.limit, n_workers)
+
+    def _max_image_bytes(self):
+        return self.max_image_kb_value.value() * 1000 or None
+
+    def _on_upload_finished(self, result):
+        successful_uploads, failed_subjects = result
+        if failed_subjects:
+            show_error(f"{failed_subjects} subjects failed to upload, run the upload again to retry them")
+        else:
+            show_info(f"Uploaded {successful_uploads} subject sets")
+
+    def _dry_run(self):
+        worker = thread_worker(plan_report)(self._open_dir_path.text(),
+                                            self.span_value.value(),
+                                            self.step_value.value(),
+                                            self.subject_set_size_value.value(),
+                                            max_image_bytes=self._max_image_bytes())
+        worker.returned.connect(show_info)
+        self._start(worker, "Planning upload")
 
     def _open_dir_dialogue(self):
         """
@@ -246,58 +303,140 @@ class UploadWidget(QWidget):
 
     def _login(self):
         try:
-            self.user = Panoptes.connect(username=self.zooniverse_username.text(),
-                                         password=self.zooniverse_password.text())
-            self.project = Project.find(slug=self.zooniverse_project.text())
+            self.user = self.backend.connect(username=self.zooniverse_username.text(),
+                                             password=self.zooniverse_password.text())
+            self.project = self.backend.find_project(self.zooniverse_project.text())
             show_info("Connected to Zooniverse")
         except Exception as e:
             show_error("Exception {}".format(e))
 
     def _subject_set_preview(self):
-
-        image = self.validate_directory()
-
-        span = self.span_value.value()
-        step = self.step_value.value()
-        subject_set_size = self.subject_set_size_value.value()
-
-        starting_index = span * step
-
-        subject_set = []
-        for counter, list_start_abs in enumerate(
-                range(starting_index, starting_index + len(image) - 2 * span * step, subject_set_size)):
-            subject = []
-            for i, idx in enumerate(range(list_start_abs - step * span, list_start_abs + (step * span) + 1, step)):
-                subject.append(image[idx])
-            subject_set.append(subject)
-
-        subject_set = np.asarray(subject_set)
-
         if len(self.subject_set_name.text()) == 0:
             self.subject_set_name.setText(os.path.basename(self._open_dir_path.text()))
 
-        self.viewer.add_image(np.asarray(subject_set), name=self.subject_set_name.text())
+        worker = thread_worker(self._build_subject_set_preview)(self._open_dir_path.text(),
+                                                                self.span_value.value(),
+                                                                self.step_value.value(),
+                                                                self.subject_set_size_value.value())
+        name = self.subject_set_name.text()
+        worker.returned.connect(lambda preview: self._add_stack(preview, name))
+        self._start(worker, "Loading subject set preview")
 
-    def _view_subject_set_napari(self):
-
-        preview_image_stack = self.validate_directory()
+    @staticmethod
+    def _build_subject_set_preview(directory, span, step, subject_set_size):
+        image = open_stack(directory)
+        if len(image) < 2 * span * step + 1:
+            raise ValueError(f"{len(image)} images are too few for one subject of span {span} and step {step}")
 
-        self.viewer.add_image(preview_image_stack, name=os.path.basename(self._open_dir_path.text()))
+        # One row per subject set: the slice indices of its first subject
+        plan = plan_upload(len(image), span, step, subject_set_size)
+        windows = plan.members[np.searchsorted(plan.centre, plan.set_start)]
 
-    def validate_directory(self):
-        only_files = [f for f in os.listdir(self._open_dir_path.text()) if
-                      os.path.isfile(os.path.join(self._open_dir_path.text(), f)) and
-                      f.lower().endswith(('.jpeg', 'jpg'))]
+        # Indexing the lazy stack only records which slices to read
+        return image[windows.ravel()].reshape(windows.shape + image.shape[1:])
 
-        only_files.sort()
-
-        if len(only_files) == 0:
-            show_error("Directory selected contains no images of type .jpeg or .jpg")
+    def _view_subject_set_napari(self):
+        """
+        Show the lazily read stack of a subject set directory straight
+        away, then swap in a multiscale layer once its thumbnail pyramid
+        is built, so zooming out no longer decodes every image.
+        """
+        directory = self._open_dir_path.text()
+        stack = self.validate_directory(directory)
+        if stack is None:
+            return
+        layer = self.viewer.add_image(stack, name=os.path.basename(directory))
+        worker = thread_worker(self._load_thumbnails)(directory)
+        worker.returned.connect(lambda levels: self._add_levels(layer, levels))
+        self._start(worker, "Loading subject set thumbnails", unit="images")
+
+    def _add_levels(self, layer, levels):
+        # The layer may have been closed while the pyramid was built
+        if levels is None or layer not in self.viewer.layers:
             return
+        index = self.viewer.layers.index(layer)
+        multiscale = Image([layer.data] + list(levels), multiscale=True, name=layer.name,
+                           contrast_limits=layer.contrast_limits, colormap=layer.colormap)
+        self.viewer.layers.remove(layer)
+        self.viewer.layers.insert(index, multiscale)
+
+    def _browse_run(self):
+        run_directory = QFileDialog.getExistingDirectory(self, 'Run Directory', str(Path))
+        if run_directory == '':
+            return
+        worker = thread_worker(self._load_run_thumbnails)(run_directory)
+        worker.returned.connect(self._add_run)
+        self._start(worker, "Loading run thumbnails", unit="directories")
+
+    @staticmethod
+    def _load_thumbnails(directory):
+        levels = yield from iter_update_thumbnails(directory)
+        if levels is None:
+            raise ValueError(NO_IMAGES)
+        return levels
+
+    @staticmethod
+    def _load_run_thumbnails(run_directory):
+        """
+        :param run_directory: `subject_sets` directory, OME-Zarr store or
+                              the directory holding either.
+        :return: yields (directories done, total directories); returns
+                 a list of (name, multiscale stack, translate).
+        """
+        directories = []
+        for store in (run_directory, os.path.join(run_directory, 'subject_sets'),
+                      os.path.join(run_directory, 'subject_sets.zarr')):
+            if not os.path.isdir(store):
+                continue
+            skipped = read_skipped_tiles(store)
+            directories = sorted(entry.path for entry in os.scandir(store)
+                                 if entry.is_dir() and entry.name.startswith('image_x') and entry.name not in skipped)
+            if directories:
+                break
+        if not directories:
+            raise ValueError(f"No subject set directories in {run_directory}")
+
+        tiles = []
+        for n_done, directory in enumerate(directories, start=1):
+            levels = update_thumbnails(directory)
+            yield n_done, len(directories)
+            if levels is None:
+                continue
+            manifest = read_manifest(directory)
+            translate = (0, manifest['rows'][0], manifest['cols'][0]) if manifest is not None else (0, 0, 0)
+            tiles.append((os.path.basename(directory), multiscale_stack(directory, levels), translate))
+        return tiles
 
-        preview_image_stack = []
-        for file in only_files:
-            file_path = os.path.join(self._open_dir_path.text(), file)
-            preview_image_stack.append(imread(file_path))
+    def _add_run(self, tiles):
+        for name, stack, translate in tiles:
+            self._add_stack(stack, name, translate=translate)
 
-        return np.asarray(preview_image_stack)
+    def _add_stack(self, stack, name, translate=None):
+        if stack is None:
+            return
+        if isinstance(stack, list):
+            multiscale = len(stack) > 1
+            self.viewer.add_image(stack if multiscale else stack[0], name=name, multiscale=multiscale,
+                                  translate=translate)
+        else:
+            self.viewer.add_image(stack, name=name, translate=translate)
+
+    def validate_directory(self, directory=None):
+        if directory is None:
+            directory = self._open_dir_path.text()
+        try:
+            return open_stack(directory)
+        except ValueError as e:
+            show_error(str(e))
+
+
+def open_stack(directory):
+    """
+    :return: lazily read (z, row, column) stack of the images of a tile
+             directory.
+    :raises ValueError: if the directory holds no images.
+    """
+    file_list, _ = load_image_list(directory)
+    if len(file_list) == 0:
+        raise ValueError(NO_IMAGES)
+    return lazy_imread_stack(file_list)
@@ -1,93 +1,411 @@
+import io
 import os
-from qtpy.QtWidgets import (QLabel,
-                            QWidget,
-                            QHBoxLayout)
-from magicgui.widgets import create_widget
-from panoptes_client import Project, Panoptes, Subject, SubjectSet
+import re
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+import dask.array as da
+import numpy as np
+from skimage.io import imread
+from ._backend import PanoptesBackend
+from ._export import jpeg_quality
+from ._journal import SAVED, LINKED
+from ._manifest import read_manifest
+from ._planner import centre_bounds, subject_members
+from ._zarr_store import is_zarr_tile, open_tile_array, tile_file_names, read_plane_jpeg
 
 
-def make_widget(annotation, label):
-    w = QWidget()
-    w.setLayout(QHBoxLayout())
-    w.layout().addWidget(QLabel(label))
+_IMAGE_NAME = re.compile(r'_x(\d+)_y(\d+)_z(\d+)\.jpe?g$', re.IGNORECASE)
 
-    magic_w = create_widget(annotation=annotation, label=label)
-    w.layout().addWidget(magic_w.native)
+# Sorted file names of a directory with the (x, y, z) index parsed from each name,
+# -1 where a name does not follow the export naming scheme
+ImageIndex = namedtuple('ImageIndex', ['files', 'x', 'y', 'z'])
 
-    set_border(w)
+_scan_cache = {}
 
-    return w, magic_w
 
+def scan_image_directory(input_directory):
+    """
+    Index the JPEG images of a directory in a single `os.scandir` pass,
+    parsing the (x, y, z) index of every name once and sorting
+    numerically by it. Results are cached per directory and reused
+    until the directory's mtime changes, i.e. until files are added,
+    removed or renamed.
 
-def set_border(widget: QWidget, spacing=2, margin=0):
-    if hasattr(widget.layout(), "setContentsMargins"):
-        widget.layout().setContentsMargins(margin, margin, margin, margin)
-    if hasattr(widget.layout(), "setSpacing"):
-        widget.layout().setSpacing(spacing)
+    :param input_directory: directory to scan.
+    :return: ImageIndex of file names and NumPy index arrays.
+    """
+    path = os.path.abspath(input_directory)
+    mtime = os.stat(path).st_mtime_ns
+    cached = _scan_cache.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    entries = []
+    with os.scandir(path) as it:
+        for entry in it:
+            # DirEntry.is_file uses the type returned by the listing, no extra stat
+            if not entry.name.lower().endswith(('.jpeg', '.jpg')) or not entry.is_file():
+                continue
+            match = _IMAGE_NAME.search(entry.name)
+            index = tuple(int(i) for i in match.groups()) if match else (-1, -1, -1)
+            entries.append(index + (entry.name,))
+    entries.sort()
+
+    index = ImageIndex(files=[e[3] for e in entries],
+                       x=np.array([e[0] for e in entries], dtype=np.int64),
+                       y=np.array([e[1] for e in entries], dtype=np.int64),
+                       z=np.array([e[2] for e in entries], dtype=np.int64))
+    _scan_cache[path] = (mtime, index)
+    return index
 
 
 def get_image_list(input_directory):
-    file_list = [os.path.join(input_directory, f) for f in os.listdir(input_directory) if
-                 os.path.isfile(os.path.join(input_directory, f)) and
-                 f.lower().endswith(('.jpeg', 'jpg'))]
+    index = scan_image_directory(input_directory)
+    file_list = [os.path.join(input_directory, f) for f in index.files]
 
     n_files = len(file_list)
     print(f"There are {n_files} jpg files in the directory {input_directory}")
     return file_list, n_files
 
 
-def build_subject(project, file_list, centre_idx, span, step):
-    subject = Subject()  # Inititialise a subject
-    subject.links.project = project  # ...attach it to a project
-    subject.metadata['Subject ID'] = centre_idx - step * span + 1  # Add the names of the images
+def load_image_list(input_directory):
+    """
+    Image paths of a tile directory sorted by z, together with their z
+    indices. They are read from the manifest written by the
+    preprocessing export when there is one, otherwise from a cached scan
+    of the directory. The images of an OME-Zarr tile group are named
+    like JPEG files in the group; read_media encodes them.
+
+    :param input_directory: tile directory or OME-Zarr tile group.
+    :return: list of image paths and NumPy array of z indices.
+    """
+    manifest = read_manifest(input_directory)
+    if manifest is not None:
+        return [os.path.join(input_directory, f) for f in manifest['files']], manifest['z']
+    if is_zarr_tile(input_directory):
+        file_names, z = tile_file_names(input_directory)
+        return [os.path.join(input_directory, f) for f in file_names], z
+
+    index = scan_image_directory(input_directory)
+    return [os.path.join(input_directory, f) for f in index.files], index.z
+
+
+def lazy_imread_stack(file_list):
+    """
+    Stack a list of images into a dask array with one chunk per image.
+    Only the first image is decoded up front, to find the shape and
+    dtype; every other image is decoded when its chunk is requested, so
+    napari only reads the slices it displays.
+
+    Images of an OME-Zarr tile group are read from its array instead,
+    without decoding any JPEG.
+
+    :param file_list: sorted list of image paths of equal shape.
+    :return: dask array of shape (len(file_list),) + image shape.
+    """
+    directory = os.path.dirname(file_list[0])
+    if is_zarr_tile(directory):
+        z = [int(_IMAGE_NAME.search(f).group(3)) for f in file_list]
+        stack = da.from_zarr(open_tile_array(directory))
+        return stack if z == list(range(stack.shape[0])) else stack[z]
+
+    first = imread(file_list[0])
+
+    def read_slice(block_info=None):
+        z = block_info[None]['array-location'][0][0]
+        return imread(file_list[z])[np.newaxis]
+
+    return da.map_blocks(read_slice,
+                         chunks=((1,) * len(file_list),) + tuple((n,) for n in first.shape),
+                         dtype=first.dtype,
+                         meta=np.empty((0,) * (first.ndim + 1), dtype=first.dtype))
+
+
+def lazy_volume(volume):
+    """
+    Wrap a (z, row, column) array-like, e.g. a memory-mapped or zarr
+    volume, as a dask array with one chunk per z slice that reads a
+    slice from `volume` only when its chunk is requested.
+    `da.from_array` is not used as it copies array-likes first.
+
+    :param volume: array-like indexed by z.
+    :return: dask array of the same shape and dtype.
+    """
+    if isinstance(volume, da.Array):
+        return volume
+
+    def read_slice(block_info=None):
+        z = block_info[None]['array-location'][0][0]
+        return np.asarray(volume[z])[np.newaxis]
+
+    return da.map_blocks(read_slice,
+                         chunks=((1,) * volume.shape[0],) + tuple((n,) for n in volume.shape[1:]),
+                         dtype=volume.dtype,
+                         meta=np.empty((0,) * volume.ndim, dtype=volume.dtype))
+
+
+def read_image(path):
+    """
+    :param path: image path from load_image_list.
+    :return: the decoded image, read straight from the array of an
+             OME-Zarr tile group.
+    """
+    if not os.path.isfile(path) and is_zarr_tile(os.path.dirname(path)):
+        z = int(path.rsplit('_z', 1)[1].split('.', 1)[0])
+        return np.asarray(open_tile_array(os.path.dirname(path))[z])
+    return imread(path)
+
+
+def _read_media_bytes(path):
+    if os.path.isfile(path) or not is_zarr_tile(os.path.dirname(path)):
+        with open(path, 'rb') as f:
+            return f.read()
+    return read_plane_jpeg(path)
+
+
+def read_media(path, media_cache=None, encoder=None):
+    """
+    :param path: image path from load_image_list.
+    :param media_cache: MediaCache shared by the subjects of an upload.
+    :param encoder: BudgetEncoder re-encoding images to a byte budget.
+    :return: the path of an image file, or the JPEG bytes of an image of
+             an OME-Zarr tile group, for a backend to upload; the bytes
+             of either through `media_cache` when one is given, and as
+             re-encoded by `encoder` when one is given.
+    """
+    load = encoder.encode if encoder is not None else _read_media_bytes
+    if media_cache is not None:
+        return media_cache.get(path, load)[0]
+    if encoder is not None:
+        return encoder.encode(path)
+    if os.path.isfile(path) or not is_zarr_tile(os.path.dirname(path)):
+        return path
+    return read_plane_jpeg(path)
+
+
+# JPEG quality of uploaded images by path, with the modification time of a file or the digest of cached bytes
+_quality_cache = {}
+_QUALITY_CACHE_SIZE = 2 ** 16
+
+
+def media_quality(path, location, media_cache=None, encoder=None):
+    """
+    :param path: image path from load_image_list.
+    :param location: what read_media returned for `path`.
+    :param media_cache: MediaCache `location` was read through.
+    :param encoder: BudgetEncoder `location` was encoded by.
+    :return: JPEG quality of the uploaded image, as `encoder` recorded
+             it or parsed once per image rather than once per subject
+             it is a frame of; None if it is not a JPEG.
+    """
+    if encoder is not None and path in encoder.qualities:
+        return encoder.qualities[path]
+    if isinstance(location, bytes):
+        digest = media_cache.digest(path) if media_cache is not None else None
+        if digest is None:
+            return jpeg_quality(io.BytesIO(location))
+        key = (path, digest)
+    else:
+        key = (path, os.stat(location).st_mtime_ns)
+    if key not in _quality_cache:
+        if len(_quality_cache) >= _QUALITY_CACHE_SIZE:
+            _quality_cache.clear()
+        _quality_cache[key] = jpeg_quality(io.BytesIO(location) if isinstance(location, bytes) else location)
+    return _quality_cache[key]
+
+
+# Backend used when a function is not given one explicitly
+DEFAULT_BACKEND = PanoptesBackend()
+
+
+def build_subject(project, file_list, centre_idx, span, step, backend=None, media_cache=None, encoder=None):
+    backend = backend or DEFAULT_BACKEND
+    locations = []
+    metadata = {'Subject ID': centre_idx - step * span + 1}  # Add the names of the images
 
     # For loop to attach the images to the subject one-by-one
-    for i, idx in enumerate(range(centre_idx - step * span, centre_idx + (step * span) + 1, step)):
+    for i, idx in enumerate(subject_members(centre_idx, span, step)):
         fname = str(file_list[idx])
         print("Attaching %s to subject %d" % (os.path.basename(fname), centre_idx - step * span + 1))
-        subject.add_location(fname)
-        subject.metadata['Image %d' % i] = os.path.basename(fname)
-    subject.metadata['default_frame'] = span + 1  # We want people to annotate the middle image
+        locations.append(read_media(fname, media_cache, encoder))
+        metadata['Image %d' % i] = os.path.basename(fname)
+    metadata['default_frame'] = span + 1  # We want people to annotate the middle image
 
     # Metadata from here should be changed according to the data
-    subject.metadata['Microscope'] = 'SBF SEM (with FCC)'
-    subject.metadata['Raw XY resolution (nm)'] = 5
-    subject.metadata['Raw Z resolution (nm)'] = 50
-    subject.metadata['Scaling factor'] = 2
-    subject.metadata['jpeg quality (%)'] = 90
-    subject.metadata['Attribution'] = 'Matt Russell'
-    subject.metadata['Description'] = 'MP009_FCC_5-161118_Cell1registered-binnedx2 (HeLa)'
+    metadata['Microscope'] = 'SBF SEM (with FCC)'
+    metadata['Raw XY resolution (nm)'] = 5
+    metadata['Raw Z resolution (nm)'] = 50
+    metadata['Scaling factor'] = 2
+    # What the uploaded images were actually encoded with, the lowest of them
+    qualities = [media_quality(str(file_list[idx]), location, media_cache, encoder)
+                 for idx, location in zip(subject_members(centre_idx, span, step), locations)]
+    metadata['jpeg quality (%)'] = min((q for q in qualities if q is not None), default=None)
+    if encoder is not None:
+        metadata['Upload scale'] = encoder.scale
+    metadata['Attribution'] = 'Matt Russell'
+    metadata['Description'] = 'MP009_FCC_5-161118_Cell1registered-binnedx2 (HeLa)'
     print("Starting to save")
-    print(subject)
-    subject.save()
+    subject = backend.save_subject(project, locations, metadata)
     print("Subject saved")
 
     return subject
 
 
-def initialise_subject_set(project, subject_name):
-    subject_set = SubjectSet()
-    subject_set.links.project = project
-    subject_set.display_name = subject_name
-    subject_set.save()
-    return subject_set
+def initialise_subject_set(project, subject_name, backend=None):
+    return (backend or DEFAULT_BACKEND).create_subject_set(project, subject_name)
+
+
+def find_subject_set(subject_set_id, backend=None):
+    return (backend or DEFAULT_BACKEND).find_subject_set(subject_set_id)
 
 
-def build_subject_set(project, file_list, file_idx_start, file_idx_stop, span, step, testing=False):
+def subject_centres(file_list, file_idx_start, file_idx_stop, span, step):
+    """
+    :return: planned subject centres between two list indices, inclusive.
+    """
+    first, stop = centre_bounds(len(file_list), span, step)
+    return range(max(first, file_idx_start), min(stop - 1, file_idx_stop) + 1)
+
+
+def build_subject_set(project, file_list, file_idx_start, file_idx_stop, span, step, n_workers=1, backend=None,
+                      media_cache=None, encoder=None):
     print(f"project {project}\n",
           f"file_idx_start {file_idx_start}\n",
           f"file_idx_stop {file_idx_stop}\n",
           f"span {span}\n",
           f"step {step}")
     print(f"Building subject set from files {file_idx_start}-{file_idx_stop}")
-    subjects = []
-    min_idx = 0
-    max_idx = len(file_list) - span * step
+    centres = subject_centres(file_list, file_idx_start, file_idx_stop, span, step)
+
+    if n_workers <= 1:
+        return [build_subject(project, file_list, centre_idx, span, step, backend, media_cache, encoder)
+                for centre_idx in centres]
+
+    # Subjects are returned in file order regardless of which upload finishes first
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        return list(executor.map(lambda centre_idx: build_subject(project, file_list, centre_idx, span, step,
+                                                                  backend, media_cache, encoder),
+                                 centres))
+
+
+def iter_upload_subject_set(project, subject_set, file_list, file_idx_start, file_idx_stop, span, step,
+                            n_workers=4, batch_size=50, journal=None, subject_set_name=None, backend=None,
+                            media_cache=None, encoder=None):
+    """
+    Build and save the subjects of a subject set on a bounded pool of
+    worker threads, linking them to `subject_set` in batches as they
+    finish. A failed subject does not stop the others.
+
+    When a `journal` is given every subject is recorded under
+    `subject_set_name` as it is saved and linked. Subjects the journal
+    already lists as linked are skipped and subjects that were saved but
+    not linked are linked by ID without being uploaded again.
+
+    New uploads are only started while the generator is being consumed,
+    so closing it early leaves at most `n_workers` uploads to finish.
+
+    :param project: Zooniverse project the subjects are attached to.
+    :param subject_set: saved SubjectSet the subjects are linked to.
+    :param file_list: sorted list of image paths.
+    :param file_idx_start: list index of the first subject centre.
+    :param file_idx_stop: list index of the last subject centre.
+    :param span: number of slices either side of the centre slice.
+    :param step: distance in slices between the images of a subject.
+    :param n_workers: maximum number of subjects uploaded at once.
+    :param batch_size: number of saved subjects linked per request.
+    :param journal: optional UploadJournal used to resume an upload.
+    :param subject_set_name: name the subjects are journaled under.
+    :param backend: Zooniverse backend, the live Panoptes API by default.
+    :param media_cache: MediaCache so images shared by overlapping subjects
+                        are read once.
+    :param encoder: BudgetEncoder re-encoding images to a byte budget.
+    :return: yields (centre index, subject or Zooniverse ID, exception or
+             None) each time a subject is saved, linked or fails. The
+             last report for a centre index is its outcome.
+    """
+    backend = backend or DEFAULT_BACKEND
+    centres = subject_centres(file_list, file_idx_start, file_idx_stop, span, step)
+    pending_links = []
+    to_upload = list(centres)
+
+    if journal is not None:
+        journal.plan_subjects(subject_set_name, centres)
+        to_upload = []
+        for centre_idx in centres:
+            entry = journal.subject(subject_set_name, centre_idx)
+            if entry['state'] == LINKED:
+                yield centre_idx, entry['id'], None
+            elif entry['state'] == SAVED:
+                pending_links.append((centre_idx, entry['id']))
+            else:
+                to_upload.append(centre_idx)
+        if len(to_upload) < len(centres):
+            print(f"Resuming {subject_set_name}: {len(centres) - len(to_upload)} subjects already uploaded, "
+                  f"{len(to_upload)} remaining")
+
+    def link(batch):
+        try:
+            backend.link_subjects(subject_set, [subject for _, subject in batch])
+        except Exception as e:
+            # Saved but unlinked subjects are reported as failures
+            return [(centre_idx, subject, e) for centre_idx, subject in batch]
+        if journal is not None:
+            journal.subjects_linked(subject_set_name, [centre_idx for centre_idx, _ in batch])
+        return [(centre_idx, subject, None) for centre_idx, subject in batch]
+
+    def save(centre_idx):
+        subject = build_subject(project, file_list, centre_idx, span, step, backend, media_cache, encoder)
+        # Journal straight away so an upload finishing after a cancel is not repeated
+        if journal is not None:
+            journal.subject_saved(subject_set_name, centre_idx, subject.id)
+        return subject
+
+    n_workers = max(1, n_workers)
+    queued = iter(to_upload)
+    running = {}
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        while True:
+            for centre_idx in islice(queued, n_workers - len(running)):
+                running[executor.submit(save, centre_idx)] = centre_idx
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                centre_idx = running.pop(future)
+                try:
+                    subject = future.result()
+                except Exception as e:
+                    print(f"Subject centred on file {centre_idx} failed: {e}")
+                    yield centre_idx, None, e
+                    continue
+                print(f"Subject centred on file {centre_idx} saved")
+                pending_links.append((centre_idx, subject))
+                yield centre_idx, subject, None
+
+            if len(pending_links) >= batch_size:
+                yield from link(pending_links)
+                pending_links = []
+
+    if pending_links:
+        yield from link(pending_links)
+
+
+def upload_subject_set(*args, **kwargs):
+    """
+    Run iter_upload_subject_set to completion.
 
-    for centre_idx in range(max(min_idx, file_idx_start), min(max_idx, file_idx_stop) + 1):
-        if testing:
-            print(f"Testing for subject centred on file {centre_idx} in the list")
+    :return: dict of centre index to saved subject (or its Zooniverse ID
+             when resumed from the journal) and dict of centre index to
+             the exception raised while building or linking it.
+    """
+    succeeded, failed = {}, {}
+    for centre_idx, subject, error in iter_upload_subject_set(*args, **kwargs):
+        if error is None:
+            succeeded[centre_idx] = subject
+            failed.pop(centre_idx, None)
         else:
-            subject = build_subject(project, file_list, centre_idx, span, step)
-            subjects.append(subject)
-    return subjects
+            failed[centre_idx] = error
+            succeeded.pop(centre_idx, None)
+    return succeeded, failed
@@ -1,4 +1,7 @@
 from pathlib import Path
+import numpy as np
+from napari.qt.threading import thread_worker
+from napari.utils.notifications import show_error
 from qtpy.QtGui import QFont
 from qtpy.QtWidgets import (QHBoxLayout,
                             QPushButton,
@@ -8,9 +11,13 @@ from qtpy.QtWidgets import (QHBoxLayout,
                             QLineEdit,
                             QFileDialog,
                             QFrame,
-                            QSpinBox)
+                            QSpinBox,
+                            QCheckBox,
+                            QDoubleSpinBox)
 from superqt import QCollapsible
-from ._utils import set_border
+from ._classifications import ClassificationStore, Consensus, iter_load_consensus
+from ._qt_utils import set_border, ProgressWidget
+from ._subject_index import SubjectIndex, run_tile_shapes
 
 
 class VisualiseClassificationWidget(QWidget):
@@ -45,9 +52,59 @@ class VisualiseClassificationWidget(QWidget):
         self.zooniverse_csv_collapsible.addWidget(open_csv_widget)
         self._open_csv_button.clicked.connect(self._open_csv_dialogue)
 
+        # LOADED CLASSIFICATIONS
+        self.classifications = None
+        self.consensus = None
+        self._classifications_summary = QLabel("No classifications loaded")
+        self._classifications_summary.setWordWrap(True)
+        self.zooniverse_csv_collapsible.addWidget(self._classifications_summary)
+
         set_border(self.zooniverse_csv_collapsible)
         self.layout().addWidget(self.zooniverse_csv_collapsible)
 
+        # SHOW CONSENSUS
+        # --------------
+        self.consensus_collapsible = QCollapsible("2. Show Consensus", self)
+
+        # RUN DIRECTORY, FOR THE EXTENT OF THE TILES
+        self._run_dir_button = QPushButton("Run Directory")
+        self._run_dir_path = QLineEdit()
+        run_dir_widget = QWidget()
+        run_dir_widget.setLayout(QHBoxLayout())
+        run_dir_widget.layout().addWidget(self._run_dir_button)
+        run_dir_widget.layout().addWidget(self._run_dir_path)
+        set_border(run_dir_widget)
+        self.consensus_collapsible.addWidget(run_dir_widget)
+        self._run_dir_button.clicked.connect(self._open_run_dir_dialogue)
+
+        # AGREEMENT
+        self.min_agreement = QDoubleSpinBox()
+        self.min_agreement.setRange(0.0, 1.0)
+        self.min_agreement.setSingleStep(0.05)
+        self.min_agreement.setValue(0.5)
+        self.default_frame_checkbox = QCheckBox("Default Frame Only")
+        self.in_view_checkbox = QCheckBox("Only Subjects In View")
+        agreement_widget = QWidget()
+        agreement_widget.setLayout(QHBoxLayout())
+        agreement_widget.layout().addWidget(QLabel("Minimum Agreement"))
+        agreement_widget.layout().addWidget(self.min_agreement)
+        agreement_widget.layout().addWidget(self.default_frame_checkbox)
+        agreement_widget.layout().addWidget(self.in_view_checkbox)
+        set_border(agreement_widget)
+        self.consensus_collapsible.addWidget(agreement_widget)
+
+        self.show_consensus_button = QPushButton("Show Consensus")
+        self.show_consensus_button.clicked.connect(self._show_consensus)
+        self.consensus_collapsible.addWidget(self.show_consensus_button)
+
+        set_border(self.consensus_collapsible)
+        self.layout().addWidget(self.consensus_collapsible)
+
+        # PROGRESS
+        # --------
+        self.progress = ProgressWidget()
+        self.layout().addWidget(self.progress)
+
     def _open_csv_dialogue(self):
         """
         If the `Open File` button is clicked a FielDialog will open
@@ -63,6 +120,92 @@ class VisualiseClassificationWidget(QWidget):
         zooniverse_file = QFileDialog.getOpenFileName(qfd, "Zooniverse CSV File", path, file_filter)
 
         self._open_csv_path.setText(zooniverse_file[0])
+        print(zooniverse_file)
+        if zooniverse_file[0]:
+            self._load_classifications(zooniverse_file[0])
+
+    def _load_classifications(self, path):
+        """
+        Stream a classification export into the ClassificationStore on a
+        worker thread, which also aggregates the consensus after every
+        chunk; only summaries reach the GUI. The consensus can be shown
+        at any time, of the classifications loaded so far. Opening a
+        newer export of the same project only adds the classifications
+        made since the last one.
+
+        :param path: classification export CSV.
+        """
+        if self.classifications is None:
+            self.classifications = ClassificationStore()
+            self.consensus = Consensus()
+        worker = thread_worker(iter_load_consensus)(path, self.classifications, self.consensus)
+        worker.yielded.connect(lambda progress: self._classifications_summary.setText(progress[2]))
+        worker.returned.connect(self._classifications_summary.setText)
+        worker.finished.connect(lambda: self._set_loading(False))
+        self._set_loading(True)
+        self.progress.start(worker, "Loading classifications", unit="bytes")
+
+    def _set_loading(self, loading):
+        # One export loads into the store at a time
+        self._open_csv_button.setEnabled(not loading)
+
+    def _viewport(self):
+        """
+        :return: (z, row, column) ranges of the volume the viewer shows,
+                 the z range unbounded when it displays in 3D.
+        """
+        camera = self.viewer.scene.camera
+        centre = np.asarray(camera.center[-2:])
+        half = np.asarray(self.viewer.canvas.size) / camera.zoom / 2
+        row_range, col_range = zip(np.floor(centre - half).astype(int), np.ceil(centre + half).astype(int) + 1)
+        z_range = None
+        if self.viewer.dims.ndisplay == 2 and self.viewer.dims.ndim > 2:
+            z = int(round(self.viewer.dims.point[-3]))
+            z_range = (z, z + 1)
+        return z_range, row_range, col_range
+
+    def _open_run_dir_dialogue(self):
+        run_directory = QFileDialog.getExistingDirectory(self, 'Run Directory', str(Path))
+        self._run_dir_path.setText(run_directory)
+
+    def _show_consensus(self):
+        """
+        Place the consensus points and polygons of every subject in the
+        volume, through a SubjectIndex of the loaded subjects, as Points
+        and Shapes layers, replacing the layers of an earlier consensus.
+        With `Only Subjects In View` checked, only the subjects the index
+        finds in the current view are placed.
+        """
+        if self.consensus is None:
+            show_error("Load a Zooniverse CSV first")
+            return
+        run_directory = self._run_dir_path.text()
+        index = SubjectIndex(self.classifications, run_tile_shapes(run_directory) if run_directory else None)
+        min_agreement = self.min_agreement.value()
+        default_frame_only = self.default_frame_checkbox.isChecked()
+
+        in_view = index.query(*self._viewport()) if self.in_view_checkbox.isChecked() else None
+
+        for name in ("consensus points", "consensus polygons"):
+            if name in self.viewer.layers:
+                self.viewer.layers.remove(name)
 
+        data, features = self.consensus.points(default_frame_only=default_frame_only, min_agreement=min_agreement)
+        data, found = index.to_volume(features['subject_id'], data)
+        if in_view is not None:
+            found &= np.isin(features['subject_id'], in_view)
+        if found.any():
+            self.viewer.add_points(data[found], features={k: v[found] for k, v in features.items()},
+                                   name="consensus points", face_color='agreement', size=10)
 
-        print(zooniverse_file)
\ No newline at end of file
+        data, features = self.consensus.polygons(default_frame_only=default_frame_only,
+                                                 min_agreement=min_agreement)
+        data, found = index.to_volume(features['subject_id'], data)
+        if in_view is not None:
+            found &= np.isin(features['subject_id'], in_view)
+        if found.any():
+            self.viewer.add_shapes(list(data[found]), shape_type='polygon',
+                                   features={k: v[found] for k, v in features.items()},
+                                   name="consensus polygons", edge_color='agreement', face_color='transparent')
+        print(f"Placed the consensus of {len(np.unique(features['subject_id'][found]))} of {len(index)} "
+              f"located subjects")
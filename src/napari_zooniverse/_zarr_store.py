@@ -0,0 +1,122 @@
+import os
+import re
+from functools import lru_cache
+import numpy as np
+
+# Store the OME-Zarr export writes to, next to where the JPEG export writes `subject_sets`
+ZARR_STORE_NAME = 'subject_sets.zarr'
+# Full resolution array of a tile group, the only level of its multiscales
+ARRAY_PATH = '0'
+
+_PLANE_Z = re.compile(r'_z(\d+)\.jpe?g$', re.IGNORECASE)
+
+
+def require_tile_array(store_path, tile, n_z, dtype, channels=()):
+    """
+    Create, or open if a shard already created it, the OME-Zarr group of
+    a tile: one (z, y, x) array, (z, y, x, c) for RGB(A) volumes, chunked
+    one z slice by the whole tile, translated to the tile's position in
+    the volume.
+
+    :param store_path: path of the zarr store.
+    :param tile: Tile the group holds.
+    :param n_z: number of z slices in the volume.
+    :param dtype: dtype of the volume.
+    :param channels: shape of the volume after its (z, y, x) axes, e.g. (3,) for RGB.
+    :return: writable zarr array of the tile.
+    """
+    import zarr
+    from numcodecs import Blosc
+    from ._export import tile_dir_name
+
+    name = tile_dir_name(tile)
+    group = zarr.open_group(store_path, mode='a').require_group(name)
+    n_rows = tile.rows.stop - tile.rows.start
+    n_cols = tile.cols.stop - tile.cols.start
+    channels = tuple(channels)
+    array = group.require_dataset(ARRAY_PATH, shape=(n_z, n_rows, n_cols) + channels,
+                                  chunks=(1, n_rows, n_cols) + channels, dtype=dtype, exact=True,
+                                  compressor=Blosc(cname='zstd', clevel=5, shuffle=Blosc.BITSHUFFLE))
+    group.attrs['multiscales'] = [{
+        'version': '0.4',
+        'name': name,
+        'axes': [{'name': axis, 'type': 'space'} for axis in ('z', 'y', 'x')] +
+                [{'name': 'c', 'type': 'channel'} for _ in channels],
+        'datasets': [{'path': ARRAY_PATH,
+                      'coordinateTransformations': [
+                          {'type': 'scale', 'scale': [1.0] * (3 + len(channels))},
+                          {'type': 'translation', 'translation': [0.0, float(tile.rows.start),
+                                                                  float(tile.cols.start)] +
+                                                                 [0.0] * len(channels)}]}],
+    }]
+    group.attrs['tile'] = {'x': int(tile.x), 'y': int(tile.y), 'file_prefix': tile.file_prefix}
+    return array
+
+
+def write_plane(array, z, plane):
+    """
+    Write one z slice of a tile array.
+
+    :return: size in bytes of the stored chunk.
+    """
+    array[z] = plane
+    try:
+        return os.path.getsize(chunk_path(array, z))
+    except (AttributeError, FileNotFoundError):
+        return 0
+
+
+def chunk_path(array, z):
+    """
+    :param array: tile array in a directory store.
+    :param z: z slice of the array.
+    :return: file of the chunk holding slice `z`, named by the array's
+             own chunk key scheme.
+    """
+    return os.path.join(array.store.path, array._chunk_key((z,) + (0,) * (array.ndim - 1)))
+
+
+def is_zarr_tile(path):
+    """
+    :return: whether `path` is a tile group written by the OME-Zarr export.
+    """
+    return os.path.isfile(os.path.join(path, '.zgroup')) and \
+        os.path.isfile(os.path.join(path, ARRAY_PATH, '.zarray'))
+
+
+@lru_cache(maxsize=64)
+def open_tile_array(path):
+    """
+    :param path: tile group.
+    :return: read-only zarr array of the tile.
+    """
+    import zarr
+    return zarr.open_array(os.path.join(path, ARRAY_PATH), mode='r')
+
+
+def tile_file_names(path):
+    """
+    JPEG names of the planes of a tile group without a manifest, e.g.
+    one whose shards have not been merged.
+
+    :return: list of file names and NumPy array of their z indices.
+    """
+    import zarr
+    from ._export import Tile, tile_file_name
+    attrs = zarr.open_group(path, mode='r').attrs['tile']
+    tile = Tile(attrs['x'], attrs['y'], None, None, attrs['file_prefix'])
+    z = np.arange(open_tile_array(path).shape[0], dtype=np.int64)
+    return [tile_file_name(tile, i) for i in z], z
+
+
+def read_plane_jpeg(path):
+    """
+    Encode the plane a JPEG name of a tile group refers to, as the JPEG
+    export would have written it.
+
+    :param path: tile group joined with a plane's JPEG file name.
+    :return: JPEG bytes.
+    """
+    from ._export import encode_jpeg
+    z = int(_PLANE_Z.search(path).group(1))
+    return encode_jpeg(open_tile_array(os.path.dirname(path))[z])